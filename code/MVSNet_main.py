@@ -9,7 +9,8 @@ from dataflow_utils import *
 import multiprocessing
 import os
 import tensorflow as tf
-from nn_utils import (uni_feature_extraction_branch, unet_feature_extraction_branch)
+from nn_utils import (uni_feature_extraction_branch, unet_feature_extraction_branch, COST_VOLUME_MODES,
+                      FEATURE_VIEW_MODES, COST_VOLUME_DTYPES)
 from tensorpack.tfutils.gradproc import SummaryGradient
 from matplotlib import pyplot as plt
 from os import path
@@ -17,6 +18,53 @@ from DataManager import Cam
 import cv2
 import numpy as np
 from test_utils import PointCloudGenerator
+from loader_utils import (SharedMemoryLoader, DataFlowStatsMonitor)
+from manifest_utils import load_or_build_manifest
+from dataflow_utils import (DTU_TRAINING_SET, DTU_VALIDATION_SET)
+from predict_utils import (FeatureCachePredictor, BucketPredictor, FrozenPredictor, TiledPredictor, sample_bucket,
+                           choose_tile_shape)
+from export_utils import (export_frozen_graph, FROZEN_OUTPUT_NAMES)
+
+
+def get_model(args, stage='full', depth_num=None, tile_shape=None, image_shape=None, with_gt=True):
+    """
+    MVSNet of the command line args, of depth_num planes instead of --max_d if given
+    :param with_gt: gt_depth is fed at inference, see MVSNet
+    :param tile_shape: tile height, tile width in feature pixels of the 'tile' stage
+    :param image_shape: height, width of the images instead of --max_h, --max_w
+    """
+    image_shape = image_shape or (args.max_h, args.max_w)
+    height, width = image_shape if tile_shape is None else [size * 4 for size in tile_shape]
+    if args.feature == 'unet':
+        feature_branch_function = unet_feature_extraction_branch
+    else:
+        feature_branch_function = uni_feature_extraction_branch
+    return MVSNet(depth_num=depth_num or args.max_d, bn_training=None, bn_trainable=None, batch_size=args.batch,
+                  branch_function=feature_branch_function, is_refine=args.refine, height=height,
+                  width=width, view_num=args.view_num, regularize_type=args.regularize,
+                  cost_volume_mode=args.cost_volume, depth_chunk=args.depth_chunk,
+                  homography_input=args.homography_input, feature_views=args.feature_views, stage=stage,
+                  cost_volume_dtype=args.cost_volume_dtype,
+                  cascade=[int(plane_num) for plane_num in args.cascade.split(',')] if args.cascade else None,
+                  source_shape=image_shape, with_gt=with_gt)
+
+
+def get_buckets(args):
+    """ (height, width) of --buckets, None without """
+    if not args.buckets:
+        return None
+    buckets = [tuple(int(size) for size in bucket.split('x')) for bucket in args.buckets.split(',')]
+    for height, width in buckets:
+        assert height % 32 == 0 and width % 32 == 0, 'bucket {}x{} is not a multiple of 32'.format(height, width)
+    return buckets
+
+
+def get_manifest(args, kind):
+    """ manifest of args.data if --manifest is given, built and saved on first use """
+    if not args.manifest:
+        return None
+    return load_or_build_manifest(args.manifest, args.data, kind, scans=DTU_TRAINING_SET + DTU_VALIDATION_SET,
+                                  check_stale=args.manifest_check)
 
 
 def get_data(args, mode):
@@ -27,22 +75,75 @@ def get_data(args, mode):
         logger.warn("DataFlow may become the bottleneck when too few processes are used.")
     if mode == 'train':
         # ds = PrefetchData(ds, 4, parallel)
-        ds = DTU(args.data, args.view_num, mode, args.interval_scale, args.max_d)
+        if args.shards:
+            ds = DTUShard(args.shards, args.view_num, mode, args.interval_scale, args.max_d,
+                          with_homographies=args.homography_input)
+        else:
+            ds = DTU(args.data, args.view_num, mode, args.interval_scale, args.max_d,
+                     cache_bytes=args.image_cache_mb * 1024 ** 2, manifest=get_manifest(args, 'dtu'),
+                     with_homographies=args.homography_input)
         # ds = PrefetchDataZMQ(ds, nr_proc=parallel)
 
-        ds = BatchData(ds, args.batch, remainder=False)
+        if args.loader_workers != 0:
+            nr_proc = parallel if args.loader_workers < 0 else args.loader_workers
+            ds = SharedMemoryLoader(ds, args.batch, nr_proc)
+        else:
+            ds = BatchData(ds, args.batch, remainder=False)
     elif mode == 'val':
-        ds = DTU(args.data, args.view_num, mode, args.interval_scale, args.max_d)
+        if args.shards:
+            ds = DTUShard(args.shards, args.view_num, mode, args.interval_scale, args.max_d,
+                          with_homographies=args.homography_input)
+        else:
+            ds = DTU(args.data, args.view_num, mode, args.interval_scale, args.max_d,
+                     manifest=get_manifest(args, 'dtu'), with_homographies=args.homography_input)
         # ds = PrefetchData(ds, 4, parallel)
         ds = BatchData(ds, args.batch, remainder=True)
         # ds = FakeData([[3, 512, 640, 3], [3, 2, 4, 4], [512 // 4, 640 // 4, 1]], 1)
         # ds = BatchData(ds, args.batch, remainder=False)
     else:
-        ds = FakeData([[3, 512, 640, 3], [3, 2, 4, 4], [512 // 4, 640 // 4, 1]], 20)
+        shapes = [[3, 512, 640, 3], [3, 2, 4, 4], [512 // 4, 640 // 4, 1]]
+        if args.homography_input:
+            shapes.insert(2, [2, args.max_d, 3, 3])
+        ds = FakeData(shapes, 20)
         ds = BatchData(ds, args.batch, remainder=False)
     return ds
 
 
+def get_checkpoint_step(model_path):
+    """ global_step of a checkpoint or an npz model, 0 if it has none """
+    if model_path.endswith('.npz'):
+        params = np.load(model_path)
+        for name in ['global_step:0', 'global_step']:
+            if name in params:
+                return int(params[name])
+        return 0
+    reader = tf.train.NewCheckpointReader(model_path)
+    return int(reader.get_tensor('global_step')) if reader.has_tensor('global_step') else 0
+
+
+def resume_train_data(ds_train, step, nr_tower):
+    """
+    sets the DTU dataflow under ds_train to the epoch and the sample that follow the batches of `step` steps.
+    BatchData(remainder=False) drops the last len(ds) % batch_size samples of every epoch, so an epoch is
+    len(ds) // batch_size batches. SharedMemoryLoader workers batch a continuous stream of their shards, no sample
+    is dropped, and each worker skips an equal part of its shard. Its workers run ahead of the trainer
+    unsynchronised, so with it the resumed order only approximates the one the restored run would have continued
+    with
+    """
+    ds = ds_train.ds
+    batch_size = ds_train.batch_size
+    batches = step * nr_tower
+    if isinstance(ds_train, SharedMemoryLoader):
+        epoch, start = divmod(batches * batch_size, len(ds))
+        start //= ds_train.nr_proc
+    else:
+        epoch, batch_index = divmod(batches, len(ds) // batch_size)
+        start = batch_index * batch_size
+    ds.set_epoch(epoch, start)
+    logger.info('resumed the train data at step {}: epoch {}, sample {}'.format(step, epoch, start))
+    return epoch
+
+
 def get_train_conf(model, args):
     nr_tower = max(get_num_gpu(), 1)
     batch = args.batch
@@ -64,6 +165,12 @@ def get_train_conf(model, args):
     val_data = QueueInput(ds_val)
     steps_per_epoch = train_size // nr_tower
     logger.info("train_size={}. steps_per_epoch={}".format(train_size, steps_per_epoch))
+    starting_epoch = 1
+    if args.mode == 'train' and args.load:
+        # continue the sample order of the restored run instead of restarting its first epoch
+        step = get_checkpoint_step(args.load)
+        resume_train_data(ds_train, step, nr_tower)
+        starting_epoch = step // steps_per_epoch + 1
     callbacks = [
         ModelSaver(),
         EstimatedTimeLeft(),
@@ -71,6 +178,10 @@ def get_train_conf(model, args):
     callbacks.extend([
         GPUUtilizationTracker(),
     ])
+    # BatchData wraps the DTU dataflow, SharedMemoryLoader collects the stats of its workers itself
+    stats_ds = ds_train if hasattr(ds_train, 'get_stats') else getattr(ds_train, 'ds', None)
+    if hasattr(stats_ds, 'get_stats'):
+        callbacks.append(DataFlowStatsMonitor(stats_ds))
 
     return TrainConfig(
         # session_creator=creator,
@@ -87,6 +198,7 @@ def get_train_conf(model, args):
             ScalarPrinter(blacklist=['param-summary.*', 'SummaryGradient.*'])
         ],
         steps_per_epoch=steps_per_epoch,
+        starting_epoch=starting_epoch,
         max_epoch=5,
     )
 
@@ -101,7 +213,7 @@ def evaluate(model, sess_init, args):
     pred_conf = PredictConfig(
         model=model,
         session_init=sess_init,
-        input_names=['imgs', 'cams', 'gt_depth'],
+        input_names=model.get_input_names(),
         output_names=['prob_map', 'coarse_depth', 'refine_depth', 'imgs', 'loss',
                       'less_one_accuracy', 'less_three_accuracy']
     )
@@ -141,10 +253,10 @@ def evaluate(model, sess_init, args):
     return avg_loss, avg_less_three_acc, avg_less_one_acc
 
 
-def test(model, sess_init, args):
+def test(sess_init, args):
     """
     outputs prob_map, depth_map, rgb, and meshlab .obj file
-    :param model:
+    the models are built from args by get_model, one per bucket of the samples and per stage
     :param sess_init:
     :param args:
     :return:
@@ -158,17 +270,82 @@ def test(model, sess_init, args):
     interval_scale = args.interval_scale
     logger.info('data_dir: %s, out_dir: %s' % (data_dir, out_base))
 
-    pred_conf = PredictConfig(
-        model=model,
-        session_init=sess_init,
-        input_names=['imgs', 'cams'],
-        output_names=['prob_map', 'coarse_depth', 'refine_depth', 'cost_volume_regularization/regularized_cost_volume']
-    )
+    output_names = ['prob_map', 'coarse_depth', 'refine_depth']
+    if args.regularize == '3DCNN' and not args.cascade and args.tile_budget_mb <= 0:
+        # the GRU regularization keeps no volume at inference, the cascade only narrow ones and tiles only parts
+        output_names.append('cost_volume_regularization/regularized_cost_volume')
+    buckets = get_buckets(args)
+    # the depth num of a sample is the one of its ref cam with --target_interval
+    depth_num = None if args.target_interval > 0 else args.max_d
+    input_names = get_model(args).get_predict_input_names()
+
+    def bucketed(build_func, cams_index):
+        """ one predictor per sample_bucket of the samples, built by build_func(height, width, depth_num, view_num) """
+        return BucketPredictor(build_func, lambda *inputs: sample_bucket(inputs[0], inputs[cams_index], depth_num),
+                               args.bucket_predictors)
+
+    if args.frozen:
+        # a single graph import instead of building the model and restoring the checkpoint
+        def build_pred_func(height, width, depth_num, view_num):
+            graph_path = args.frozen.format(height=height, width=width, depth_num=depth_num, view_num=view_num)
+            return FrozenPredictor(graph_path, input_names, FROZEN_OUTPUT_NAMES)
+
+        pred_func = bucketed(build_pred_func, input_names.index('cams'))
+        predictor = lambda meta, dp: pred_func(*[np.expand_dims(component, 0) for component in dp])
+    elif args.feature_cache_mb > 0 or args.tile_budget_mb > 0:
+        # features of each image extracted once per scene, the model is rebuilt as two stages
+        def build_feature_func(height, width):
+            feature_model = get_model(args, stage='feature', image_shape=(height, width))
+            return OfflinePredictor(PredictConfig(
+                model=feature_model, session_init=sess_init, input_names=feature_model.get_predict_input_names(),
+                output_names=['image_features']))
+
+        if args.tile_budget_mb > 0:
+            # the depth stage tile by tile
+            def build_depth_func(height, width, depth_num, view_num):
+                tile_shape = choose_tile_shape(args.tile_budget_mb * 1024 ** 2, depth_num, height // 4, width // 4,
+                                               view_num, MVSNet.feature_channels)
+                logger.info('tiles of {}x{} feature pixels'.format(*tile_shape))
+                tile_model = get_model(args, stage='tile', depth_num=depth_num, tile_shape=tile_shape,
+                                       image_shape=(height, width), with_gt=False)
+                tile_func = OfflinePredictor(PredictConfig(
+                    model=tile_model, session_init=sess_init, input_names=tile_model.get_predict_input_names(),
+                    output_names=output_names))
+                return TiledPredictor(tile_func, tile_shape, args.tile_overlap)
+        else:
+            def build_depth_func(height, width, depth_num, view_num):
+                depth_model = get_model(args, stage='depth', depth_num=depth_num, image_shape=(height, width),
+                                        with_gt=False)
+                return OfflinePredictor(PredictConfig(
+                    model=depth_model, session_init=sess_init, input_names=depth_model.get_predict_input_names(),
+                    output_names=output_names))
+
+        # the feature stage only depends on the resolution
+        feature_func = BucketPredictor(build_feature_func, lambda imgs: imgs.shape[1:3], args.bucket_predictors)
+        depth_func = bucketed(build_depth_func, get_model(args, stage='depth').get_predict_input_names().index('cams'))
+        predictor = FeatureCachePredictor(feature_func, depth_func, max(args.feature_cache_mb, 0) * 1024 ** 2)
+    else:
+        def build_pred_func(height, width, depth_num, view_num):
+            pred_model = get_model(args, depth_num=depth_num, image_shape=(height, width), with_gt=False)
+            pred_conf = PredictConfig(
+                model=pred_model,
+                session_init=sess_init,
+                input_names=pred_model.get_predict_input_names(),
+                output_names=output_names
+            )
+            return OfflinePredictor(pred_conf)
+
+        pred_func = bucketed(build_pred_func, input_names.index('cams'))
+        predictor = lambda meta, dp: pred_func(*[np.expand_dims(component, 0) for component in dp])
     # create imgs and cams data
     # data_points = list(DTU.make_test_data(data_dir, view_num, max_h, max_w, max_d, interval_scale))
-    data_points = DTU.make_test_dataset(data_dir, view_num, max_h, max_w, max_d, interval_scale)
+    # streamed: the next samples are read, scaled and cropped while the current one is predicted
+    data_points = DTU.make_test_dataset(data_dir, view_num, max_h, max_w, max_d, interval_scale,
+                                        nr_thread=args.test_threads, prefetch=args.test_prefetch,
+                                        manifest=get_manifest(args, 'test'),
+                                        with_homographies=args.homography_input, with_meta=True,
+                                        target_interval=args.target_interval or None, buckets=buckets)
     # model.batch_size = len(data_points)
-    pred_func = OfflinePredictor(pred_conf)
 
     # TODO: after release training, finish this
     # imgs = [dp[0] for dp in data_points]
@@ -194,21 +371,19 @@ def test(model, sess_init, args):
     #     PointCloudGenerator.write_as_obj(depth_point_list, path.join(out_dir, '%s_depth.obj' % str(i)))
     # logger.info('len of data_points: %d' % len(data_points))
     # Function here assumes batch = 1
-    dir_count = 0
-    view_num_count = 0
-    for idx, dp in enumerate(data_points):
-        out_dir = path.join(out_base, str(dir_count))
+    for meta, dp in data_points:
+        # outputs of a scene go to the dir of its name, prefixed by the index of the sample in the scene
+        out_dir = path.join(out_base, meta['scene'])
+        view_num_count = meta['sample']
         if not path.exists(out_dir):
             os.makedirs(out_dir)
-        imgs, cams = dp
-        batch_prob_map, batch_coarse_depth, batch_refine_depth, batch_reg_cost_volume = \
-            pred_func(np.expand_dims(imgs, 0), np.expand_dims(cams, 0))
+        # imgs, cams and the homographies with --homography_input
+        imgs, cams = dp[:2]
+        batch_prob_map, batch_coarse_depth, batch_refine_depth, *batch_reg_cost_volume = predictor(meta, dp)
         logger.info('shape of batch_prob_map: {}'.format(batch_prob_map.shape))
-        # size of reg_cost_volume: d, h/4, w/4
-        prob_map, coarse_depth, refine_depth, reg_cost_volume = np.squeeze(batch_prob_map), \
-                                                                np.squeeze(batch_coarse_depth), \
-                                                                np.squeeze(batch_refine_depth), \
-                                                                np.squeeze(batch_reg_cost_volume)
+        prob_map, coarse_depth, refine_depth = np.squeeze(batch_prob_map), \
+                                               np.squeeze(batch_coarse_depth), \
+                                               np.squeeze(batch_refine_depth)
         quality_depth = np.where(prob_map > args.threshold, refine_depth, np.zeros_like(refine_depth))
         mask_mat = np.where(prob_map > args.threshold, np.ones_like(refine_depth), np.zeros_like(refine_depth))
         ref_img, ref_cam = imgs[0], cams[0]
@@ -226,7 +401,10 @@ def test(model, sess_init, args):
         plt.imsave(path.join(out_dir, str(view_num_count) + '_depth_quality.png'), quality_depth, cmap='rainbow')
         plt.imsave(path.join(out_dir, str(view_num_count) + '_rgb.png'), rgb.astype('uint8'))
         # save the reg_cost_volume for future process
-        np.save(path.join(out_dir, str(view_num_count) + '_reg_cost_volume'), reg_cost_volume)
+        if batch_reg_cost_volume:
+            # size of reg_cost_volume: d, h/4, w/4
+            reg_cost_volume = np.squeeze(batch_reg_cost_volume[0])
+            np.save(path.join(out_dir, str(view_num_count) + '_reg_cost_volume'), reg_cost_volume)
 
         Cam.write_cam(ref_cam, path.join(out_dir, str(view_num_count) + '_cam.txt'), intrinsic_scale=4.)
 
@@ -245,23 +423,22 @@ def test(model, sess_init, args):
         depth_point_list = PointCloudGenerator.gen_3d_point_with_rgb(coarse_depth, downsample_rgb, intrinsic, prob_map,
                                                                      args.threshold)
         PointCloudGenerator.write_as_obj(depth_point_list, path.join(out_dir, '%s_depth.obj' % str(view_num_count)))
-        view_num_count += 1
-        # FIXME: only works if the dir contains 5 imgs
-        if view_num_count == 5:
-            view_num_count = 0
-            dir_count += 1
+    if isinstance(predictor, FeatureCachePredictor):
+        predictor.finish_scene()
 
 
 def mvsnet_main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--logdir', help='path to save model ckpt', default='.')
-    parser.add_argument('--data', help='path to dataset', required=True)
+    parser.add_argument('--data', help='path to dataset')
     parser.add_argument('--load', help='load a model for training or evaluation')
     parser.add_argument('--exp_name', help='model ckpt name')
     parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
-    parser.add_argument('--mode', '-m', help='train / val / test', choices=['train', 'val', 'test', 'fake'])
+    parser.add_argument('--mode', '-m', help='train / val / test / export',
+                        choices=['train', 'val', 'test', 'fake', 'export'])
     parser.add_argument('--out', default='./',
-                        help='output path for evaluation and test, default to current folder')
+                        help='output path for evaluation and test, default to current folder. test writes the outputs '
+                             'of a sample to <out>/<scene dir name>/<index of the sample in the scene>_*')
     parser.add_argument('--batch', default=1, type=int, help="Batch size per tower.")
     parser.add_argument('--max_d', help='depth num for MVSNet', required=True, type=int)
     parser.add_argument('--max_h', help='depth num for MVSNet', required=True, type=int)
@@ -272,22 +449,74 @@ def mvsnet_main():
     parser.add_argument('--feature', help='feature extraction branch', choices=['uninet', 'unet'], default='unet')
     parser.add_argument('--threshold', type=float)
     parser.add_argument('--regularize', default='3DCNN', choices=['3DCNN', 'GRU'])
+    parser.add_argument('--cascade', default='',
+                        help='depth planes of the stages of a coarse to fine 3DCNN regularization, multiples of 8, '
+                             'e.g. 48,32,8. Each stage halves the depth interval around the depth of the previous '
+                             'stage, within the depth range of the ref cam')
+    parser.add_argument('--feature_views', default='batched', choices=FEATURE_VIEW_MODES,
+                        help='batched: one feature extraction pass over all views, per_view: one pass per view')
+    parser.add_argument('--cost_volume', default='batched', choices=COST_VOLUME_MODES,
+                        help='batched: warp all depth planes of a view in one op, loop: one op per plane and view, '
+                             'chunked: build --depth_chunk planes at a time in a loop to bound the memory, '
+                             'streamed: with --regularize GRU, warp each plane inside the regularization loop')
+    parser.add_argument('--cost_volume_dtype', default='float32', choices=COST_VOLUME_DTYPES,
+                        help='store the cost volume and the skips of its 3DCNN regularization in this dtype, '
+                             'the layers still compute in float32. The batched --cost_volume builds the volume in '
+                             'float32 and casts it, so its peak while building is not lowered, the loop and chunked '
+                             'modes cast plane by plane and chunk by chunk')
+    parser.add_argument('--depth_chunk', default=32, type=int,
+                        help='num of depth planes per iteration of the chunked cost volume')
+    parser.add_argument('--homography_input', action='store_true',
+                        help='compute the homographies in the dataflow (memoized) and feed them to the graph')
+    parser.add_argument('--shards', help='dir of packed dtu shards (see shard_utils.py), replaces png decoding')
+    parser.add_argument('--loader_workers', '--loader-workers', default=0, type=int,
+                        help='num of processes loading training batches into shared memory, '
+                             '0 loads in the trainer process, -1 uses half of the cpu count')
+    parser.add_argument('--image_cache_mb', default=0, type=int,
+                        help='size of the decoded image cache of each training dataflow (process), 0 disables it')
+    parser.add_argument('--manifest',
+                        help='file manifest of --data (see manifest_utils.py), built there if missing, '
+                             'samples with missing or empty files are excluded')
+    parser.add_argument('--manifest_check', action='store_true',
+                        help='stat the files of a saved --manifest again and rebuild it if any changed')
+    parser.add_argument('--test_threads', default=4, type=int,
+                        help='num of threads that load test samples')
+    parser.add_argument('--test_prefetch', default=8, type=int,
+                        help='max num of test samples loaded ahead of the predictor')
+    parser.add_argument('--feature_cache_mb', default=0, type=int,
+                        help='test: budget of the per scene cache of image features, the features of each image are '
+                             'extracted once per scene by a separate feature stage. 0 runs the whole net for every '
+                             'sample')
+    parser.add_argument('--target_interval', default=0., type=float,
+                        help='test: sweep each sample with the fewest planes, a multiple of 8 up to --max_d, that '
+                             'cover the depth range of its ref cam at this interval, one graph per num of planes. '
+                             '0 sweeps --max_d planes of the cam interval')
+    parser.add_argument('--tile_budget_mb', default=0, type=int,
+                        help='test: run the depth stage on tiles of the ref view, as large as this memory budget '
+                             'allows. 0 runs it on the whole image')
+    parser.add_argument('--tile_overlap', default=8, type=int,
+                        help='test: min overlap of the tiles in feature pixels (1/4 of the image), blended with '
+                             'feathered weights')
+    parser.add_argument('--frozen',
+                        help='export: file to write the frozen inference graph of --load to, test: predict with that '
+                             'graph instead of building the model and restoring --load. May contain {height}, '
+                             '{width}, {depth_num} and {view_num}, filled per bucket')
+    parser.add_argument('--buckets',
+                        help='test: comma separated resolutions, e.g. 512x640,640x512, each sample is scaled and '
+                             'cropped to the closest one that fits in it instead of --max_h x --max_w, images '
+                             'smaller than every bucket are an error. export: one graph per bucket')
+    parser.add_argument('--bucket_predictors', default=4, type=int,
+                        help='test: max num of predictors kept, one per resolution, depth num and view num')
 
     args = parser.parse_args()
 
-    if args.feature == 'unet':
-        feature_branch_function = unet_feature_extraction_branch
-    else:
-        feature_branch_function = uni_feature_extraction_branch
-
     if args.gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
     if args.mode == 'train' or args.mode == 'fake':
+        assert args.data, 'in train mode, you have to specify the data dir path'
 
-        model = MVSNet(depth_num=args.max_d, bn_training=None, bn_trainable=None, batch_size=args.batch,
-                       branch_function=feature_branch_function, is_refine=args.refine, height=args.max_h,
-                       width=args.max_w, view_num=args.view_num, regularize_type=args.regularize)
+        model = get_model(args)
 
         if args.exp_name is None:
             if not args.refine:
@@ -318,27 +547,34 @@ def mvsnet_main():
 
     elif args.mode == 'val':
         assert args.load, 'in eval mode, you have to specify a trained model'
+        assert args.data, 'in eval mode, you have to specify the data dir path'
         assert args.out, 'in eval mode, you have to specify the output dir path'
         logger.set_logger_dir(args.out)
-        model = MVSNet(depth_num=args.max_d, bn_training=None, bn_trainable=None, batch_size=args.batch,
-                       branch_function=feature_branch_function, is_refine=args.refine, height=args.max_h,
-                       width=args.max_w, view_num=args.view_num)
+        model = get_model(args)
         sess_init = get_model_loader(args.load)
         avg_loss, avg_less_three_acc, avg_less_one_acc = evaluate(model, sess_init, args)
         logger.info(f'val loss: {avg_loss}')
         logger.info(f'val less three acc: {avg_less_three_acc}')
         logger.info(f'val less one acc: {avg_less_one_acc}')
 
+    elif args.mode == 'export':
+        assert args.load, 'in export mode, you have to specify a trained model'
+        assert args.frozen, 'in export mode, you have to specify the path of the frozen graph'
+        buckets = get_buckets(args) or [(args.max_h, args.max_w)]
+        graph_paths = [args.frozen.format(height=height, width=width, depth_num=args.max_d, view_num=args.view_num)
+                       for height, width in buckets]
+        assert len(set(graph_paths)) == len(buckets), 'the buckets need {height} and {width} in --frozen'
+        for bucket, graph_path in zip(buckets, graph_paths):
+            export_frozen_graph(get_model(args, image_shape=bucket, with_gt=False), get_model_loader(args.load),
+                                graph_path)
+
     else:  # test
-        assert args.load, 'in eval mode, you have to specify a trained model'
+        assert args.load or args.frozen, 'in eval mode, you have to specify a trained model'
         assert args.out, 'in eval mode, you have to specify the output dir path'
         assert args.data, 'in eval mode, you have to specify the data dir path'
         logger.set_logger_dir(args.out)
-        model = MVSNet(depth_num=args.max_d, bn_training=None, bn_trainable=None, batch_size=args.batch,
-                       branch_function=feature_branch_function, is_refine=args.refine, height=args.max_h,
-                       width=args.max_w, view_num=args.view_num, regularize_type=args.regularize)
-        sess_init = get_model_loader(args.load)
-        test(model, sess_init, args)
+        sess_init = get_model_loader(args.load) if args.load else None
+        test(sess_init, args)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,12 @@
+import os
 import numpy as np
 import cv2
 import re
 from tensorpack.utils import logger
 import tensorflow as tf
 import copy
+import threading
+from collections import OrderedDict
 
 
 def mask_depth_image(depth_image, min_depth, max_depth):
@@ -15,6 +18,64 @@ def mask_depth_image(depth_image, min_depth, max_depth):
     return depth_image
 
 
+def clip_mask_depth(depth_image, min_depth, max_depth):
+    """
+    fused mask_depth_image: keeps pixels in (min_depth, max_depth], zeros the rest and adds the channel axis,
+    writing straight into the float32 output instead of two cv2.threshold passes and an expand_dims
+    :param depth_image: shape: h, w, may be a read-only or flipped view such as the one load_pfm returns
+    :return: depth_image, shape: h, w, 1
+    """
+    # cv2.threshold compares in float32, so do we
+    min_depth, max_depth = np.float32(min_depth), np.float32(max_depth)
+    mask = np.greater(depth_image, min_depth)
+    mask &= np.less_equal(depth_image, max_depth)
+    masked_depth = np.zeros(depth_image.shape + (1,), dtype=np.float32)
+    np.copyto(masked_depth[..., 0], depth_image, where=mask)
+    return masked_depth
+
+
+def load_pfm(file_name):
+    """
+    memory-map the payload of a pfm file
+    :return: read-only view of shape (h, w) or (h, w, 3), flipped to top-down row order without copying
+    """
+    with open(file_name, 'rb') as file:
+        header = str(file.readline(), encoding='utf-8').strip('\n ')
+        if header == 'PF':
+            color = True
+        elif header == 'Pf':
+            color = False
+        else:
+            raise Exception('Not a PFM file.')
+        dim_match = re.match(r'^(\d+)\s(\d+)\s$', str(file.readline(), encoding='utf-8'))
+        if dim_match:
+            width, height = map(int, dim_match.groups())
+        else:
+            raise Exception('Malformed PFM header.')
+        scale = float((file.readline()).rstrip())
+        data_type = '<f4' if scale < 0 else '>f4'
+        offset = file.tell()
+    shape = (height, width, 3) if color else (height, width)
+    data = np.memmap(file_name, dtype=data_type, mode='r', offset=offset, shape=shape)
+    return data[::-1]
+
+
+def write_pfm(file_name, data, scale=1.):
+    """ write a (h, w), (h, w, 1) or (h, w, 3) array as little-endian pfm, the counterpart of load_pfm """
+    data = np.asarray(data)
+    if data.ndim == 3 and data.shape[2] == 1:
+        data = data[..., 0]
+    color = data.ndim == 3
+    assert not color or data.shape[2] == 3, 'pfm takes 1 or 3 channels, got shape {}'.format(data.shape)
+    height, width = data.shape[:2]
+    with open(file_name, 'wb') as file:
+        file.write(('PF\n' if color else 'Pf\n').encode('utf-8'))
+        file.write(('%d %d\n' % (width, height)).encode('utf-8'))
+        # negative scale marks little-endian
+        file.write(('%f\n' % -abs(scale)).encode('utf-8'))
+        np.ascontiguousarray(data[::-1], dtype='<f4').tofile(file)
+
+
 class Cam(object):
 
     def __init__(self, file_name=None, max_d=None, interval_scale=1):
@@ -159,39 +220,114 @@ class Cam(object):
                 self.depth_max = 0
 
 
+CAM_FILE_RE = re.compile(r'^(\d+)_cam\.txt$')
+
+
+def cam_index(cam_path):
+    """ index of a cam file named like %08d_cam.txt """
+    match = CAM_FILE_RE.match(os.path.basename(cam_path))
+    assert match, 'not a cam file: {}'.format(cam_path)
+    return int(match.group(1))
+
+
+class CamTable(object):
+    """
+    process-wide registry of parsed cams
+    every cam folder is parsed once into a dense float32 array of shape (N, 2, 4, 4), indexed by the cam index
+    in the file name, rows of missing files stay zero. Build the tables before forking dataflow workers, the
+    children then share them copy-on-write instead of re-tokenizing every cam file per sample.
+    """
+    _tables = {}
+    # the test pipeline looks cams up from several threads, each folder should still be parsed once
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(cam_folder, max_d=None, interval_scale=1):
+        key = (os.path.abspath(cam_folder), max_d, interval_scale)
+        with CamTable._lock:
+            table = CamTable._tables.get(key)
+            if table is None:
+                table = CamTable._build(cam_folder, max_d, interval_scale)
+                CamTable._tables[key] = table
+        return table
+
+    @staticmethod
+    def lookup(cam_path, max_d=None, interval_scale=1):
+        """ mat form of a single cam, the returned array is a view into the shared table, do not modify it """
+        return CamTable.get(os.path.dirname(cam_path), max_d, interval_scale)[cam_index(cam_path)]
+
+    @staticmethod
+    def _build(cam_folder, max_d, interval_scale):
+        cam_files = {}
+        for file_name in os.listdir(cam_folder):
+            match = CAM_FILE_RE.match(file_name)
+            if match:
+                cam_files[int(match.group(1))] = file_name
+        assert len(cam_files) > 0, 'no cam file found in {}'.format(cam_folder)
+        table = np.zeros((max(cam_files) + 1, 2, 4, 4), dtype=np.float32)
+        for index, file_name in cam_files.items():
+            table[index] = Cam(os.path.join(cam_folder, file_name), max_d=max_d,
+                               interval_scale=interval_scale).get_mat_form()
+        table.flags.writeable = False
+        logger.info('parsed {} cams in {}'.format(len(cam_files), cam_folder))
+        return table
+
+
+class LRUCache(object):
+    """
+    least-recently-used cache of numpy arrays, bounded by the sum of their nbytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, load_func):
+        """ cached value of key, load_func(key) is called on a miss """
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = load_func(key)
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key).nbytes
+        if value.nbytes > self.max_bytes:
+            return
+        self._entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+
 class PFMReader(object):
     def __init__(self, file_name):
         self.file_name = file_name
         self.data = self._load_pfm_file()
 
     def _load_pfm_file(self):
-        file = open(self.file_name, 'rb')
-        header = str(file.readline(), encoding='utf-8').strip('\n ')
-        # print(header)
-
-        if header == 'PF':
-            color = True
-        elif header == 'Pf':
-            color = False
-        else:
-            raise Exception('Not a PFM file.')
-        dim_match = re.match(r'^(\d+)\s(\d+)\s$', str(file.readline(), encoding='utf-8'))
-        if dim_match:
-            width, height = map(int, dim_match.groups())
-        else:
-            raise Exception('Malformed PFM header.')
-        # scale = float(file.readline().rstrip())
-        scale = float((file.readline()).rstrip())
-        if scale < 0:  # little-endian
-            data_type = '<f'
-        else:
-            data_type = '>f'  # big-endian
-        data_string = file.read()
-        data = np.fromstring(data_string, data_type)
-        # data = np.fromfile(file, data_type)
-        shape = (height, width, 3) if color else (height, width)
-        data = np.reshape(data, shape)
-        data = cv2.flip(data, 0)
-        file.close()
-
-        return data
+        # a single copy out of the mapping, callers get a writable, contiguous array as before
+        return np.ascontiguousarray(load_pfm(self.file_name))
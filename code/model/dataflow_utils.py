@@ -3,14 +3,28 @@
 # Author: Yeeef
 
 import os
+import copy
 import numpy as np
 from tensorpack import *
-from DataManager import (Cam, PFMReader, mask_depth_image)
+from DataManager import (Cam, CamTable, load_pfm, clip_mask_depth, LRUCache)
+from shard_utils import DTUShardReader
+from manifest_utils import (DTU_IMAGE_FILE, DTU_DEPTH_FILE, DTU_CAM_FILE)
+from homography_utils import get_view_homographies_np
 import cv2
 from tensorpack.utils import logger
 import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-__all__ = ['DTU']
+__all__ = ['DTU', 'DTUShard']
+
+# 3 sets
+DTU_TRAINING_SET = [2, 6, 7, 8, 14, 16, 18, 19, 20, 22, 30, 31, 36, 39, 41, 42, 44,
+                    45, 46, 47, 50, 51, 52, 53, 55, 57, 58, 60, 61, 63, 64, 65, 68, 69, 70, 71, 72,
+                    74, 76, 83, 84, 85, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100,
+                    101, 102, 103, 104, 105, 107, 108, 109, 111, 112, 113, 115, 116, 119, 120,
+                    121, 122, 123, 124, 125, 126, 127, 128]
+DTU_VALIDATION_SET = [3, 5, 17, 21, 28, 35, 37, 38, 40, 43, 56, 59, 66, 67, 82, 86, 106, 117]
 
 
 def center_image(img):
@@ -58,7 +72,6 @@ def gen_test_input_sample_list(data_dir, view_num):
 
 def scale_mvs_input(images, cams, depth_image=None, scale=1.):
     """ resize input to fit into the memory """
-    print('-'*100)
     view_num = len(images)
     for view in range(view_num):
 
@@ -112,7 +125,6 @@ def crop_mvs_input(images, cams, max_h, max_w, base_image_size=8, depth_image=No
             new_w = max_w
         else:
             new_w = int(math.ceil(w / base_image_size) * base_image_size)
-        print('h: {}, w:{}, new_h: {}, new_w: {}'.format(h, w, new_h, new_w))
         start_h = int(math.ceil((h - new_h) / 2))
         start_w = int(math.ceil((w - new_w) / 2))
         finish_h = start_h + new_h
@@ -130,6 +142,147 @@ def crop_mvs_input(images, cams, max_h, max_w, base_image_size=8, depth_image=No
         return images, cams
 
 
+# the depth num of adapt_depth_num is a multiple of it, the 3 stride 2 levels of the 3DCNN regularization halve it
+DEPTH_BUCKET = 8
+
+
+def adapt_depth_num(cams, depth_interval, max_d, bucket=DEPTH_BUCKET):
+    """
+    the smallest num of depth planes, a multiple of bucket, that covers [depth_min, depth_max] of the ref cam at
+    depth_interval. The interval is stretched where the range needs more than max_d planes.
+    The depth meta of the ref cam are updated in place
+    :param cams: shape: view_num, 2, 4, 4
+    :return: cams
+    """
+    depth_min, depth_max = Cam.get_depth_meta(cams[0], 'depth_min', 'depth_max')
+    # depth_max = depth_min + depth_interval * depth_num, as in Cam
+    depth_num = int(math.ceil((depth_max - depth_min) / depth_interval - 1e-6))
+    depth_num = max(int(math.ceil(depth_num / bucket)) * bucket, bucket)
+    if depth_num > max_d:
+        depth_interval = (depth_max - depth_min) / max_d
+        depth_num = max_d
+    cams[0, 1, 3, 1] = depth_interval
+    cams[0, 1, 3, 2] = depth_num
+    cams[0, 1, 3, 3] = depth_min + depth_interval * depth_num
+    return cams
+
+
+def read_image(image_path):
+    """ cv2.imread, raising an IOError where it returns None for a missing or unreadable file """
+    img = cv2.imread(image_path)
+    if img is None:
+        raise IOError('cannot read image {}'.format(image_path))
+    return img
+
+
+def closest_bucket(buckets, height, width):
+    """
+    the (max_h, max_w) of buckets that crops a height x width image the least once preprocess_mvs_input scaled it
+    to cover the bucket and cropped it, then the one of the scale closest to 1. Only the buckets that fit in the
+    image are considered, preprocess_mvs_input does not upscale
+
+    >>> closest_bucket([(512, 640), (1024, 1280)], 1024, 1280)
+    (1024, 1280)
+    >>> closest_bucket([(512, 640), (1024, 1280)], 1200, 1600)
+    (1024, 1280)
+    >>> closest_bucket([(512, 640), (1024, 1280)], 480, 640)
+    Traceback (most recent call last):
+    ...
+    ValueError: no bucket of [(512, 640), (1024, 1280)] fits in a 480x640 image
+    """
+    def _cost(bucket):
+        scale = max(bucket[0] / height, bucket[1] / width)
+        cropped = 1 - bucket[0] * bucket[1] / (scale ** 2 * height * width)
+        return round(cropped, 3), abs(math.log(scale))
+
+    fitting = [bucket for bucket in buckets if bucket[0] <= height and bucket[1] <= width]
+    if not fitting:
+        raise ValueError('no bucket of {} fits in a {}x{} image'.format(buckets, height, width))
+    return min(fitting, key=_cost)
+
+
+# rows and cols of fx, fy, cx, cy in the intrinsic matrix
+INTRINSIC_ROWS = [0, 1, 0, 1]
+INTRINSIC_COLS = [0, 1, 2, 2]
+
+
+def crop_window(h, w, max_h, max_w, base_image_size=8):
+    """ center crop window of crop_mvs_input, as (start_h, start_w, new_h, new_w) """
+    new_h = max_h if h > max_h else int(math.ceil(h / base_image_size) * base_image_size)
+    new_w = max_w if w > max_w else int(math.ceil(w / base_image_size) * base_image_size)
+    return int(math.ceil((h - new_h) / 2)), int(math.ceil((w - new_w) / 2)), new_h, new_w
+
+
+def preprocess_mvs_input(images, cams, max_h, max_w, base_image_size=8, cam_scale=0.25, out=None):
+    """
+    scale_mvs_input, crop_mvs_input and scale_camera(cam, cam_scale) for all views at once.
+    Images are scaled by the smallest scale that still covers (max_h, max_w), the crop window is computed once
+    and each view is resized into one scratch image and copied into its crop of the output.
+    :param images: view_num images of the same shape (h, w, 3)
+    :param cams: (view_num, 2, 4, 4), updated in place
+    :param out: optional buffer of shape (view_num, new_h, new_w, 3) and dtype of images
+    :return: images of shape (view_num, new_h, new_w, 3), cams
+    """
+    h, w, _ = images[0].shape
+    assert all(image.shape == images[0].shape for image in images), 'views ought to have the same shape'
+    height_scale = float(max_h) / h
+    width_scale = float(max_w) / w
+    assert height_scale <= 1 and width_scale <= 1, 'max_h, max_w shall not be more than h, w'
+    # 选取较大的scale的好处是，宁愿 crop 也不要 padding
+    resize_scale = max(height_scale, width_scale)
+
+    scratch = None
+    for view, image in enumerate(images):
+        scratch = cv2.resize(image, None, dst=scratch, fx=resize_scale, fy=resize_scale,
+                             interpolation=cv2.INTER_LINEAR)
+        if view == 0:
+            start_h, start_w, new_h, new_w = crop_window(scratch.shape[0], scratch.shape[1], max_h, max_w,
+                                                         base_image_size)
+            # the window is clipped by the image if h or w is not a multiple of base_image_size
+            crop_h = len(range(scratch.shape[0])[start_h:start_h + new_h])
+            crop_w = len(range(scratch.shape[1])[start_w:start_w + new_w])
+            if out is None:
+                out = np.empty((len(images), crop_h, crop_w, 3), dtype=image.dtype)
+            assert out.shape == (len(images), crop_h, crop_w, 3), out.shape
+        np.copyto(out[view], scratch[start_h:start_h + new_h, start_w:start_w + new_w])
+
+    intrinsics = cams[:, 1, INTRINSIC_ROWS, INTRINSIC_COLS]
+    intrinsics *= resize_scale
+    # crop 的时候内参要变(图片中心变了)
+    intrinsics[:, 2] -= start_w
+    intrinsics[:, 3] -= start_h
+    intrinsics *= cam_scale
+    cams[:, 1, INTRINSIC_ROWS, INTRINSIC_COLS] = intrinsics
+    return out, cams
+
+
+def prefetch_map(func, iterable, nr_thread, prefetch):
+    """
+    yields func(x) for x in iterable, in order, computed by a pool of nr_thread threads
+    at most `prefetch` results are pending or waiting for the consumer, the rest of iterable is not touched yet
+    """
+    assert prefetch >= 1, prefetch
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=nr_thread) as executor:
+        for x in iterable:
+            if len(pending) == prefetch:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, x))
+        while pending:
+            yield pending.popleft().result()
+
+
+def locality_permutation(rng, group_ids):
+    """
+    permutation that shuffles the order of the groups and the samples inside every group, but keeps each group
+    contiguous, so that the images a group shares are still cached while it is visited
+    :param group_ids: shape: (n,), group of every sample
+    """
+    _, group_ids = np.unique(group_ids, return_inverse=True)
+    group_rank = rng.permutation(group_ids.max() + 1)[group_ids]
+    return np.lexsort((rng.rand(len(group_ids)), group_rank))
+
+
 def scale_mvs_camera(cams, scale=1.):
     """ resize input in order to produce sampled depth map """
     view_num = len(cams)
@@ -142,89 +295,206 @@ class DTU(RNGDataFlow):
     """
     produces [imgs, cams, depth_image]
     imgs is of shape (view_num, h, w, 3)
-    cams is of shape (view_num, ) where the element is of type 'Cam'
+    cams is of shape (view_num, 2, 4, 4)
     depth_image is of shape (h, w, 1)
+
+    samples are rows of `self.index` (see gen_dtu_index) and can be loaded by id with `ds[i]`.
+    The order of an epoch only depends on seed and epoch, `shard` splits it between processes or machines
+    without overlap, and `set_epoch` resumes in the middle of an epoch.
     """
 
     test = False
 
-    def __init__(self, dtu_data_root, view_num, train_or_val, interval_scale, max_d, shuffle=None):
+    def __init__(self, dtu_data_root, view_num, train_or_val, interval_scale, max_d, shuffle=None, cache_bytes=0,
+                 seed=0, manifest=None, with_homographies=False):
+        """
+        :param cache_bytes: budget of the decoded image cache, 0 disables it. Every image is the ref view of one
+        sample and a src view of several others with the same lighting, with the cache on, shuffling keeps the
+        samples of one scan and lighting together so that those reuses hit the cache
+        :param seed: seed of the epoch permutations
+        :param manifest: optional dtu Manifest of dtu_data_root (see manifest_utils.py), samples with a missing or
+        empty file are excluded
+        :param with_homographies: insert the (view_num - 1, max_d, 3, 3) homographies of the sample after the cams,
+        for MVSNet(homography_input=True)
+        """
 
         assert train_or_val in ['train', 'val'], 'train or val but '.format(train_or_val)
         assert isinstance(view_num, int), 'view_num ought to be of type int'
         assert isinstance(interval_scale, (int, float)), 'interval_scale ought to be a number'
 
+        self.dtu_data_root = dtu_data_root
+        self._init_index(os.path.join(dtu_data_root, 'Cameras/pair.txt'), view_num, train_or_val, interval_scale,
+                         max_d, shuffle, seed, with_homographies)
+        if manifest is not None:
+            self._exclude_bad_samples(manifest)
+        # parsed here, before any worker is forked
+        self.cam_table = CamTable.get(os.path.join(dtu_data_root, 'Cameras/train'), max_d, interval_scale)
+        self.image_cache = LRUCache(cache_bytes) if cache_bytes > 0 else None
+
+    def _init_index(self, cluster_file_path, view_num, train_or_val, interval_scale, max_d, shuffle, seed,
+                    with_homographies):
         self.max_d = max_d
         self.interval_scale = interval_scale
         self.is_train = (train_or_val == 'train')
         self.train_or_val = train_or_val
-        self.dtu_data_root = dtu_data_root
         if shuffle is None:
             shuffle = (train_or_val == 'train')
         self.shuffle = shuffle
         self.view_num = view_num
-        self.sample_list, self.len_data = gen_dtu_resized_path(dtu_data_root, view_num, train_or_val)
+        self.index = gen_dtu_index(cluster_file_path, view_num, train_or_val)
+        self.seed = seed
+        self.with_homographies = with_homographies
+        self.epoch = 0
+        self.start = 0
+        self.rank = 0
+        self.world_size = 1
         self.count = 0
 
+    def _exclude_bad_samples(self, manifest):
+        assert manifest.kind == 'dtu', manifest.kind
+        keep = np.ones(len(self.index), dtype=bool)
+        for i, (scan, light, *views) in enumerate(self.index):
+            paths = [DTU_DEPTH_FILE % (scan, views[0])]
+            for view in views:
+                paths.append(DTU_IMAGE_FILE % (scan, view + 1, light))
+                paths.append(DTU_CAM_FILE % view)
+            keep[i] = all(manifest.ok(path) for path in paths)
+        if not keep.all():
+            logger.warn('excluded {} of {} {} samples with bad files'.format(np.sum(~keep), len(keep),
+                                                                          self.train_or_val))
+        self.index = self.index[keep]
+
     def __len__(self):
-        # // fixed : check if it is true
-        return self.len_data
-        # if self.is_train:
-        #     return 27097
-        # else:
-        #     return 882
+        # samples of this shard per epoch
+        return len(np.array_split(np.arange(len(self.index)), self.world_size)[self.rank])
 
-    def __iter__(self):
+    def __getitem__(self, sample_id):
+        """ datapoint of row sample_id of the index, regardless of the shard """
+        dp = self._load(self.index[sample_id])
+        if self.with_homographies:
+            dp.insert(2, get_view_homographies_np(dp[1], self.max_d))
+        return dp
+
+    def shard(self, rank, world_size):
+        """
+        a view of this dataset that only iterates its rank-th of world_size contiguous parts of every epoch,
+        the parts of all ranks cover the epoch exactly once
+        """
+        assert 0 <= rank < world_size, (rank, world_size)
+        ds = copy.copy(self)
+        ds.rank = rank
+        ds.world_size = world_size
+        return ds
+
+    def set_epoch(self, epoch, start=0):
+        """ the next iteration yields epoch `epoch` of this shard, skipping its first `start` samples """
+        self.epoch = epoch
+        self.start = start
+
+    def epoch_order(self, epoch):
+        """ sample ids this shard yields in epoch `epoch` """
         if self.shuffle:
-            self.rng.shuffle(self.sample_list)
-        for data in self.sample_list:
-            imgs = []
-            cams = []
-            for view in range(self.view_num):
-                # read_image
-                # // [fixedTODO]: center image is left to augmentor or tf Graph
-                # // I have done it here
-                img = cv2.imread(data[2 * view])
-                # img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                # load cam and do basic interval_scale
-                cam = Cam(data[2 * view + 1], max_d=self.max_d)
-                cam.depth_interval = cam.depth_interval * self.interval_scale
-                imgs.append(img)
-                cams.append(cam.get_mat_form())
-            # load depth image of ref view
-            depth_image = PFMReader(data[2 * self.view_num]).data
-            # depth_image = np.zeros((10, 10))
-
-            # mask invalid depth_image
-            ref_cam = cams[0]
-            depth_min, depth_interval = Cam.get_depth_meta(ref_cam, 'depth_min', 'depth_interval')
-            depth_start = depth_min + depth_interval
-            depth_end = depth_min + (self.max_d - 2) * depth_interval
-            # depth_image's shape: (h, w, 1)
-            depth_image = mask_depth_image(depth_image, depth_start, depth_end)
-            # view_num, h, w, 3
-            imgs = np.array(imgs)
-            # (view_num, )
-            cams = np.array(cams)
-            if self.test and self.count % 10 == 0:
-                print('Forward pass: d_min = %f, d_max = %f.' %
-                      (depth_min, depth_min + (self.max_d - 1) * depth_interval))
-            assert cams.shape == (self.view_num, 2, 4, 4)
-            self.count += 1
-            yield [imgs, cams, depth_image]
+            rng = np.random.RandomState([self.seed, epoch])
+            if self.image_cache is not None:
+                # (scan, lighting)
+                order = locality_permutation(rng, self.index[:, 0] * 10 + self.index[:, 1])
+            else:
+                order = rng.permutation(len(self.index))
+        else:
+            order = np.arange(len(self.index))
+        return np.array_split(order, self.world_size)[self.rank]
+
+    def get_stats(self):
+        if self.image_cache is None:
+            return {}
+        return {'image_cache_hit_rate': self.image_cache.hit_rate()}
+
+    def _read_image(self, image_path):
+        if self.image_cache is None:
+            return read_image(image_path)
+        # cached images are shared between samples, np.array(imgs) below copies them
+        return self.image_cache.get(image_path, read_image)
+
+    def __iter__(self):
+        order = self.epoch_order(self.epoch)
+        for sample_id in order[self.start:]:
+            yield self[sample_id]
+        self.epoch += 1
+        self.start = 0
+
+    def _load(self, sample):
+        scan, light, *views = sample
+        image_folder = os.path.join(self.dtu_data_root, ('Rectified/scan%d_train' % scan))
+        depth_folder = os.path.join(self.dtu_data_root, ('Depths/scan%d_train' % scan))
+        imgs = []
+        for view in views:
+            # read_image
+            # // [fixedTODO]: center image is left to augmentor or tf Graph
+            # // I have done it here
+            img = self._read_image(os.path.join(image_folder, ('rect_%03d_%d_r5000.png' % ((view + 1), light))))
+            # img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            imgs.append(img)
+        # cams come with interval_scale applied, fancy indexing copies them out of the table
+        cams = self.cam_table[views]
+        # load depth image of ref view
+        depth_image = load_pfm(os.path.join(depth_folder, ('depth_map_%04d.pfm' % views[0])))
+        # depth_image = np.zeros((10, 10))
+
+        # mask invalid depth_image
+        ref_cam = cams[0]
+        depth_min, depth_interval = Cam.get_depth_meta(ref_cam, 'depth_min', 'depth_interval')
+        depth_start = depth_min + depth_interval
+        depth_end = depth_min + (self.max_d - 2) * depth_interval
+        # depth_image's shape: (h, w, 1)
+        depth_image = clip_mask_depth(depth_image, depth_start, depth_end)
+        # view_num, h, w, 3
+        imgs = np.array(imgs)
+        if self.test and self.count % 10 == 0:
+            print('Forward pass: d_min = %f, d_max = %f.' %
+                  (depth_min, depth_min + (self.max_d - 1) * depth_interval))
+        assert cams.shape == (self.view_num, 2, 4, 4)
+        self.count += 1
+        return [imgs, cams, depth_image]
 
     @staticmethod
-    def make_test_dataset(base_dir, view_num, max_h, max_w, max_d, interval_scale):
-        data_dirs = os.listdir(base_dir)
-        data_dirs = sorted(data_dirs, key=int)
-        data_dirs = [os.path.join(base_dir, data_dir) for data_dir in data_dirs]
-        for data_dir in data_dirs:
-            dps = list(DTU.make_test_data(data_dir, view_num, max_h, max_w, max_d, interval_scale))
-            for dp in dps:
-                yield dp
+    def make_test_dataset(base_dir, view_num, max_h, max_w, max_d, interval_scale, nr_thread=4, prefetch=8,
+                          manifest=None, with_homographies=False, with_meta=False, target_interval=None,
+                          buckets=None):
+        """
+        streams the samples of all scenes in base_dir, in order
+        :param nr_thread: num of threads that read, scale and crop samples
+        :param prefetch: max num of samples loaded ahead of the consumer, bounds the memory whatever the scene size
+        :param manifest: optional test Manifest of base_dir (see manifest_utils.py), the scenes are taken from it
+        and samples with a missing or empty file are skipped
+        :param with_homographies: yield (imgs, cams, homographies), see load_test_sample
+        :param with_meta: yield (meta, dp), meta is a dict of the scene dir name 'scene', the index of the sample in
+        the scene 'sample' and the image file names of its views 'views', the ref view first
+        :param target_interval: sweep each sample with the num of planes that covers its depth range at this
+        interval instead of max_d, see load_test_sample
+        :param buckets: (max_h, max_w) of the resolutions to scale and crop the samples to, see load_test_sample
+        """
+        if manifest is None:
+            data_dirs = os.listdir(base_dir)
+            data_dirs = sorted(data_dirs, key=int)
+        else:
+            assert manifest.kind == 'test', manifest.kind
+            data_dirs = manifest.test_scenes()
+
+        def _jobs():
+            for data_dir in data_dirs:
+                sample_list = DTU._gen_test_sample_list(os.path.join(base_dir, data_dir), view_num, manifest)
+                for sample, data in enumerate(sample_list):
+                    meta = {'scene': data_dir, 'sample': sample,
+                            'views': [os.path.basename(path) for path in data[0::2]]}
+                    yield meta, (data, view_num, max_h, max_w, max_d, interval_scale, with_homographies,
+                                 target_interval, buckets)
+
+        for meta, dp in prefetch_map(lambda job: (job[0], DTU.load_test_sample(*job[1])), _jobs(), nr_thread,
+                                     prefetch):
+            yield (meta, dp) if with_meta else dp
 
     @staticmethod
-    def make_test_data(data_dir, view_num, max_h, max_w, max_d, interval_scale):
+    def make_test_data(data_dir, view_num, max_h, max_w, max_d, interval_scale, with_homographies=False):
         """
         the data_dir should be organized like:
         * images
@@ -233,157 +503,164 @@ class DTU(RNGDataFlow):
         :param data_dir:
         :return:
         """
-        dir_files = os.listdir(data_dir)
-        assert 'images' in dir_files and 'cams' in dir_files and 'pair.txt' in dir_files
+        for data in DTU._gen_test_sample_list(data_dir, view_num):
+            yield DTU.load_test_sample(data, view_num, max_h, max_w, max_d, interval_scale, with_homographies)
+
+    @staticmethod
+    def _gen_test_sample_list(data_dir, view_num, manifest=None):
+        if manifest is None:
+            dir_files = os.listdir(data_dir)
+            assert 'images' in dir_files and 'cams' in dir_files and 'pair.txt' in dir_files
+        else:
+            # manifest paths are relative to the test root, which may have been given in another form
+            base_dir = os.path.dirname(os.path.normpath(data_dir))
+            if not manifest.ok(os.path.relpath(os.path.join(data_dir, 'pair.txt'), base_dir)):
+                logger.warn('skipped scene {} without pair.txt'.format(data_dir))
+                return []
         sample_list = gen_test_input_sample_list(data_dir, view_num)
+        if manifest is not None:
+            good_list = [paths for paths in sample_list
+                         if all(manifest.ok(os.path.relpath(path, base_dir)) for path in paths)]
+            if len(good_list) < len(sample_list):
+                logger.warn('skipped {} of {} samples of {} with bad files'.format(
+                    len(sample_list) - len(good_list), len(sample_list), data_dir))
+            sample_list = good_list
         logger.info('sample_list: %s' % sample_list)
+        return sample_list
 
-        for data in sample_list:
-            imgs = []
-            cams = []
-
-            for view in range(view_num):
-                # read_image
-                # // [fixedTODO]: center image is left to augmentor or tf Graph
-                # // I have done it here
-                img = cv2.imread(data[2 * view])
-                # print(img.shape)
-
-                # img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                # load cam and do basic interval_scale
-                cam = Cam(data[2 * view + 1], max_d=max_d, interval_scale=interval_scale)
-                imgs.append(img)
-                cams.append(cam.get_mat_form())
-
-            logger.info('range: {} {} {} {}'.format(cams[0][1, 3, 0], cams[0][1, 3, 1], cams[0][1, 3, 2], cams[0][1, 3, 3]))
-
-            general_h_scale = -1.
-            general_w_scale = -1.
-            # 选取较大的scale的好处是，宁愿 crop 也不要 padding
-            for view in range(view_num):
-                # print(imgs[view].shape)
-                h, w, _ = imgs[view].shape
-                height_scale = float(max_h) / h
-                width_scale = float(max_w) / w
-                general_h_scale = height_scale if height_scale > general_h_scale else general_h_scale
-                general_w_scale = width_scale if width_scale > general_w_scale else general_w_scale
-                assert height_scale < 1 and width_scale < 1, 'max_h, max_w shall be less than h, w'
-            resize_scale = general_h_scale if general_h_scale > general_w_scale else general_w_scale
-            logger.info('resize scale is %.2f' % resize_scale)
-
-            # first scale
-            imgs, cams = scale_mvs_input(imgs, cams, scale=resize_scale)
-
-            # then crop to fit the nn input
-            imgs, cams = crop_mvs_input(imgs, cams, max_h, max_w, base_image_size=8)
-
-            # then scale the cam and img, because the final resolution is not full-res
-            cams = [scale_camera(cam, 0.25) for cam in cams]
-            # imgs, cams = scale_mvs_input(imgs, cams, scale=0.25)
-
-            ref_cam = cams[0]
-            depth_min, depth_interval, depth_max = Cam.get_depth_meta(ref_cam, 'depth_min', 'depth_interval', 'depth_max')
-            # view_num, h, w, 3
-            imgs = np.array(imgs)
-            # (view_num, )
-            cams = np.array(cams)
-            logger.info('d_min = %f, interval: %f, d_max = %f.' %
-                      (depth_min, depth_interval, depth_max))
-
-            assert cams.shape == (view_num, 2, 4, 4)
-            yield imgs, cams
-
+    @staticmethod
+    def load_test_sample(data, view_num, max_h, max_w, max_d, interval_scale, with_homographies=False,
+                         target_interval=None, buckets=None):
+        """
+        read, scale and crop one test sample, data is an entry of gen_test_input_sample_list
+        :param with_homographies: also return the (view_num - 1, depth_num, 3, 3) homographies of the scaled cams,
+        memoized so that the views shared by the samples of a scene are computed once
+        :param target_interval: depth interval of the sample, its depth num is then the smallest multiple of
+        DEPTH_BUCKET planes that covers the depth_min, depth_max of the ref cam (see adapt_depth_num), up to max_d.
+        The depth num of the sample is the one of the ref cam, max_d otherwise
+        :param buckets: list of (max_h, max_w), the sample is scaled and cropped to the closest_bucket of its ref
+        image instead of (max_h, max_w), a ValueError is raised if the image is smaller than every bucket
+        """
+        imgs = []
+        cams = []
+
+        for view in range(view_num):
+            # read_image
+            # // [fixedTODO]: center image is left to augmentor or tf Graph
+            # // I have done it here
+            img = cv2.imread(data[2 * view])
+            # print(img.shape)
+
+            # img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            # load cam and do basic interval_scale, np.array below copies it out of the shared table
+            imgs.append(img)
+            cams.append(CamTable.lookup(data[2 * view + 1], max_d, interval_scale))
+
+        logger.info('range: {} {} {} {}'.format(cams[0][1, 3, 0], cams[0][1, 3, 1], cams[0][1, 3, 2], cams[0][1, 3, 3]))
+
+        if buckets:
+            max_h, max_w = closest_bucket(buckets, *imgs[0].shape[:2])
+
+        # scale to cover (max_h, max_w), crop to fit the nn input, then scale the cam to the resolution of the
+        # depth map, the images stay full-res
+        imgs, cams = preprocess_mvs_input(imgs, np.array(cams), max_h, max_w, base_image_size=8, cam_scale=0.25)
+        depth_num = max_d
+        if target_interval:
+            cams = adapt_depth_num(cams, target_interval, max_d)
+            depth_num = int(cams[0, 1, 3, 2])
+
+        ref_cam = cams[0]
+        depth_min, depth_interval, depth_max = Cam.get_depth_meta(ref_cam, 'depth_min', 'depth_interval', 'depth_max')
+        logger.info('d_min = %f, interval: %f, d_max = %f.' %
+                  (depth_min, depth_interval, depth_max))
+
+        assert cams.shape == (view_num, 2, 4, 4)
+        if with_homographies:
+            return imgs, cams, get_view_homographies_np(cams, depth_num)
+        return imgs, cams
+
+
+class DTUShard(DTU):
+    """
+    same datapoints as DTU, but read from the packed shards written by shard_utils.py
+    no png decoding, cam parsing or pfm reading happens when loading a sample
+    """
 
-def gen_dtu_resized_path(dtu_data_folder, view_num, mode='train'):
-    """ generate data paths for dtu dataset """
+    def __init__(self, shard_root, view_num, train_or_val, interval_scale, max_d, shuffle=None, seed=0,
+                 with_homographies=False):
+        assert train_or_val in ['train', 'val'], 'train or val but {}'.format(train_or_val)
+        assert isinstance(view_num, int), 'view_num ought to be of type int'
 
+        self.shard_root = shard_root
+        self._init_index(os.path.join(shard_root, 'pair.txt'), view_num, train_or_val, interval_scale, max_d,
+                         shuffle, seed, with_homographies)
+        self.image_cache = None
+        self._shards = {}
+
+    def _get_shard(self, scan):
+        # opened lazily, so that each forked worker maps the shards it actually reads
+        if scan not in self._shards:
+            shard = DTUShardReader(self.shard_root, scan)
+            assert shard.max_d == self.max_d and shard.interval_scale == self.interval_scale, \
+                'scan{} is packed with max_d={}, interval_scale={}, repack it'.format(scan, shard.max_d,
+                                                                                    shard.interval_scale)
+            self._shards[scan] = shard
+        return self._shards[scan]
+
+    def _load(self, sample):
+        scan, light, *views = sample
+        shard = self._get_shard(scan)
+        # fancy indexing copies the views out of the mapping: view_num, h, w, 3
+        imgs = np.asarray(shard.images[light, views])
+        cams = np.asarray(shard.cams[views])
+        depth_image = np.array(shard.depths[views[0]])
+        self.count += 1
+        return [imgs, cams, depth_image]
+
+
+def gen_dtu_index(cluster_file_path, view_num, mode='train'):
+    """
+    generate the samples of dtu dataset as a compact index of ids instead of paths
+    :return: int16 array of shape (n, 2 + view_num), a row is
+    (scan, lighting, ref_index, view_index_1, ..., view_index_{view_num-1})
+    """
     assert mode in ['train', 'val'], 'undefined mode: {}'.format(mode)
     assert isinstance(view_num, int), 'view_num ought to be of type int'
-    sample_list = []
-
-    # parse camera pairs
-    cluster_file_path = os.path.join(dtu_data_folder, 'Cameras/pair.txt')
 
     with open(cluster_file_path, mode='r') as cluster_file:
         cluster_list = cluster_file.read().split()
-    # cluster_list = file_io.FileIO(cluster_file_path, mode='r').read().split()
+    # pair.txt: num of ref views, then for each of them: ref index, num of src views (10), 10 x (src index, score)
+    cam_num = int(cluster_list[0])
+    pairs = np.array(cluster_list[1:], dtype=np.float64).reshape(cam_num, 22)
+    # ref index and the first view_num - 1 src views
+    views = pairs[:, [0] + [2 * view + 2 for view in range(view_num - 1)]].astype(np.int16)
 
-    # 3 sets
-    training_set = [2, 6, 7, 8, 14, 16, 18, 19, 20, 22, 30, 31, 36, 39, 41, 42, 44,
-                    45, 46, 47, 50, 51, 52, 53, 55, 57, 58, 60, 61, 63, 64, 65, 68, 69, 70, 71, 72,
-                    74, 76, 83, 84, 85, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100,
-                    101, 102, 103, 104, 105, 107, 108, 109, 111, 112, 113, 115, 116, 119, 120,
-                    121, 122, 123, 124, 125, 126, 127, 128]
-    training_set = training_set[:]
-    validation_set = [3, 5, 17, 21, 28, 35, 37, 38, 40, 43, 56, 59, 66, 67, 82, 86, 106, 117]
-    validation_set = validation_set[:]
-    logger.warn('num of scans in training_set: {}'.format(len(training_set)))
-    logger.warn('num of scans in val_set: {}'.format(len(validation_set)))
-
-    data_set = []
-    if mode == 'train':
-        data_set = training_set
-    elif mode == 'val':
-        data_set = validation_set
+    data_set = DTU_TRAINING_SET if mode == 'train' else DTU_VALIDATION_SET
+    lightings = range(0, 7) if mode == 'train' else [3]
+    logger.warn('num of scans in {} set: {}'.format(mode, len(data_set)))
+    # for each dataset, for each lighting, for each reference image
+    scan_light = np.array([(i, j) for i in data_set for j in lightings], dtype=np.int16)
+    index = np.concatenate([np.repeat(scan_light, cam_num, axis=0), np.tile(views, (len(scan_light), 1))], axis=1)
+    return index
 
-    # for each dataset
-    for i in data_set:
-
-        image_folder = os.path.join(dtu_data_folder, ('Rectified/scan%d_train' % i))
-        cam_folder = os.path.join(dtu_data_folder, 'Cameras/train')
-        depth_folder = os.path.join(dtu_data_folder, ('Depths/scan%d_train' % i))
-
-        if mode == 'train':
-            # for each lighting
-            for j in range(0, 7):
-                # for each reference image
-                for p in range(0, int(cluster_list[0])):
-                    paths = []
-                    # ref image' index
-                    ref_index = int(cluster_list[22 * p + 1])
-                    ref_image_path = os.path.join(
-                        image_folder, ('rect_%03d_%d_r5000.png' % ((ref_index + 1), j)))
-                    ref_cam_path = os.path.join(cam_folder, ('%08d_cam.txt' % ref_index))
-                    paths.append(ref_image_path)
-                    paths.append(ref_cam_path)
-                    # view images
-                    for view in range(view_num - 1):
-                        view_index = int(cluster_list[22 * p + 2 * view + 3])
-                        view_image_path = os.path.join(
-                            image_folder, ('rect_%03d_%d_r5000.png' % ((view_index + 1), j)))
-                        view_cam_path = os.path.join(cam_folder, ('%08d_cam.txt' % view_index))
-                        paths.append(view_image_path)
-                        paths.append(view_cam_path)
-                    # depth path
-                    depth_image_path = os.path.join(depth_folder, ('depth_map_%04d.pfm' % ref_index))
-                    paths.append(depth_image_path)
-                    sample_list.append(paths)
-        elif mode == 'val':
-            j = 3
-            # for each reference image
-            for p in range(0, int(cluster_list[0])):
-                paths = []
-                # ref image
-                ref_index = int(cluster_list[22 * p + 1])
-                ref_image_path = os.path.join(
-                    image_folder, ('rect_%03d_%d_r5000.png' % ((ref_index + 1), j)))
-                ref_cam_path = os.path.join(cam_folder, ('%08d_cam.txt' % ref_index))
-                paths.append(ref_image_path)
-                paths.append(ref_cam_path)
-                # view images
-                for view in range(view_num - 1):
-                    view_index = int(cluster_list[22 * p + 2 * view + 3])
-                    view_image_path = os.path.join(
-                        image_folder, ('rect_%03d_%d_r5000.png' % ((view_index + 1), j)))
-                    view_cam_path = os.path.join(cam_folder, ('%08d_cam.txt' % view_index))
-                    paths.append(view_image_path)
-                    paths.append(view_cam_path)
-                # depth path
-                depth_image_path = os.path.join(depth_folder, ('depth_map_%04d.pfm' % ref_index))
-                paths.append(depth_image_path)
-                sample_list.append(paths)
-
-    return sample_list, len(data_set) * 343
+
+def gen_dtu_resized_path(dtu_data_folder, view_num, mode='train'):
+    """ generate data paths for dtu dataset """
+    index = gen_dtu_index(os.path.join(dtu_data_folder, 'Cameras/pair.txt'), view_num, mode)
+    cam_folder = os.path.join(dtu_data_folder, 'Cameras/train')
+    sample_list = []
+    for scan, light, *views in index:
+        image_folder = os.path.join(dtu_data_folder, ('Rectified/scan%d_train' % scan))
+        depth_folder = os.path.join(dtu_data_folder, ('Depths/scan%d_train' % scan))
+        paths = []
+        for view in views:
+            paths.append(os.path.join(image_folder, ('rect_%03d_%d_r5000.png' % ((view + 1), light))))
+            paths.append(os.path.join(cam_folder, ('%08d_cam.txt' % view)))
+        # depth path
+        paths.append(os.path.join(depth_folder, ('depth_map_%04d.pfm' % views[0])))
+        sample_list.append(paths)
+
+    return sample_list, len(sample_list)
 
 
 from matplotlib import pyplot as plt
@@ -438,5 +715,4 @@ if __name__ == "__main__":
     # ds = BatchData(ds, 2)
     # ds = PrintData(ds)
 
-    # 160it/s
-    # TestDataSpeed(ds).start()
+    # per-stage throughput: util scripts/bench_dataflow.py
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# File: export_utils.py
+
+"""
+Frozen inference graphs.
+
+export_frozen_graph builds the model for inference only, restores its variables and writes a single GraphDef in
+which the variables are constants and only the ops between the inputs and the outputs are left: no summaries, no
+loss, no gt_depth. The constants and the batch norms are folded when the graph transform tool of tensorflow is
+available. FrozenPredictor (predict_utils.py) runs such a graph after a single import, without building the model
+or restoring a checkpoint.
+"""
+
+import tensorflow as tf
+from tensorpack import TowerContext
+from tensorpack.utils import logger
+
+__all__ = ['FROZEN_OUTPUT_NAMES', 'export_frozen_graph', 'load_frozen_graph']
+
+# outputs of the frozen graphs
+FROZEN_OUTPUT_NAMES = ['prob_map', 'coarse_depth', 'refine_depth']
+
+FROZEN_GRAPH_TRANSFORMS = ['fold_constants(ignore_errors=true)', 'fold_batch_norms', 'fold_old_batch_norms',
+                           'sort_by_execution_order']
+
+
+def export_frozen_graph(model, sess_init, output_path, output_names=FROZEN_OUTPUT_NAMES):
+    """
+    :param model: MVSNet, the inputs of the frozen graph are its get_predict_input_names
+    :param sess_init: SessionInit of the variables, e.g. get_model_loader(checkpoint)
+    :param output_path: GraphDef file to write
+    :param output_names: names of the output tensors
+    :return: the frozen GraphDef
+    """
+    input_names = model.get_predict_input_names()
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs = model.inputs()
+        with TowerContext('', is_training=False):
+            model.build_graph(*inputs)
+        node_num = len(graph.as_graph_def().node)
+        with tf.Session(graph=graph) as sess:
+            sess_init.init(sess)
+            # only the ancestors of the outputs are kept, the graph is built for inference so there are no
+            # training nodes left to remove. remove_training_nodes would also strip the Identity nodes the
+            # tf.while_loop frames rely on
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), output_names)
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        logger.warn('tensorflow has no graph transform tool, the constants are not folded')
+    else:
+        graph_def = TransformGraph(graph_def, input_names, output_names, FROZEN_GRAPH_TRANSFORMS)
+    with tf.gfile.GFile(output_path, 'wb') as out_file:
+        out_file.write(graph_def.SerializeToString())
+    logger.info('frozen graph of {} -> {} written to {}, {} of {} nodes'.format(
+        input_names, output_names, output_path, len(graph_def.node), node_num))
+    return graph_def
+
+
+def load_frozen_graph(graph_path):
+    """ a new graph with the GraphDef of export_frozen_graph imported, under the names of the model """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(graph_path, 'rb') as graph_file:
+        graph_def.ParseFromString(graph_file.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    return graph
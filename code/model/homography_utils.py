@@ -1,38 +1,93 @@
+import threading
+import numpy as np
 import tensorflow as tf
+from DataManager import LRUCache
+
+# homographies of (ref cam, src cam, depth_start, depth_interval, depth_num), shared by the samples of a process
+HOMOGRAPHY_CACHE_BYTES = 64 * 1024 ** 2
+_homography_cache = LRUCache(HOMOGRAPHY_CACHE_BYTES)
+_homography_cache_lock = threading.Lock()
+
+
+def get_depth_values(depth_start, depth_interval, depth_num):
+    """
+    depth of every plane of every sample
+    :param depth_start: shape: b
+    :param depth_interval: shape: b
+    :return: shape: b, depth_num
+    """
+    depth_index = tf.cast(tf.range(depth_num), tf.float32)
+    return tf.reshape(depth_start, [-1, 1]) + tf.reshape(depth_interval, [-1, 1]) * depth_index
 
 
 def get_propability_map(cv, depth_map, depth_start, depth_interval):
     """ get probability map from cost volume
+    sum of the probabilities of the 2 planes below (floor - 1, floor) and the 2 planes above (ceil, ceil + 1)
+    the depth of each pixel, clipped to the volume. The 4 planes of all pixels are read by a single gather
+    from the flattened volume, so only b * 4 * h * w values are materialized
     :param cv: shape: b, d, h, w
-    :param depth_map: shape: b, 1, h, w
+    :param depth_map: shape: b, h, w, 1
+    :param depth_start: shape: b, or b, h, w, 1 for per pixel depth hypotheses (see build_cost_volume_hypotheses)
+    :return prob_map: shape: b, h, w, 1
+    """
+    shape = tf.shape(cv)
+    batch_size = shape[0]
+    depth = shape[1]
+    height = shape[2]
+    width = shape[3]
+
+    # d coordinate (floored and ceiled), shape: b, 1, h, w
+    if depth_start.get_shape().ndims == 1:
+        depth_start = tf.reshape(depth_start, [-1, 1, 1, 1])
+    depth_interval = tf.reshape(depth_interval, [-1, 1, 1, 1])
+    d_coordinates = tf.transpose((depth_map - depth_start) / depth_interval, [0, 3, 1, 2])
+    d_coordinates_left0 = tf.clip_by_value(tf.cast(tf.floor(d_coordinates), 'int32'), 0, depth - 1)
+    d_coordinates_left1 = tf.clip_by_value(d_coordinates_left0 - 1, 0, depth - 1)
+    d_coordinates_right0 = tf.clip_by_value(tf.cast(tf.ceil(d_coordinates), 'int32'), 0, depth - 1)
+    d_coordinates_right1 = tf.clip_by_value(d_coordinates_right0 + 1, 0, depth - 1)
+    # shape: b, 4, h, w
+    d_coordinates = tf.concat([d_coordinates_left0, d_coordinates_left1, d_coordinates_right0,
+                               d_coordinates_right1], axis=1)
+
+    # index in the flattened volume
+    b_coordinates = tf.reshape(tf.range(batch_size), [-1, 1, 1, 1])
+    y_coordinates = tf.reshape(tf.range(height), [1, 1, -1, 1])
+    x_coordinates = tf.reshape(tf.range(width), [1, 1, 1, -1])
+    voxel_indices = ((b_coordinates * depth + d_coordinates) * height + y_coordinates) * width + x_coordinates
+
+    # shape: b, 4, h, w
+    probs = tf.gather(tf.reshape(cv, [-1]), voxel_indices)
+    # summed in the order of get_propability_map_gather_nd
+    prob_map = probs[:, 0] + probs[:, 1] + probs[:, 2] + probs[:, 3]
+    return tf.expand_dims(prob_map, axis=3)
+
+
+def get_propability_map_gather_nd(cv, depth_map, depth_start, depth_interval):
+    """ get probability map from cost volume
+    the former get_propability_map, with a coordinate grid and four gather_nd, kept as the reference
+    :param cv: shape: b, d, h, w
+    :param depth_map: shape: b, h, w, 1
     :return prob_map: shape: b, h, w, 1
     """
-    # depth_map = tf.transpose(depth_map, [0, 2, 3, 1])
-
-    def _repeat_(x, num_repeats):
-        """ repeat each element num_repeats times """
-        x = tf.reshape(x, [-1])
-        ones = tf.ones((1, num_repeats), dtype='int32')
-        x = tf.reshape(x, shape=(-1, 1))
-        x = tf.matmul(x, ones)
-        return tf.reshape(x, [-1])
-
     shape = tf.shape(depth_map)
     batch_size = shape[0]
     height = shape[1]
     width = shape[2]
     depth = tf.shape(cv)[1]
 
-    # byx coordinate, batched & flattened
+    # byx coordinate, batched & flattened in the order of depth_map
     b_coordinates = tf.range(batch_size)
     y_coordinates = tf.range(height)
     x_coordinates = tf.range(width)
-    b_coordinates, y_coordinates, x_coordinates = tf.meshgrid(b_coordinates, y_coordinates, x_coordinates)
-    b_coordinates = _repeat_(b_coordinates, batch_size)
-    y_coordinates = _repeat_(y_coordinates, batch_size)
-    x_coordinates = _repeat_(x_coordinates, batch_size)
+    b_coordinates, y_coordinates, x_coordinates = tf.meshgrid(b_coordinates, y_coordinates, x_coordinates,
+                                                              indexing='ij')
+    b_coordinates = tf.reshape(b_coordinates, [-1])
+    y_coordinates = tf.reshape(y_coordinates, [-1])
+    x_coordinates = tf.reshape(x_coordinates, [-1])
 
     # d coordinate (floored and ceiled), batched & flattened
+    depth_start = tf.reshape(depth_start, [-1, 1, 1, 1])
+    depth_interval = tf.reshape(depth_interval, [-1, 1, 1, 1])
     d_coordinates = tf.reshape((depth_map - depth_start) / depth_interval, [-1])
     d_coordinates_left0 = tf.clip_by_value(tf.cast(tf.floor(d_coordinates), 'int32'), 0, depth - 1)
     d_coordinates_left1 = tf.clip_by_value(d_coordinates_left0 - 1, 0, depth - 1)
@@ -139,9 +194,10 @@ def get_homographies(left_cam, right_cam, depth_num, depth_start, depth_interval
         # depth
         depth_num = tf.reshape(tf.cast(depth_num, 'int32'), [])
 
-        depth = depth_start + tf.cast(tf.range(depth_num), tf.float32) * depth_interval
+        # shape: b, d
+        depth = get_depth_values(depth_start, depth_interval, depth_num)
         # preparation
-        num_depth = tf.shape(depth)[0]
+        num_depth = tf.shape(depth)[1]
         K_left_inv = tf.matrix_inverse(tf.squeeze(K_left, axis=1))
         R_left_trans = tf.transpose(tf.squeeze(R_left, axis=1), perm=[0, 2, 1])
         R_right_trans = tf.transpose(tf.squeeze(R_right, axis=1), perm=[0, 2, 1])
@@ -170,7 +226,87 @@ def get_homographies(left_cam, right_cam, depth_num, depth_start, depth_interval
     return homographies
 
 
-def build_cost_volume(view_homographies, feature_maps, depth_num):
+def get_homography_terms(left_cam, right_cam):
+    """
+    the homographies of get_homographies split by their dependency on the depth, H(d) = A - B / d, so that they
+    can be applied to per pixel depths
+    :param left_cam: ref cams, shape: b, 2, 4, 4
+    :param right_cam: src cams, shape: b, 2, 4, 4
+    :return: A, B, shape: b, 3, 3
+    """
+    with tf.name_scope('get_homography_terms'):
+        R_left = left_cam[:, 0, :3, :3]
+        R_right = right_cam[:, 0, :3, :3]
+        t_left = left_cam[:, 0, :3, 3:4]
+        t_right = right_cam[:, 0, :3, 3:4]
+        K_left = left_cam[:, 1, :3, :3]
+        K_right = right_cam[:, 1, :3, :3]
+
+        R_left_trans = tf.transpose(R_left, perm=[0, 2, 1])
+        R_right_trans = tf.transpose(R_right, perm=[0, 2, 1])
+        # shape: b, 1, 3
+        fronto_direction = R_left[:, 2:3, :]
+        c_left = -tf.matmul(R_left_trans, t_left)
+        c_right = -tf.matmul(R_right_trans, t_right)
+
+        back_projection = tf.matmul(R_left_trans, tf.matrix_inverse(K_left))
+        projection = tf.matmul(K_right, R_right)
+        A = tf.matmul(projection, back_projection)
+        B = tf.matmul(projection, tf.matmul(tf.matmul(c_right - c_left, fronto_direction), back_projection))
+    return A, B
+
+
+def get_homographies_np(ref_cam, src_cam, depth_num, depth_start, depth_interval):
+    """
+    numpy counterpart of get_homographies for a single pair of cams, computed in float64
+    H(d) = K_src R_src (I - (c_src - c_ref) n / d) R_ref^T K_ref^-1, with n the fronto direction of the ref cam,
+    is split into A - B / d so that all depth planes come from two 3x3 matrices
+    :param ref_cam: shape: 2, 4, 4
+    :param src_cam: shape: 2, 4, 4
+    :return: float32 array of shape (depth_num, 3, 3)
+    """
+    ref_cam = np.asarray(ref_cam, dtype=np.float64)
+    src_cam = np.asarray(src_cam, dtype=np.float64)
+    R_left, t_left, K_left = ref_cam[0, :3, :3], ref_cam[0, :3, 3:4], ref_cam[1, :3, :3]
+    R_right, t_right, K_right = src_cam[0, :3, :3], src_cam[0, :3, 3:4], src_cam[1, :3, :3]
+
+    c_left = -np.matmul(R_left.T, t_left)
+    c_right = -np.matmul(R_right.T, t_right)
+    fronto_direction = R_left[2:3, :]
+    back_projection = np.matmul(R_left.T, np.linalg.inv(K_left))
+    projection = np.matmul(K_right, R_right)
+    A = np.matmul(projection, back_projection)
+    B = np.matmul(projection, np.matmul(np.matmul(c_right - c_left, fronto_direction), back_projection))
+
+    depth = depth_start + np.arange(depth_num, dtype=np.float64) * depth_interval
+    return (A[np.newaxis] - B[np.newaxis] / depth[:, np.newaxis, np.newaxis]).astype(np.float32)
+
+
+def get_view_homographies_np(cams, depth_num):
+    """
+    homographies of all src views of a sample, with the depth range of its ref cam, memoized per process:
+    the cams come from a fixed set (one file per view), so training samples and test scenes keep hitting the cache
+    :param cams: shape: view_num, 2, 4, 4
+    :return: float32 array of shape (view_num - 1, depth_num, 3, 3)
+    """
+    cams = np.asarray(cams, dtype=np.float32)
+    ref_cam = cams[0]
+    depth_start, depth_interval = float(ref_cam[1, 3, 0]), float(ref_cam[1, 3, 1])
+    view_homographies = []
+    for src_cam in cams[1:]:
+        key = (ref_cam.tobytes(), src_cam.tobytes(), depth_start, depth_interval, depth_num)
+        with _homography_cache_lock:
+            homographies = _homography_cache.get(key, lambda _: get_homographies_np(
+                ref_cam, src_cam, depth_num, depth_start, depth_interval))
+        view_homographies.append(homographies)
+    return np.stack(view_homographies, axis=0)
+
+
+def build_cost_volume(view_homographies, feature_maps, depth_num, dtype=tf.float32):
+    """
+    :param dtype: dtype every plane is cast to before the planes are stacked, the cost is computed in float32
+    :return: cost volume, shape: b, depth_num, h, w, c
+    """
     _, view_num, h, w, c = feature_maps.get_shape().as_list()
 
     # shape: b, h, w, c
@@ -190,7 +326,7 @@ def build_cost_volume(view_homographies, feature_maps, depth_num):
                 ave_feature2 = ave_feature2 + tf.square(warped_view_feature)
             ave_feature = ave_feature / view_num
             ave_feature2 = ave_feature2 / view_num
-            cost = ave_feature2 - tf.square(ave_feature)
+            cost = tf.cast(ave_feature2 - tf.square(ave_feature), dtype)
             # shape of cost: b, h, w, c
             # shape of depth_costs: depth_num, b, h, w, c
             depth_costs.append(cost)
@@ -200,6 +336,246 @@ def build_cost_volume(view_homographies, feature_maps, depth_num):
     return cost_volume
 
 
+class CostPlanes(object):
+    """
+    the cost of build_cost_volume one depth plane at a time, for the regularizations that step through the depth
+    planes (gru_depth_loop), so that the whole cost volume is never built
+    calling it with a depth index (int32 scalar tensor) builds the cost of that plane, shape: b, h, w, c
+    """
+
+    def __init__(self, view_homographies, feature_maps, depth_num):
+        """
+        :param view_homographies: view_num - 1 homographies of shape (b, depth_num, 3, 3)
+        :param feature_maps: shape: b, view_num, h, w, c
+        """
+        _, self.view_num, h, w, c = feature_maps.get_shape().as_list()
+        self.view_homographies = view_homographies
+        self.feature_maps = feature_maps
+        self.depth_num = depth_num
+        # shape of a plane
+        self.shape = [tf.shape(feature_maps)[0], h, w, c]
+
+    def __call__(self, d):
+        view_num = self.view_num
+        feature_maps = self.feature_maps
+        # shape: b, h, w, c
+        ref_feature_map = feature_maps[:, 0]
+        with tf.name_scope('cost_plane_homography'):
+            ave_feature = ref_feature_map
+            ave_feature2 = tf.square(ref_feature_map)
+            for view in range(0, view_num - 1):
+                # shape: b, 3, 3
+                homography = tf.gather(self.view_homographies[view], d, axis=1)
+                warped_view_feature = tf_transform_homography(feature_maps[:, view + 1], homography)
+                ave_feature = ave_feature + warped_view_feature
+                ave_feature2 = ave_feature2 + tf.square(warped_view_feature)
+            ave_feature = ave_feature / view_num
+            ave_feature2 = ave_feature2 / view_num
+            cost = ave_feature2 - tf.square(ave_feature)
+        cost.set_shape(feature_maps.get_shape()[:1].concatenate(feature_maps.get_shape()[2:]))
+        return cost
+
+
+def build_cost_volume_batched(view_homographies, feature_maps, depth_num):
+    """
+    same cost volume as build_cost_volume, but every src view is warped to all depth planes by a single
+    tf_transform_homography: the src feature map is tiled to b * depth_num images, each with its own homography.
+    Mean and variance are accumulated view by view on whole (b, depth_num, h, w, c) volumes, in the same order
+    as build_cost_volume, so the results are identical while the graph no longer grows with depth_num.
+    The accumulators are whole float32 volumes, a lower precision dtype is only applied to the result
+    :param view_homographies: view_num - 1 homographies of shape (b, depth_num, 3, 3)
+    :param feature_maps: shape: b, view_num, h, w, c
+    :return: cost volume, shape: b, depth_num, h, w, c
+    """
+    _, view_num, h, w, c = feature_maps.get_shape().as_list()
+
+    # shape: b, 1, h, w, c, broadcast against the depth planes
+    ref_feature_map = tf.expand_dims(feature_maps[:, 0], axis=1)
+    with tf.variable_scope('cost_volume_homography'):
+        ave_feature = ref_feature_map
+        ave_feature2 = tf.square(ref_feature_map)
+        for view in range(0, view_num - 1):
+            # shape: b * depth_num, h, w, c
+            view_feature_map = tf.reshape(
+                tf.tile(tf.expand_dims(feature_maps[:, view + 1], axis=1), [1, depth_num, 1, 1, 1]), [-1, h, w, c])
+            homography = tf.reshape(view_homographies[view], [-1, 3, 3])
+            warped_view_feature = tf_transform_homography(view_feature_map, homography)
+            warped_view_feature = tf.reshape(warped_view_feature, [-1, depth_num, h, w, c])
+            ave_feature = ave_feature + warped_view_feature
+            ave_feature2 = ave_feature2 + tf.square(warped_view_feature)
+        ave_feature = ave_feature / view_num
+        ave_feature2 = ave_feature2 / view_num
+        # shape of cost_volume: b, depth_num, h, w, c
+        cost_volume = ave_feature2 - tf.square(ave_feature)
+
+    return cost_volume
+
+
+def build_cost_volume_chunked(view_homographies, feature_maps, depth_num, depth_chunk, dtype=tf.float32,
+                              preallocate=False):
+    """
+    same cost volume as build_cost_volume, filled depth_chunk planes at a time by a tf.while_loop.
+    Every iteration warps its planes of all src views like build_cost_volume_batched, the iterations run one after
+    another so only one chunk of warped features is alive.
+    With preallocate the volume is allocated once, laid out as (b * depth_num, h, w, c), and every chunk is written
+    into its rows in place: the peak is one volume plus the intermediates of one chunk. The in place update has no
+    gradient, so for training the chunks are written into a TensorArray and concatenated after the loop, which
+    holds the chunks and the volume at the same time (~2 volumes).
+    :param view_homographies: view_num - 1 homographies of shape (b, depth_num, 3, 3)
+    :param feature_maps: shape: b, view_num, h, w, c
+    :param depth_chunk: num of depth planes per iteration
+    :param dtype: dtype the chunks are stored in, the cost is computed in float32
+    :param preallocate: write the chunks into a preallocated volume, inference only
+    :return: cost volume, shape: b, depth_num, h, w, c
+    """
+    _, view_num, h, w, c = feature_maps.get_shape().as_list()
+    depth_chunk = min(depth_chunk, depth_num)
+    chunk_num = (depth_num + depth_chunk - 1) // depth_chunk
+    batch_size = tf.shape(feature_maps)[0]
+
+    with tf.variable_scope('cost_volume_homography'):
+        # shape: view_num - 1, depth_num, b, 3, 3, depth first so that chunks slice the leading axes
+        homographies = tf.transpose(tf.stack(view_homographies, axis=0), [0, 2, 1, 3, 4])
+        # shape: 1, b, h, w, c, broadcast against the depth planes
+        ref_feature_map = tf.expand_dims(feature_maps[:, 0], axis=0)
+
+        def _chunk_cost(d_start, d_size):
+            # shape: d_size, b, h, w, c
+            ave_feature = ref_feature_map
+            ave_feature2 = tf.square(ref_feature_map)
+            for view in range(0, view_num - 1):
+                # shape: d_size * b, h, w, c
+                view_feature_map = tf.reshape(
+                    tf.tile(tf.expand_dims(feature_maps[:, view + 1], axis=0), [d_size, 1, 1, 1, 1]), [-1, h, w, c])
+                homography = tf.reshape(homographies[view, d_start:d_start + d_size], [-1, 3, 3])
+                warped_view_feature = tf_transform_homography(view_feature_map, homography)
+                warped_view_feature = tf.reshape(warped_view_feature, [d_size, -1, h, w, c])
+                ave_feature = ave_feature + warped_view_feature
+                ave_feature2 = ave_feature2 + tf.square(warped_view_feature)
+            ave_feature = ave_feature / view_num
+            ave_feature2 = ave_feature2 / view_num
+            return tf.cast(ave_feature2 - tf.square(ave_feature), dtype)
+
+        if preallocate:
+            from tensorflow.python.ops import inplace_ops
+            # row i * depth_num + d holds plane d of sample i, so the volume is reshaped to b, depth_num without a copy
+            volume = inplace_ops.empty([batch_size * depth_num, h, w, c], dtype)
+
+            def _body(chunk, volume):
+                d_start = chunk * depth_chunk
+                d_size = tf.minimum(depth_chunk, depth_num - d_start)
+                # shape: b * d_size, h, w, c
+                cost = tf.reshape(tf.transpose(_chunk_cost(d_start, d_size), [1, 0, 2, 3, 4]), [-1, h, w, c])
+                rows = tf.reshape(tf.expand_dims(tf.range(batch_size) * depth_num, axis=1) +
+                                  tf.expand_dims(tf.range(d_start, d_start + d_size), axis=0), [-1])
+                return chunk + 1, inplace_ops.alias_inplace_update(volume, rows, cost)
+
+            _, volume = tf.while_loop(lambda chunk, _: chunk < chunk_num, _body, [tf.constant(0), volume],
+                                      parallel_iterations=1)
+            cost_volume = tf.reshape(volume, [-1, depth_num, h, w, c])
+        else:
+            costs = tf.TensorArray(dtype, size=chunk_num, infer_shape=False)
+
+            def _body(chunk, costs):
+                d_start = chunk * depth_chunk
+                d_size = tf.minimum(depth_chunk, depth_num - d_start)
+                return chunk + 1, costs.write(chunk, _chunk_cost(d_start, d_size))
+
+            _, costs = tf.while_loop(lambda chunk, _: chunk < chunk_num, _body, [tf.constant(0), costs],
+                                     parallel_iterations=1, swap_memory=True)
+            # shape: depth_num, b, h, w, c
+            cost_volume = costs.concat()
+            # with a single sample the depth and batch axes can be swapped without a copy
+            cost_volume = tf.cond(tf.equal(batch_size, 1),
+                                  lambda: tf.reshape(cost_volume, [1, depth_num, h, w, c]),
+                                  lambda: tf.transpose(cost_volume, [1, 0, 2, 3, 4]))
+        cost_volume.set_shape([None, depth_num, h, w, c])
+
+    return cost_volume
+
+
+def bilinear_sample(image, x, y):
+    """
+    bilinear interpolation of image at the pixel coordinates (x, y), the center of pixel (i, j) is at (j, i).
+    Neighbours outside the image are read as zeros, as in tf.contrib.image.transform
+    :param image: shape: b, h, w, c
+    :param x: shape: b, ...
+    :param y: shape: b, ...
+    :return: shape: b, ..., c
+    """
+    shape = tf.shape(image)
+    batch_size, height, width = shape[0], shape[1], shape[2]
+    c = image.get_shape().as_list()[-1]
+    flat_image = tf.reshape(image, [-1, c])
+    b_coordinates = tf.reshape(tf.range(batch_size), [-1] + [1] * (x.get_shape().ndims - 1))
+
+    x0 = tf.floor(x)
+    y0 = tf.floor(y)
+    x_weight1 = tf.expand_dims(x - x0, -1)
+    y_weight1 = tf.expand_dims(y - y0, -1)
+    x0 = tf.cast(x0, 'int32')
+    y0 = tf.cast(y0, 'int32')
+
+    def read(xi, yi):
+        valid = (xi >= 0) & (xi < width) & (yi >= 0) & (yi < height)
+        pixel_indices = (b_coordinates * height + tf.clip_by_value(yi, 0, height - 1)) * width + \
+            tf.clip_by_value(xi, 0, width - 1)
+        return tf.gather(flat_image, pixel_indices) * tf.expand_dims(tf.cast(valid, image.dtype), -1)
+
+    top = (1 - x_weight1) * read(x0, y0) + x_weight1 * read(x0 + 1, y0)
+    bottom = (1 - x_weight1) * read(x0, y0 + 1) + x_weight1 * read(x0 + 1, y0 + 1)
+    return (1 - y_weight1) * top + y_weight1 * bottom
+
+
+def build_cost_volume_hypotheses(view_terms, ref_feature_map, src_feature_maps, depth_hypotheses):
+    """
+    variance cost volume over per pixel depth hypotheses, e.g. a narrow range around a previous depth estimate.
+    Every ref pixel p is projected to the src views by its own H(d) p = A p - B p / d, then the src feature maps
+    are sampled bilinearly, with the pixel centers at +0.5 in the image coordinates of the homographies as in
+    tf_transform_homography. The src feature maps may be larger than the ref one, e.g. around a ref tile whose
+    cam has its principal point shifted, they are only read where the ref pixels project
+    :param view_terms: view_num - 1 (A, B) of get_homography_terms
+    :param ref_feature_map: shape: b, h, w, c
+    :param src_feature_maps: shape: b, view_num - 1, src_h, src_w, c
+    :param depth_hypotheses: shape: b, d, h, w
+    :return: cost volume, shape: b, d, h, w, c
+    """
+    _, h, w, c = ref_feature_map.get_shape().as_list()
+    view_num = len(view_terms) + 1
+    batch_size = tf.shape(ref_feature_map)[0]
+    depth_num = tf.shape(depth_hypotheses)[1]
+
+    # image coordinates of the pixel centers, shape: 3, h * w
+    x, y = tf.meshgrid(tf.range(w, dtype=tf.float32) + 0.5, tf.range(h, dtype=tf.float32) + 0.5)
+    pixels = tf.stack([tf.reshape(x, [-1]), tf.reshape(y, [-1]), tf.ones([h * w])], axis=0)
+    # shape: b, d, 1, h * w
+    depth = tf.reshape(depth_hypotheses, [batch_size, depth_num, 1, h * w])
+
+    ref_feature_map = tf.expand_dims(ref_feature_map, axis=1)
+    with tf.variable_scope('cost_volume_hypotheses'):
+        ave_feature = ref_feature_map
+        ave_feature2 = tf.square(ref_feature_map)
+        for view, (A, B) in enumerate(view_terms):
+            # shape: b, 1, 3, h * w
+            a_pixels = tf.expand_dims(tf.matmul(A, tf.tile(pixels[tf.newaxis], [batch_size, 1, 1])), axis=1)
+            b_pixels = tf.expand_dims(tf.matmul(B, tf.tile(pixels[tf.newaxis], [batch_size, 1, 1])), axis=1)
+            # shape: b, d, 3, h * w
+            projected = a_pixels - b_pixels / depth
+            z = projected[:, :, 2]
+            z = tf.where(tf.abs(z) < 1e-7, tf.fill(tf.shape(z), 1e-7), z)
+            # pixel coordinates in the src view, shape: b, d, h, w
+            src_x = tf.reshape(projected[:, :, 0] / z - 0.5, [batch_size, depth_num, h, w])
+            src_y = tf.reshape(projected[:, :, 1] / z - 0.5, [batch_size, depth_num, h, w])
+            warped_view_feature = bilinear_sample(src_feature_maps[:, view], src_x, src_y)
+            ave_feature = ave_feature + warped_view_feature
+            ave_feature2 = ave_feature2 + tf.square(warped_view_feature)
+        ave_feature = ave_feature / view_num
+        ave_feature2 = ave_feature2 / view_num
+        cost_volume = ave_feature2 - tf.square(ave_feature)
+
+    return cost_volume
+
+
 def tf_transform_homography(input_image, homography):
 
     # tf.contrib.image.transform is for pixel coordinate but our
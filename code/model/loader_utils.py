@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# File: loader_utils.py
+
+import ctypes
+import time
+import queue
+import traceback
+import multiprocessing as mp
+import numpy as np
+from tensorpack import *
+from tensorpack.utils import logger
+from tensorpack.utils.concurrency import (ensure_proc_terminate, start_proc_mask_signal)
+
+__all__ = ['SharedMemoryLoader', 'DataFlowStatsMonitor']
+
+
+class SharedMemoryLoader(DataFlow):
+    """
+    Runs a DTU-like dataflow in `nr_proc` forked workers and produces batches of it.
+    Every worker iterates its own contiguous shard of each epoch, batches the datapoints itself and writes the batch
+    straight into one slot of a ring of shared-memory buffers. Only slot ids travel through the queues, so the
+    trainer never unpickles the image arrays.
+
+    The yielded arrays are views into a slot, which goes back to the workers as soon as the next batch is
+    requested. QueueInput feeds every datapoint before asking for the next one, consumers that keep a batch
+    around have to copy it.
+
+    An exception in a worker is sent to the trainer and raised there as a RuntimeError with the traceback of the
+    worker, a worker that dies without one (e.g. killed) is found by its exit code.
+    """
+
+    # seconds between two checks of the workers while waiting for a batch
+    POLL_SECONDS = 5
+
+    def __init__(self, ds, batch_size, nr_proc, nr_slots=None):
+        """
+        :param ds: dataflow with a `shard(rank, world_size)`, such as DTU or DTUShard
+        :param batch_size: batch size of the produced datapoints
+        :param nr_proc: num of worker processes
+        :param nr_slots: num of shared-memory batch buffers, defaults to 2 per worker
+        """
+        assert nr_proc > 0, nr_proc
+        assert len(ds) >= nr_proc, 'the shards of {} workers over {} samples would be empty'.format(nr_proc, len(ds))
+        self.ds = ds
+        self.batch_size = batch_size
+        self.nr_proc = nr_proc
+        self.nr_slots = nr_slots or 2 * nr_proc
+        assert self.nr_slots >= nr_proc, 'there should be at least one slot for each worker'
+        self._procs = None
+
+    def __len__(self):
+        return len(self.ds) // self.batch_size
+
+    def reset_state(self):
+        if self._procs is not None:
+            return
+        # the first datapoint tells the shapes and dtypes of the slots
+        self.ds.reset_state()
+        dp = next(iter(self.ds))
+        self._specs = [((self.batch_size,) + np.shape(component), np.asarray(component).dtype) for component in dp]
+        slot_bytes = sum(int(np.prod(shape)) * dtype.itemsize for shape, dtype in self._specs)
+        logger.info('SharedMemoryLoader: {} workers, {} slots of {:.1f} MB'.format(
+            self.nr_proc, self.nr_slots, slot_bytes / 1024. ** 2))
+
+        ctx = mp.get_context('fork')
+        self._buffers = [mp.RawArray(ctypes.c_uint8, slot_bytes) for _ in range(self.nr_slots)]
+        self._slots = [self._slot_views(buffer) for buffer in self._buffers]
+        self._free_queue = ctx.Queue()
+        self._ready_queue = ctx.Queue()
+        for slot in range(self.nr_slots):
+            self._free_queue.put(slot)
+        # per worker: produced samples, seconds spent producing them, then the get_stats() of its dataflow
+        self._ds_stat_names = sorted(self.ds.get_stats()) if hasattr(self.ds, 'get_stats') else []
+        self._stat_num = 2 + len(self._ds_stat_names)
+        self._stats = mp.RawArray(ctypes.c_double, self._stat_num * self.nr_proc)
+
+        self._procs = [ctx.Process(target=self._run_worker, args=(rank,)) for rank in range(self.nr_proc)]
+        for proc in self._procs:
+            proc.daemon = True
+        ensure_proc_terminate(self._procs)
+        start_proc_mask_signal(self._procs)
+
+    def _slot_views(self, buffer):
+        views = []
+        offset = 0
+        for shape, dtype in self._specs:
+            count = int(np.prod(shape))
+            views.append(np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape))
+            offset += count * dtype.itemsize
+        return views
+
+    def _run_worker(self, rank):
+        try:
+            self._produce(rank)
+        except Exception:
+            # the exception may not be picklable, its traceback is
+            self._ready_queue.put((rank, traceback.format_exc()))
+            raise
+
+    def _produce(self, rank):
+        # the shards of all workers share the permutation of each epoch, so they never overlap
+        ds = self.ds.shard(rank, self.nr_proc)
+        ds.reset_state()
+        idx = 0
+        slot = None
+        busy = 0.
+        start = time.time()
+        while True:
+            dp_num = 0
+            for dp in ds:
+                dp_num += 1
+                if slot is None:
+                    busy += time.time() - start
+                    slot = self._free_queue.get()
+                    start = time.time()
+                for view, component in zip(self._slots[slot], dp):
+                    view[idx] = component
+                idx += 1
+                if idx == self.batch_size:
+                    self._ready_queue.put(slot)
+                    busy += time.time() - start
+                    start = time.time()
+                    self._update_stats(rank, busy, ds)
+                    idx = 0
+                    slot = None
+            if dp_num == 0:
+                # an empty epoch would spin forever
+                raise RuntimeError('the shard of worker {} of {} is empty'.format(rank, self.nr_proc))
+
+    def _update_stats(self, rank, busy, ds):
+        """ :param ds: the shard of the worker """
+        base = self._stat_num * rank
+        self._stats[base] += self.batch_size
+        self._stats[base + 1] = busy
+        if self._ds_stat_names:
+            ds_stats = ds.get_stats()
+            for i, name in enumerate(self._ds_stat_names):
+                self._stats[base + 2 + i] = ds_stats[name]
+
+    def _next_slot(self):
+        """ the next ready slot, raises the failure of a worker instead of waiting for it forever """
+        while True:
+            try:
+                item = self._ready_queue.get(timeout=self.POLL_SECONDS)
+            except queue.Empty:
+                item = None
+            if isinstance(item, tuple):
+                rank, worker_traceback = item
+                raise RuntimeError('worker {} of SharedMemoryLoader failed:\n{}'.format(rank, worker_traceback))
+            # the workers never return, the other workers would go on without the shard of a dead one
+            for rank, proc in enumerate(self._procs):
+                if proc.exitcode is not None:
+                    raise RuntimeError('worker {} of SharedMemoryLoader exited with code {}'.format(
+                        rank, proc.exitcode))
+            if item is not None:
+                return item
+
+    def __iter__(self):
+        slot = None
+        for _ in range(len(self)):
+            if slot is not None:
+                self._free_queue.put(slot)
+            slot = self._next_slot()
+            yield self._slots[slot]
+        if slot is not None:
+            self._free_queue.put(slot)
+
+    def get_stats(self):
+        """ samples per second of busy time and the dataflow stats of each worker, and the total throughput """
+        stats = {}
+        total = 0.
+        for rank in range(self.nr_proc):
+            base = self._stat_num * rank
+            samples, busy = self._stats[base], self._stats[base + 1]
+            throughput = samples / busy if busy > 0 else 0.
+            stats['worker{}_samples_per_sec'.format(rank)] = throughput
+            total += throughput
+            for i, name in enumerate(self._ds_stat_names):
+                stats['worker{}_{}'.format(rank, name)] = self._stats[base + 2 + i]
+        stats['samples_per_sec'] = total
+        return stats
+
+
+class DataFlowStatsMonitor(Callback):
+    """ puts the `get_stats()` of a dataflow into the monitors after every epoch """
+
+    def __init__(self, ds, prefix='dataflow'):
+        self._ds = ds
+        self._prefix = prefix
+
+    def _trigger(self):
+        for name, value in sorted(self._ds.get_stats().items()):
+            self.trainer.monitors.put_scalar('{}/{}'.format(self._prefix, name), value)
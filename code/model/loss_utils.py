@@ -25,9 +25,7 @@ def mvsnet_classification_loss(prob_volume, gt_depth_image, depth_num, depth_sta
     start_mat = tf.tile(tf.reshape(depth_start, [shape[0], 1, 1, 1]), [1, shape[1], shape[2], 1])
 
     interval_mat = tf.tile(tf.reshape(depth_interval, [shape[0], 1, 1, 1]), [1, shape[1], shape[2], 1])
-    gt_index_image = tf.div(gt_depth_image - start_mat, interval_mat)
-    gt_index_image = tf.multiply(mask_true, gt_index_image)
-    gt_index_image = tf.cast(tf.round(gt_index_image), dtype='int32')
+    gt_index_image = get_gt_index_image(gt_depth_image, depth_start, depth_interval)
     # gt index map -> gt one hot volume (B x H x W x 1)
     gt_index_volume = tf.one_hot(gt_index_image, depth_num, axis=1)
     # cross entropy image (B x H x W x 1)
@@ -51,6 +49,47 @@ def mvsnet_classification_loss(prob_volume, gt_depth_image, depth_num, depth_sta
     return masked_cross_entropy, masked_mae, less_one_accuracy, less_three_accuracy, wta_depth_map
 
 
+def get_gt_index_image(gt_depth_image, depth_start, depth_interval):
+    """
+    index of the depth plane closest to the gt depth, 0 where there is no gt
+    :param gt_depth_image: shape: b, h, w, 1
+    :return: shape: b, h, w, 1, int32
+    """
+    mask_true = tf.cast(tf.not_equal(gt_depth_image, 0.0), dtype='float32')
+    start_mat = tf.reshape(depth_start, [-1, 1, 1, 1])
+    interval_mat = tf.reshape(depth_interval, [-1, 1, 1, 1])
+    gt_index_image = tf.multiply(mask_true, tf.div(gt_depth_image - start_mat, interval_mat))
+    return tf.cast(tf.round(gt_index_image), dtype='int32')
+
+
+def mvsnet_online_classification_loss(gt_logit, log_sum_exp, wta_depth_map, gt_depth_image, depth_num,
+                                      depth_start, depth_interval):
+    """
+    loss and accuracy of mvsnet_classification_loss from the values gru_winner_take_all accumulates over the
+    depth planes, without the probability volume
+    :param gt_logit: logit of the plane of get_gt_index_image, shape: b, h, w, 1
+    :param log_sum_exp: log-sum-exp of the logits over the planes, shape: b, h, w, 1
+    :param wta_depth_map: depth of the most probable plane, shape: b, h, w, 1
+    """
+    mask_true = tf.cast(tf.not_equal(gt_depth_image, 0.0), dtype='float32')
+    valid_pixel_num = tf.reduce_sum(mask_true, axis=[1, 2, 3]) + 1e-7
+    gt_index_image = get_gt_index_image(gt_depth_image, depth_start, depth_interval)
+    # -log(softmax) of the gt plane, 0 where the gt is out of the planes like the empty one hot of
+    # mvsnet_classification_loss
+    in_range = tf.logical_and(gt_index_image >= 0, gt_index_image < depth_num)
+    cross_entropy_image = tf.where(in_range, log_sum_exp - gt_logit, tf.zeros_like(gt_logit))
+    # masked cross entropy loss
+    masked_cross_entropy_image = tf.multiply(mask_true, cross_entropy_image)
+    masked_cross_entropy = tf.reduce_sum(masked_cross_entropy_image, axis=[1, 2, 3])
+    masked_cross_entropy = tf.reduce_sum(masked_cross_entropy / valid_pixel_num)
+
+    masked_mae = non_zero_mean_absolute_diff(gt_depth_image, wta_depth_map, tf.abs(depth_interval))
+    less_one_accuracy = less_one_percentage(gt_depth_image, wta_depth_map, tf.abs(depth_interval))
+    less_three_accuracy = less_three_percentage(gt_depth_image, wta_depth_map, tf.abs(depth_interval))
+
+    return masked_cross_entropy, masked_mae, less_one_accuracy, less_three_accuracy
+
+
 def non_zero_mean_absolute_diff(gt_depth, pred_depth, depth_interval):
     """
     non zero mean absolute error(MAE)
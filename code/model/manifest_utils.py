@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# File: manifest_utils.py
+
+"""
+Dataset manifests.
+
+A manifest is the list of files of a dataset root (paths relative to the root) with their sizes and mtimes,
+gathered once by a thread pool and saved as a small ``.npz``. Dataflows that are given a manifest take their
+scenes from it and drop the samples whose files are missing or empty up front, instead of failing when the
+sample is read hours into an epoch.
+
+Two layouts are supported:
+
+* dtu: the dtu_training root, Rectified, Depths and Cameras
+* test: a test root of numbered scenes, each with images, cams and pair.txt
+"""
+
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from tensorpack.utils import logger
+
+__all__ = ['Manifest', 'build_dtu_manifest', 'build_test_manifest', 'load_or_build_manifest']
+
+MANIFEST_VERSION = 1
+DTU_LIGHTING_NUM = 7
+DTU_IMAGE_FILE = 'Rectified/scan%d_train/rect_%03d_%d_r5000.png'
+DTU_DEPTH_FILE = 'Depths/scan%d_train/depth_map_%04d.pfm'
+DTU_CAM_FILE = 'Cameras/train/%08d_cam.txt'
+DTU_PAIR_FILE = 'Cameras/pair.txt'
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return -1, 0.
+    return stat.st_size, stat.st_mtime
+
+
+class Manifest(object):
+    """
+    paths, sizes and mtimes of the files of a dataset root
+    the size of a missing file is -1
+    """
+
+    def __init__(self, root, kind, paths, sizes, mtimes):
+        self.root = root
+        self.kind = kind
+        self.paths = np.asarray(paths, dtype=np.str_)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.mtimes = np.asarray(mtimes, dtype=np.float64)
+        self._ids = {path: i for i, path in enumerate(self.paths.tolist())}
+
+    @staticmethod
+    def build(root, kind, paths, nr_thread=16):
+        """ stat the paths (relative to root) with a thread pool """
+        with ThreadPoolExecutor(max_workers=nr_thread) as executor:
+            stats = list(executor.map(_stat, [os.path.join(root, path) for path in paths], chunksize=256))
+        sizes = [size for size, _ in stats]
+        mtimes = [mtime for _, mtime in stats]
+        manifest = Manifest(root, kind, paths, sizes, mtimes)
+        bad_paths = manifest.bad_paths()
+        logger.info('manifest of {}: {} files, {} missing or empty'.format(root, len(paths), len(bad_paths)))
+        for path in bad_paths[:20]:
+            logger.warn('bad file: {}'.format(path))
+        return manifest
+
+    def save(self, file_path):
+        # through a file object, np.savez_compressed appends .npz to a path without it
+        with open(file_path, 'wb') as out_file:
+            np.savez_compressed(out_file, version=MANIFEST_VERSION, root=self.root, kind=self.kind, paths=self.paths,
+                                sizes=self.sizes, mtimes=self.mtimes)
+
+    @staticmethod
+    def load(file_path):
+        with np.load(file_path) as data:
+            assert int(data['version']) == MANIFEST_VERSION, 'manifest version {} is not supported'.format(
+                int(data['version']))
+            return Manifest(str(data['root']), str(data['kind']), data['paths'], data['sizes'], data['mtimes'])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def ok(self, path):
+        """ whether path (relative to root) is in the manifest and not empty """
+        i = self._ids.get(path)
+        return i is not None and self.sizes[i] > 0
+
+    def bad_paths(self):
+        return self.paths[self.sizes <= 0].tolist()
+
+    def stale_paths(self, nr_thread=16):
+        """ paths whose size or mtime changed since the manifest was built """
+        current = Manifest.build(self.root, self.kind, self.paths.tolist(), nr_thread)
+        changed = (current.sizes != self.sizes) | (current.mtimes != self.mtimes)
+        return self.paths[changed].tolist()
+
+    def test_scenes(self):
+        """ scene dirs of a test root, in numerical order """
+        scenes = [path.split('/')[0] for path in self.paths.tolist() if path.endswith('/pair.txt')]
+        return sorted(scenes, key=int)
+
+
+def build_dtu_manifest(dtu_data_root, scans, nr_thread=16):
+    """
+    manifest of the files the DTU dataflow reads for the given scans: images of all lightings, depth maps,
+    cams and pair.txt
+    """
+    with open(os.path.join(dtu_data_root, DTU_PAIR_FILE), 'r') as cluster_file:
+        cam_num = int(cluster_file.read().split()[0])
+    paths = [DTU_PAIR_FILE]
+    paths.extend(DTU_CAM_FILE % view for view in range(cam_num))
+    for scan in scans:
+        paths.extend(DTU_IMAGE_FILE % (scan, view + 1, light)
+                     for light in range(DTU_LIGHTING_NUM) for view in range(cam_num))
+        paths.extend(DTU_DEPTH_FILE % (scan, view) for view in range(cam_num))
+    return Manifest.build(dtu_data_root, 'dtu', paths, nr_thread)
+
+
+def build_test_manifest(test_root, nr_thread=16):
+    """ manifest of every numbered scene of a test root: its images, cams and pair.txt """
+    paths = []
+    scenes = sorted((entry.name for entry in os.scandir(test_root) if entry.is_dir() and entry.name.isdigit()),
+                    key=int)
+    for scene in scenes:
+        for sub_dir in ['images', 'cams']:
+            sub_path = os.path.join(test_root, scene, sub_dir)
+            if os.path.isdir(sub_path):
+                paths.extend(sorted('{}/{}/{}'.format(scene, sub_dir, entry.name) for entry in os.scandir(sub_path)
+                                    if entry.is_file()))
+        # pair.txt marks the scene, a scene without it is reported as bad
+        paths.append('{}/pair.txt'.format(scene))
+    return Manifest.build(test_root, 'test', paths, nr_thread)
+
+
+def load_or_build_manifest(file_path, root, kind, scans=None, nr_thread=16, check_stale=False):
+    """
+    load the manifest at file_path, or build and save it there if there is none yet
+    :param check_stale: stat the files of a loaded manifest again and rebuild it if any changed (stale_paths)
+    """
+    if os.path.exists(file_path):
+        manifest = Manifest.load(file_path)
+        assert manifest.kind == kind, 'manifest {} is of kind {}, not {}'.format(file_path, manifest.kind, kind)
+        logger.info('loaded manifest of {} files from {}'.format(len(manifest), file_path))
+        if not check_stale:
+            return manifest
+        stale_paths = manifest.stale_paths(nr_thread)
+        if not stale_paths:
+            return manifest
+        logger.warn('{} files of manifest {} changed, e.g. {}, rebuilding it'.format(
+            len(stale_paths), file_path, stale_paths[0]))
+    if kind == 'dtu':
+        manifest = build_dtu_manifest(root, scans, nr_thread)
+    else:
+        manifest = build_test_manifest(root, nr_thread)
+    manifest.save(file_path)
+    return manifest
+
+
+if __name__ == "__main__":
+    from dataflow_utils import DTU_TRAINING_SET, DTU_VALIDATION_SET
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', help='dtu_training root or test root', required=True)
+    parser.add_argument('--kind', choices=['dtu', 'test'], required=True)
+    parser.add_argument('--out', help='path of the .npz manifest', required=True)
+    parser.add_argument('--threads', default=16, type=int)
+    args = parser.parse_args()
+
+    if args.kind == 'dtu':
+        manifest = build_dtu_manifest(args.root, DTU_TRAINING_SET + DTU_VALIDATION_SET, args.threads)
+    else:
+        manifest = build_test_manifest(args.root, args.threads)
+    manifest.save(args.out)
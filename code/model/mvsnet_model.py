@@ -8,10 +8,13 @@ from summary_utils import add_image_summary
 import tensorflow as tf
 from tensorpack.tfutils.gradproc import SummaryGradient
 from DataManager import Cam
+from contextlib import contextmanager
 
 """ monkey-patch """
 enable_argscope_for_module(tf.layers)
 
+MODEL_STAGES = ['full', 'feature', 'depth', 'tile']
+
 
 def get_depth_meta(cams, depth_num):
     """
@@ -73,6 +76,9 @@ class MVSNet(ModelDesc):
 
     debug_param_summary = True
 
+    """channels of the feature maps of both feature extraction branches"""
+    feature_channels = 32
+
     base_lr = 1e-3
 
     """Step interval to decay learning rate."""
@@ -82,7 +88,32 @@ class MVSNet(ModelDesc):
     decay_rate = 0.9
 
     def __init__(self, depth_num, bn_training, bn_trainable, batch_size, branch_function, is_refine, height, width,
-                 view_num, regularize_type):
+                 view_num, regularize_type, cost_volume_mode='batched', depth_chunk=32, homography_input=False,
+                 feature_views='batched', stage='full', cost_volume_dtype='float32', cascade=None,
+                 source_shape=None, with_gt=True):
+        """
+        :param cost_volume_mode: how the warping layer builds the cost volume, one of COST_VOLUME_MODES.
+        'streamed' only works with the GRU regularization, which then warps the planes one by one in its loop
+        :param depth_chunk: num of depth planes built per loop iteration in the 'chunked' cost volume mode
+        :param homography_input: take the homographies as an input computed by the dataflow
+        (get_view_homographies_np) instead of computing them from the cams in the graph
+        :param feature_views: run the feature extraction branch on all views at once or view by view, one of
+        FEATURE_VIEW_MODES
+        :param stage: one of MODEL_STAGES. 'full' is the whole net. 'feature' only maps a batch of single images
+        to their feature maps, 'depth' takes the feature maps of all views as an input and runs the rest of the net,
+        so that a test scene can extract the features of each image once (see predict_utils.py). 'tile' is the
+        'depth' stage of a height x width tile of the ref view, its ref cam has the principal point of the tile,
+        against the whole feature maps of the src views (see TiledPredictor). All stages share the variable names
+        of 'full'
+        :param cost_volume_dtype: dtype the cost volume and the skip tensors of the 3DCNN regularization are stored
+        in, one of COST_VOLUME_DTYPES, all layers compute in float32
+        :param cascade: num of depth planes of every stage of a coarse to fine 3DCNN regularization, e.g. [48, 32, 8],
+        see _cascade_regression. None regularizes the depth_num planes of the whole range at once
+        :param source_shape: (height, width) of the src images of the 'tile' stage
+        :param with_gt: gt_depth is fed at inference too, as in validation. The inference loop of the GRU
+        regularization then accumulates the loss as well, it needs gt_depth to run. False for the predictors of
+        get_predict_input_names, whose loss and accuracies are then NaN
+        """
         super(MVSNet, self).__init__()
         # self.is_training = is_training
         self.bn_training = bn_training
@@ -95,14 +126,65 @@ class MVSNet(ModelDesc):
         self.width = width
         self.view_num = view_num
         self.regularize_type = regularize_type
+        self.cost_volume_mode = cost_volume_mode
+        self.depth_chunk = depth_chunk
+        self.homography_input = homography_input
+        self.feature_views = feature_views
+        assert cost_volume_mode != 'streamed' or regularize_type == 'GRU', \
+            'the streamed cost volume is only built by the GRU regularization'
+        assert stage in MODEL_STAGES, stage
+        self.stage = stage
+        self.cost_volume_dtype = cost_volume_dtype
+        assert not cascade or regularize_type == '3DCNN', 'the cascade is a 3DCNN regularization'
+        assert not cascade or not homography_input, 'the homographies of the cascade stages depend on the depth'
+        # the 3DCNN regularization of every stage downsamples the depth three times
+        assert all(plane_num % 8 == 0 for plane_num in cascade or []), \
+            'the plane nums of the cascade must be multiples of 8: {}'.format(cascade)
+        self.cascade = cascade
+        if stage == 'tile':
+            assert source_shape is not None, 'the tile stage needs the shape of the src images'
+            assert not cascade and not homography_input and cost_volume_mode != 'streamed', \
+                'the tile stage samples the src views per pixel'
+        self.source_shape = source_shape
+        self.with_gt = with_gt
+
+    def get_input_names(self):
+        """ names of the inputs, in the order of the datapoints """
+        if self.stage == 'feature':
+            return ['imgs']
+        names = ['imgs']
+        if self.stage == 'depth':
+            names.append('feature_maps')
+        elif self.stage == 'tile':
+            names.extend(['ref_features', 'src_features'])
+        names.append('cams')
+        if self.homography_input:
+            names.append('homographies')
+        return names + ['gt_depth']
+
+    def get_predict_input_names(self):
+        """ names of the inputs fed at test time """
+        return [name for name in self.get_input_names() if name != 'gt_depth']
 
     def inputs(self):
-        return [
-            tf.placeholder(tf.float32, [None, self.view_num, self.height, self.width, 3], 'imgs'),
-            tf.placeholder(tf.float32, [None, self.view_num, 2, 4, 4], 'cams'),
-            # tf.placeholder(tf.float32, [None, self.height, self.width, 1], 'seg_map'),
-            tf.placeholder(tf.float32, [None, self.height // 4, self.width // 4, 1], 'gt_depth'),
-        ]
+        shapes = {
+            'imgs': [None, self.view_num, self.height, self.width, 3],
+            'feature_maps': [None, self.view_num, self.height // 4, self.width // 4, self.feature_channels],
+            'cams': [None, self.view_num, 2, 4, 4],
+            # 'seg_map': [None, self.height, self.width, 1],
+            'ref_features': [None, self.height // 4, self.width // 4, self.feature_channels],
+            'src_features': [None, self.view_num - 1] + [size // 4 for size in self.source_shape or (0, 0)] +
+                            [self.feature_channels],
+            'homographies': [None, self.view_num - 1, self.depth_num, 3, 3],
+            'gt_depth': [None, self.height // 4, self.width // 4, 1],
+        }
+        if self.stage == 'feature':
+            # a batch of single images
+            shapes['imgs'] = [None, self.height, self.width, 3]
+        elif self.stage in ['depth', 'tile']:
+            # the ref image only, for the refinement and the summaries
+            shapes['imgs'] = [None, 1, self.height, self.width, 3]
+        return [tf.placeholder(tf.float32, shapes[name], name) for name in self.get_input_names()]
 
     def _preprocess(self, imgs, gt_depth):
         with tf.variable_scope('preprocess'):
@@ -111,38 +193,119 @@ class MVSNet(ModelDesc):
             ref_img = tf.identity(ref_img, name='ref_img')
             return imgs, gt_depth, ref_img
 
-    def build_graph(self, imgs, cams, gt_depth):
-        # preprocess
-        imgs, gt_depth, ref_img = self._preprocess(imgs, gt_depth)
-
+    @contextmanager
+    def _layer_argscope(self):
         with argscope([tf.layers.conv3d, tf.layers.conv3d_transpose, mvsnet_gn,
                        Conv2D, Conv2DTranspose, MaxPooling, AvgPooling, BatchNorm],
                       data_format=self.data_format),\
              argscope(tf.layers.batch_normalization, axis=-1):
-            # feature extraction
-            # shape: b, view_num, h/4, w/4, c
-            feature_maps = feature_extraction_net(imgs, self.branch_function)
+            yield
+
+    def _cascade_regression(self, feature_maps, cams, depth_start, depth_interval, depth_end, gt_depth):
+        """
+        coarse to fine depth regression, all stages at the resolution of the feature maps. The first stage sweeps
+        the whole range of the depth_num planes with uniform planes (the variable names of the single stage net),
+        every next stage halves the interval and centers its planes on the depth of the previous stage per pixel,
+        kept within depth_start, depth_end, with its own regularization under 'stage<n>/'. [48, 32, 8] over 192 planes are intervals of 4, 2, 1
+        :return: depth and prob_map of the last stage, b, h/4, w/4, 1, the losses of the other stages
+        """
+        stage_interval = depth_interval * self.depth_num / self.cascade[0]
+        stage_losses = []
+        for stage, plane_num in enumerate(self.cascade):
+            if stage == 0:
+                cost_volume = warping_layer('warping', feature_maps, cams, depth_start, stage_interval, plane_num,
+                                            cost_volume_mode=self.cost_volume_mode, depth_chunk=self.depth_chunk,
+                                            dtype=self.cost_volume_dtype)
+                regularized_cost_volume = cost_volume_regularization(cost_volume, self.bn_training,
+                                                                     self.bn_trainable)
+                depth, prob_map = soft_argmin('soft_argmin', regularized_cost_volume, depth_start, stage_interval,
+                                              plane_num)
+            else:
+                stage_losses.append(mvsnet_regression_loss(
+                    gt_depth, depth, depth_interval, 'stage{}_loss'.format(stage))[0])
+                stage_interval = stage_interval / 2
+                with tf.variable_scope('stage{}'.format(stage + 1)):
+                    depth_hypotheses, hypotheses_start = get_cascade_hypotheses(depth, depth_start, depth_end,
+                                                                                stage_interval, plane_num)
+                    cost_volume = hypotheses_warping_layer('warping', feature_maps[:, 0], feature_maps[:, 1:], cams,
+                                                           depth_hypotheses, dtype=self.cost_volume_dtype)
+                    regularized_cost_volume = cost_volume_regularization(cost_volume, self.bn_training,
+                                                                         self.bn_trainable)
+                    depth, prob_map = soft_argmin_hypotheses('soft_argmin', regularized_cost_volume,
+                                                             depth_hypotheses, hypotheses_start, stage_interval)
+            depth = tf.identity(depth, 'stage{}_depth'.format(stage + 1))
+        return depth, prob_map, stage_losses
+
+    def _build_feature_graph(self, imgs):
+        """ feature maps of a batch of single images, shape: b, h/4, w/4, c """
+        with tf.variable_scope('preprocess'):
+            imgs = center_image(tf.expand_dims(imgs, 1))
+        with self._layer_argscope():
+            feature_maps = feature_extraction_net(imgs, self.branch_function, feature_views='batched')
+        return tf.identity(feature_maps[:, 0], name='image_features')
+
+    def build_graph(self, *inputs):
+        inputs = dict(zip(self.get_input_names(), inputs))
+        if self.stage == 'feature':
+            self._build_feature_graph(inputs['imgs'])
+            return
+        imgs, cams, gt_depth = inputs['imgs'], inputs['cams'], inputs['gt_depth']
+        # preprocess
+        imgs, gt_depth, ref_img = self._preprocess(imgs, gt_depth)
+
+        with self._layer_argscope():
+            if self.stage == 'depth':
+                # extracted by the 'feature' stage
+                feature_maps = inputs['feature_maps']
+            elif self.stage == 'tile':
+                feature_maps = None
+            else:
+                # feature extraction
+                # shape: b, view_num, h/4, w/4, c
+                feature_maps = feature_extraction_net(imgs, self.branch_function, feature_views=self.feature_views)
 
             # get depth_start and depth_interval batch-wise
             depth_start, depth_interval, depth_end = get_depth_meta(cams, depth_num=self.depth_num)
 
             # warping layer
             # shape of cost_volume: b, depth_num, h/4, w/4, c
-            cost_volume = warping_layer('warping', feature_maps, cams, depth_start
-                                        , depth_interval, self.depth_num)
+            if self.cascade:
+                # every stage builds its own
+                pass
+            elif self.stage == 'tile':
+                # the planes as per pixel hypotheses, the src views are only sampled where the tile projects
+                depth_hypotheses = tf.tile(
+                    get_depth_values(depth_start, depth_interval, self.depth_num)[:, :, tf.newaxis, tf.newaxis],
+                    [1, 1, self.height // 4, self.width // 4])
+                cost_volume = hypotheses_warping_layer('warping', inputs['ref_features'], inputs['src_features'],
+                                                       cams, depth_hypotheses, dtype=self.cost_volume_dtype)
+            elif self.cost_volume_mode == 'streamed':
+                # built plane by plane in the loop of the gru regularization
+                cost_volume = get_cost_planes(feature_maps, cams, depth_start, depth_interval, self.depth_num,
+                                              homographies=inputs.get('homographies'))
+            else:
+                cost_volume = warping_layer('warping', feature_maps, cams, depth_start
+                                            , depth_interval, self.depth_num, cost_volume_mode=self.cost_volume_mode,
+                                            depth_chunk=self.depth_chunk, homographies=inputs.get('homographies'),
+                                            dtype=self.cost_volume_dtype)
             # cost_volume = tf.get_variable('fake_cost_volume', (1, 32, 192, 128, 160))
 
             if self.regularize_type == '3DCNN':
-                # cost volume regularization
-                # regularized_cost_volume: b, d, h/4, w/4
-                regularized_cost_volume = cost_volume_regularization(cost_volume, self.bn_training, self.bn_trainable)
-                # regularized_cost_volume = simple_cost_volume_regularization(cost_volume, self.bn_training, self.bn_trainable)
-                # shape of coarse_depth: b, 1, h/4, w/4
-                # shape of prob_map: b, h/4, w/4, 1
-                # TODO: no need to pass batch_size as param, actually, it is needed, because it is needed in the graph buiding
-                coarse_depth, prob_map = soft_argmin('soft_argmin', regularized_cost_volume, depth_start, depth_end,
-                                                     self.depth_num,
-                                                     depth_interval, self.batch_size)
+                if self.cascade:
+                    # coarse_depth and prob_map of the last stage
+                    coarse_depth, prob_map, stage_losses = self._cascade_regression(
+                        feature_maps, cams, depth_start, depth_interval, depth_end, gt_depth)
+                else:
+                    # cost volume regularization
+                    # regularized_cost_volume: b, d, h/4, w/4
+                    regularized_cost_volume = cost_volume_regularization(cost_volume, self.bn_training,
+                                                                         self.bn_trainable)
+                    # regularized_cost_volume = simple_cost_volume_regularization(cost_volume, self.bn_training, self.bn_trainable)
+                    # shape of coarse_depth: b, 1, h/4, w/4
+                    # shape of prob_map: b, h/4, w/4, 1
+                    coarse_depth, prob_map = soft_argmin('soft_argmin', regularized_cost_volume, depth_start,
+                                                         depth_interval, self.depth_num)
+                    stage_losses = []
 
                 # shape of refine_depth: b, 1, h/4, w/4
                 if self.is_refine:
@@ -163,18 +326,37 @@ class MVSNet(ModelDesc):
                 coarse_depth = tf.identity(coarse_depth, 'coarse_depth')
                 refine_depth = tf.identity(refine_depth, 'refine_depth')
                 prob_map = tf.identity(prob_map, 'prob_map')
-                loss = tf.add(loss_refine / 2, loss_coarse * self.lambda_ / 2, name='loss')
+                # the stages before the last one of the cascade are supervised as well
+                loss = tf.add_n([loss_refine / 2, loss_coarse * self.lambda_ / 2] + stage_losses, name='loss')
                 less_one_accuracy = tf.identity(less_one_accuracy, name='less_one_accuracy')
                 less_three_accuracy = tf.identity(less_three_accuracy, name='less_three_accuracy')
 
             else:
-                prob_volume = gru_regularization(cost_volume, self.bn_training, self.bn_trainable)
-                loss, mae, less_one_accuracy, less_three_accuracy, coarse_depth = \
-                    mvsnet_classification_loss(
-                        prob_volume, gt_depth, self.depth_num, depth_start, depth_interval)
+                if get_current_tower_context().is_training:
+                    prob_volume = gru_regularization(cost_volume, self.bn_training, self.bn_trainable)
+                    loss, mae, less_one_accuracy, less_three_accuracy, coarse_depth = \
+                        mvsnet_classification_loss(
+                            prob_volume, gt_depth, self.depth_num, depth_start, depth_interval)
+                    # probability of the winning plane
+                    prob_map = tf.reduce_max(prob_volume, axis=1)
+                elif self.with_gt:
+                    # a single loop that keeps no volume, the cross entropy from the logit of the gt plane
+                    coarse_depth, prob_map, gt_logit, log_sum_exp = gru_winner_take_all(
+                        cost_volume, depth_start, depth_interval,
+                        gt_index=get_gt_index_image(gt_depth, depth_start, depth_interval))
+                    loss, mae, less_one_accuracy, less_three_accuracy = mvsnet_online_classification_loss(
+                        gt_logit, log_sum_exp, coarse_depth, gt_depth, self.depth_num, depth_start, depth_interval)
+                else:
+                    # gt_depth is not fed
+                    coarse_depth, prob_map = gru_winner_take_all(cost_volume, depth_start, depth_interval)
+                    loss = less_one_accuracy = less_three_accuracy = tf.constant(float('nan'))
+                # prob_map = get_propability_map(prob_volume, coarse_depth, depth_start, depth_interval)
                 coarse_depth = tf.identity(coarse_depth, 'coarse_depth')
                 refine_depth = tf.identity(coarse_depth, 'refine_depth')
-                # prob_map = get_propability_map(prob_volume, coarse_depth, depth_start, depth_interval)
+                prob_map = tf.identity(prob_map, 'prob_map')
+                loss = tf.identity(loss, name='loss')
+                less_one_accuracy = tf.identity(less_one_accuracy, name='less_one_accuracy')
+                less_three_accuracy = tf.identity(less_three_accuracy, name='less_three_accuracy')
 
             with tf.variable_scope('summaries'):
                 with tf.device('/cpu:0'):
@@ -183,8 +365,7 @@ class MVSNet(ModelDesc):
                     else:
                         add_moving_summary(loss, less_one_accuracy, less_three_accuracy)
 
-                if self.regularize_type == '3DCNN':
-                    add_image_summary(prob_map, name='prob_map')
+                add_image_summary(prob_map, name='prob_map')
                 add_image_summary(coarse_depth
                                   , name='coarse_depth')
                 add_image_summary(refine_depth
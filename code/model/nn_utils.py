@@ -4,8 +4,14 @@ from upsample_utils import TFBilinearUpSample
 import tensorflow as tf
 from tensorpack.utils import logger
 from tensorpack.tfutils.collection import *
+import numpy as np
 
 
+COST_VOLUME_MODES = ['batched', 'loop', 'chunked', 'streamed']
+FEATURE_VIEW_MODES = ['batched', 'per_view']
+# dtypes the cost volume and the skip tensors of its regularization can be stored in, all layers compute in float32
+COST_VOLUME_DTYPES = ['float32', 'float16', 'bfloat16']
+
 # __all__ = ['feature_extraction_net', 'warping_layer', 'cost_volume_regularization', 'soft_argmin', 'depth_refinement',
 #            ]
 
@@ -102,13 +108,17 @@ def unet_feature_extraction_branch(img):
             return feature_map
 
 
-def feature_extraction_net(imgs, branch_function):
+def feature_extraction_net(imgs, branch_function, feature_views='batched'):
     """
     feature extraction net
     Take care of variable_scope's reuse param!
     :param imgs: shape: b, view_num, c, h, w
+    :param feature_views: 'batched' runs the branch once on all b * view_num images, 'per_view' once per view.
+    Both create the same variables, with the gn based unet branch the results are identical. With the bn based
+    uni branch, training mode normalizes over all views at once instead of view by view
     :return: feature_maps: shape: view_num, batch, c, h, w
     """
+    assert feature_views in FEATURE_VIEW_MODES, feature_views
 
     feature_maps = []
     _, view_num, c, h, w = imgs.get_shape().as_list()
@@ -117,6 +127,13 @@ def feature_extraction_net(imgs, branch_function):
         reuse_flag = False
     else:
         reuse_flag = True
+    if feature_views == 'batched':
+        _, view_num, h, w, c = imgs.get_shape().as_list()
+        with tf.variable_scope('feature_extraction_net', reuse=reuse_flag):
+            # shape: b * view_num, h, w, c
+            feature_map = branch_function(tf.reshape(imgs, [-1, h, w, c]))
+        _, feature_h, feature_w, feature_c = feature_map.get_shape().as_list()
+        return tf.reshape(feature_map, [-1, view_num, feature_h, feature_w, feature_c], name='feature_maps')
     with tf.variable_scope('feature_extraction_net', reuse=reuse_flag):
         # ref view
         feature_map = branch_function(imgs[:, 0])
@@ -130,16 +147,62 @@ def feature_extraction_net(imgs, branch_function):
     return feature_maps  # shape: batch, view_num, c, h, w
 
 
+def get_view_homographies(cams, depth_start, depth_interval, depth_num, homographies=None):
+    """
+    homographies of all src views to the depth planes of the ref view
+    :param cams: shape: b, view_num, 2, 4, 4
+    :param homographies: optional homographies computed by the dataflow (get_view_homographies_np),
+    shape: b, view_num - 1, depth_num, 3, 3
+    :return: view_num - 1 homographies of shape (b, depth_num, 3, 3)
+    """
+    _, view_num, *_ = cams.get_shape().as_list()
+    if homographies is not None:
+        # precomputed by the dataflow
+        return [homographies[:, view - 1] for view in range(1, view_num)]
+    ref_cam = cams[:, 0]
+    view_homographies = []
+    for view in range(1, view_num):
+        # view_cam = cams[:, view]
+        view_cam = tf.squeeze(tf.slice(cams, [0, view, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
+        view_homography = get_homographies(ref_cam, view_cam, depth_num=depth_num, depth_start=depth_start,
+                                           depth_interval=depth_interval)
+        view_homographies.append(view_homography)
+    return view_homographies
+
+
+def get_cost_planes(feature_maps, cams, depth_start, depth_interval, depth_num, homographies=None):
+    """
+    the cost of warping_layer as CostPlanes, built plane by plane where they are used
+    only the homographies are built here
+    """
+    with tf.variable_scope('warping_layer'):
+        view_homographies = get_view_homographies(cams, depth_start, depth_interval, depth_num, homographies)
+    return CostPlanes(view_homographies, feature_maps, depth_num)
+
+
 @layer_register(log_shape=True, use_scope=True)
-def warping_layer(feature_maps, cams, depth_start, depth_interval, depth_num):
+def warping_layer(feature_maps, cams, depth_start, depth_interval, depth_num, cost_volume_mode='batched',
+                  depth_chunk=32, homographies=None, dtype='float32'):
     """
     :param feature_maps: feature maps output from feature_extraction_net, shape: b, view_num, c, h, w
     :param cams: Cams, shape: b, view_num
     :param depth_start: TODO
     :param depth_interval: TODO
     :param depth_num: num of discrete depth value
+    :param cost_volume_mode: 'batched' warps all depth planes of a view at once (build_cost_volume_batched),
+    'loop' warps them one by one (build_cost_volume), 'chunked' fills the volume depth_chunk planes at a time in
+    a tf.while_loop to bound the memory (build_cost_volume_chunked)
+    :param depth_chunk: num of depth planes per iteration of the 'chunked' mode
+    :param homographies: optional homographies computed by the dataflow (get_view_homographies_np),
+    shape: b, view_num - 1, depth_num, 3, 3, the graph computes them from the cams otherwise
+    :param dtype: one of COST_VOLUME_DTYPES, the cost is computed in float32 and stored in dtype: plane by plane in
+    the 'loop' mode, chunk by chunk in the 'chunked' mode, which writes the chunks into a preallocated volume at
+    inference. The 'batched' mode accumulates whole float32 volumes and casts the result
     :return: cost volume
     """
+    assert cost_volume_mode in COST_VOLUME_MODES, cost_volume_mode
+    assert dtype in COST_VOLUME_DTYPES, dtype
+    assert cost_volume_mode != 'streamed', 'the streamed cost is built plane by plane, see get_cost_planes'
     with tf.variable_scope('warping_layer'):
         _, view_num, c, h, w = feature_maps.get_shape().as_list()
         _, view_num, h, w, c = feature_maps.get_shape().as_list()
@@ -147,26 +210,72 @@ def warping_layer(feature_maps, cams, depth_start, depth_interval, depth_num):
         _, cam_num, *_ = cams.get_shape().as_list()
         assert view_num == cam_num, 'view num: {} conflicts with cam num: {}'.format(view_num, cam_num)
         
-        # ref image and ref cam
-        ref_cam = cams[:, 0]
+        # ref image
         ref_feature_map = feature_maps[:, 0]
         
         # get homographies of all views
-        view_homographies = []
-        for view in range(1, view_num):
-            # view_cam = cams[:, view]
-            view_cam = tf.squeeze(tf.slice(cams, [0, view, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
-            homographies = get_homographies(ref_cam, view_cam, depth_num=depth_num, depth_start=depth_start,
-                                                    depth_interval=depth_interval)
-            view_homographies.append(homographies)
-        
+        view_homographies = get_view_homographies(cams, depth_start, depth_interval, depth_num, homographies)
+
         # shape of feature_map: b, h, w, c
         # shape of cost_volume: b, depth_num, h, w, c
-        cost_volume = build_cost_volume(view_homographies, feature_maps, depth_num)
+        if cost_volume_mode == 'batched':
+            cost_volume = build_cost_volume_batched(view_homographies, feature_maps, depth_num)
+        elif cost_volume_mode == 'chunked':
+            # the in place writes of the preallocated volume have no gradient
+            cost_volume = build_cost_volume_chunked(view_homographies, feature_maps, depth_num, depth_chunk,
+                                                    dtype=tf.as_dtype(dtype),
+                                                    preallocate=not get_current_tower_context().is_training)
+        else:
+            cost_volume = build_cost_volume(view_homographies, feature_maps, depth_num, dtype=tf.as_dtype(dtype))
+        cost_volume = tf.cast(cost_volume, dtype)
 
     return cost_volume
 
 
+def get_cascade_hypotheses(depth_map, depth_start, depth_end, depth_interval, depth_num):
+    """
+    per pixel depth hypotheses of a cascade stage, depth_num planes depth_interval apart centered on the depth
+    estimated by the previous stage, shifted to stay within depth_start, depth_end (depth_start wins when the planes
+    span more than the range)
+    no gradient flows back to the previous stage through the hypotheses
+    :param depth_map: shape: b, h, w, 1
+    :param depth_start: shape: b
+    :param depth_end: shape: b
+    :param depth_interval: shape: b
+    :return: depth_hypotheses: b, d, h, w, hypotheses_start: b, h, w, 1
+    """
+    depth_map = tf.stop_gradient(depth_map)
+    depth_start = tf.reshape(depth_start, [-1, 1, 1, 1])
+    depth_end = tf.reshape(depth_end, [-1, 1, 1, 1])
+    depth_interval = tf.reshape(depth_interval, [-1, 1, 1, 1])
+    hypotheses_start = tf.minimum(depth_map - depth_num / 2 * depth_interval,
+                                  depth_end - (depth_num - 1) * depth_interval)
+    hypotheses_start = tf.maximum(hypotheses_start, depth_start)
+    depth_index = tf.reshape(tf.cast(tf.range(depth_num), tf.float32), [1, -1, 1, 1])
+    depth_hypotheses = tf.transpose(hypotheses_start, [0, 3, 1, 2]) + depth_interval * depth_index
+    return depth_hypotheses, hypotheses_start
+
+
+@layer_register(log_shape=True, use_scope=True)
+def hypotheses_warping_layer(ref_feature_map, src_feature_maps, cams, depth_hypotheses, dtype='float32'):
+    """
+    warping_layer over per pixel depth hypotheses, see build_cost_volume_hypotheses
+    :param ref_feature_map: shape: b, h, w, c
+    :param src_feature_maps: shape: b, view_num - 1, src_h, src_w, c
+    :param cams: shape: b, view_num, 2, 4, 4
+    :param depth_hypotheses: shape: b, d, h, w
+    :param dtype: one of COST_VOLUME_DTYPES
+    :return: cost volume, shape: b, d, h, w, c
+    """
+    assert dtype in COST_VOLUME_DTYPES, dtype
+    with tf.variable_scope('warping_layer'):
+        _, view_num, *_ = cams.get_shape().as_list()
+        view_terms = [get_homography_terms(cams[:, 0], cams[:, view]) for view in range(1, view_num)]
+        cost_volume = build_cost_volume_hypotheses(view_terms, ref_feature_map, src_feature_maps, depth_hypotheses)
+        cost_volume = tf.cast(cost_volume, dtype)
+    return cost_volume
+
+
 def simple_cost_volume_regularization(cost_volume, training, trainable):
     with argscope([tf.layers.conv3d], use_bias=False, kernel_initializer=tf.glorot_uniform_initializer(),
                   kernel_regularizer=tf.contrib.layers.l2_regularizer(1.0), padding='same'), \
@@ -190,6 +299,20 @@ def simple_cost_volume_regularization(cost_volume, training, trainable):
 
 
 def cost_volume_regularization(cost_volume, training, trainable):
+    """
+    3D U-Net over the cost volume
+    the convs compute in float32. If the cost volume is stored in a lower precision dtype (COST_VOLUME_DTYPES),
+    the skip tensors, which stay alive until the decoder, are stored in that dtype as well
+    :param cost_volume: b, d, h, w, c
+    :return: regularized_cost_volume: b, d, h, w
+    """
+    storage_dtype = cost_volume.dtype
+
+    def _store(x):
+        return tf.cast(x, storage_dtype)
+
+    def _compute(x):
+        return tf.cast(x, tf.float32)
 
     with argscope([tf.layers.conv3d], use_bias=False, kernel_initializer=tf.glorot_uniform_initializer(),
                   kernel_regularizer=tf.contrib.layers.l2_regularizer(1.0), padding='same'), \
@@ -199,25 +322,26 @@ def cost_volume_regularization(cost_volume, training, trainable):
         base_filter = 8
         with tf.variable_scope('cost_volume_regularization'):
             with rename_tflayer_get_variable():
-                l1_0 = conv3d_bn_relu(cost_volume, base_filter*2, 3, strides=2, training=training, trainable=trainable,
-                                            name='3dconv1_0')
+                l1_0 = conv3d_bn_relu(_compute(cost_volume), base_filter*2, 3, strides=2, training=training,
+                                      trainable=trainable, name='3dconv1_0')
 
                 # l1_0 = tf.layers.conv3d(cost_volume, base_filter * 2, 3, strides=2, activation=None, name='3dconv1_0')
                 # l1_0 = tf.layers.batch_normalization(l1_0, training=training, trainable=trainable, reuse=None, name='3dconv1_0_bn')
 
                 # skip1_0 = tf.layers.conv3d(l1_0, base_filter * 2, 3, strides=1, activation=None, name='3dconv1_1')
-                skip1_0 = conv3d_bn_relu(l1_0, base_filter*2, 3, 1, training, trainable, '3dconv1_1')
+                skip1_0 = _store(conv3d_bn_relu(l1_0, base_filter*2, 3, 1, training, trainable, '3dconv1_1'))
 
                 l2_0 = conv3d_bn_relu(l1_0, base_filter*4, 3, 2, training, trainable, '3dconv2_0')
                 # l2_0 = tf.layers.conv3d(l1_0, base_filter * 4, 3, strides=2, activation=BNReLU, name='3dconv2_0')
                 # skip2_0 = tf.layers.conv3d(l2_0, base_filter * 4, 3, strides=1, activation=None, name='3dconv2_1')
-                skip2_0 = conv3d_bn_relu(l2_0, base_filter*4, 3, 1, training, trainable, '3dconv2_1')
+                skip2_0 = _store(conv3d_bn_relu(l2_0, base_filter*4, 3, 1, training, trainable, '3dconv2_1'))
 
                 # l3_0 = tf.layers.conv3d(l2_0, base_filter * 8, 3, strides=2, activation=BNReLU, name='3dconv3_0')
                 l3_0 = conv3d_bn_relu(l2_0, base_filter*8, 3, 2, training, trainable, '3dconv3_0')
                 
                 # l0_1 = tf.layers.conv3d(cost_volume, base_filter, 3, strides=1, activation=BNReLU, name='3dconv0_1')
-                l0_1 = conv3d_bn_relu(cost_volume, base_filter, 3, 1, training, trainable, name='3dconv0_1')
+                l0_1 = _store(conv3d_bn_relu(_compute(cost_volume), base_filter, 3, 1, training, trainable,
+                                             name='3dconv0_1'))
                 
                 # l3_1 = tf.layers.conv3d(l3_0, base_filter * 8, 3, strides=1, activation=BNReLU, name='3dconv3_1')
                 l3_1 = conv3d_bn_relu(l3_0, base_filter*8, 3, 1, training, trainable, name='3dconv3_1')
@@ -225,15 +349,15 @@ def cost_volume_regularization(cost_volume, training, trainable):
                 l4_0 = deconv3d_bn_relu(l3_1, base_filter*4, 3, 2, training, trainable, name='3dconv4_0')
 
                 
-                l4_1 = tf.add(l4_0, skip2_0, name='3dconv4_1')
+                l4_1 = tf.add(l4_0, _compute(skip2_0), name='3dconv4_1')
                 # l5_0 = tf.layers.conv3d_transpose(l4_1, base_filter * 2, 3, strides=2, activation=BNReLU, name='3dconv5_0')
                 l5_0 = deconv3d_bn_relu(l4_1, base_filter*2, 3, 2, training, trainable, name='3dconv5_0')
                 
-                l5_1 = tf.add(l5_0, skip1_0, name='3dconv5_1')
+                l5_1 = tf.add(l5_0, _compute(skip1_0), name='3dconv5_1')
                 # l6_0 = tf.layers.conv3d_transpose(l5_1, base_filter, 3, strides=2, name='3dconv6_0')
                 l6_0 = deconv3d_bn_relu(l5_1, base_filter, 3, 2, training, trainable, name='3dconv6_0')
                 
-                l6_1 = tf.add(l6_0, l0_1, name='3dconv6_1')
+                l6_1 = tf.add(l6_0, _compute(l0_1), name='3dconv6_1')
                 
                 # shape of l6_2: b, 1, d, h, w
                 l6_2 = tf.layers.conv3d(l6_1, 1, 3, strides=1, activation=None, name='3dconv6_2')
@@ -246,7 +370,16 @@ def cost_volume_regularization(cost_volume, training, trainable):
     return regularized_cost_volume
 
 
-def gru_regularization(cost_volume, training, trainable):
+def gru_depth_loop(cost_volume, step_func, init_func):
+    """
+    steps the 3 ConvGRU layers and the prob conv of gru_regularization through the depth planes in a
+    tf.while_loop, so the graph does not grow with the depth num and only the states of one plane are alive
+    :param cost_volume: b, d, h, w, c, or CostPlanes, then the cost volume is never built either
+    :param step_func: function (d, logit, *values) -> values, called on the logit (b, h, w, 1) of every plane d
+    :param init_func: function of the shape of a logit (b, h, w, 1) and the depth num to the initial values of
+    step_func, tensors or TensorArrays
+    :return: the values after the last plane
+    """
     with argscope([tf.layers.conv2d], use_bias=False, kernel_initializer=tf.glorot_uniform_initializer(),
                   kernel_regularizer=tf.contrib.layers.l2_regularizer(1.0), padding='same'), \
          argscope([tf.layers.batch_normalization], epsilon=1e-5, momentum=0.99):
@@ -255,10 +388,15 @@ def gru_regularization(cost_volume, training, trainable):
                 gru1_filters = 16
                 gru2_filters = 4
                 gru3_filters = 2
-                # b, d, h, w, c
-                cost_volume_shape = tf.shape(cost_volume)
-                batch = cost_volume_shape[0]
-                _, d, h, w, c = cost_volume.get_shape().as_list()
+                if isinstance(cost_volume, CostPlanes):
+                    cost_planes = cost_volume
+                    batch, h, w, c = cost_planes.shape
+                    d = cost_planes.depth_num
+                else:
+                    # b, d, h, w, c, the planes are computed on in float32
+                    cost_planes = lambda depth: tf.cast(tf.gather(cost_volume, depth, axis=1), tf.float32)
+                    batch = tf.shape(cost_volume)[0]
+                    _, d, h, w, c = cost_volume.get_shape().as_list()
                 gru_input_shape = [h, w]
                 state1 = tf.zeros([batch, h, w, gru1_filters])
                 state2 = tf.zeros([batch, h, w, gru2_filters])
@@ -266,24 +404,85 @@ def gru_regularization(cost_volume, training, trainable):
                 conv_gru1 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru1_filters)
                 conv_gru2 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru2_filters)
                 conv_gru3 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru3_filters)
-                
-                seperate_cost_volumes = tf.split(cost_volume, d, axis=1)
-                depth_costs = []
-                for single_cost_volume in seperate_cost_volumes:
+
+                def _body(depth, state1, state2, state3, *values):
                     # b, h, w, c
+                    single_cost_volume = cost_planes(depth)
                     # gru
-                    single_cost_volume = tf.squeeze(single_cost_volume, axis=1)
                     reg_cost1, state1 = conv_gru1(-single_cost_volume, state1, scope='conv_gru1')
                     reg_cost2, state2 = conv_gru2(reg_cost1, state2, scope='conv_gru2')
                     reg_cost3, state3 = conv_gru3(reg_cost2, state3, scope='conv_gru3')
                     # reg_cost: b, h, w, 1
                     reg_cost = tf.layers.conv2d(
                         reg_cost3, 1, 3, padding='same', reuse=tf.AUTO_REUSE, name='prob_conv', use_bias=True)
-                    depth_costs.append(reg_cost)
-                # prob_volume: b, d, h, w, 1
-                prob_volume = tf.stack(depth_costs, axis=1)
-                prob_volume = tf.nn.softmax(prob_volume, axis=1, name='prob_volume')
-                return prob_volume
+                    return [depth + 1, state1, state2, state3] + list(step_func(depth, reg_cost, *values))
+
+                init_values = list(init_func([batch, h, w, 1], d))
+                loop_values = tf.while_loop(lambda depth, *_: depth < d, _body,
+                                            [tf.constant(0), state1, state2, state3] + init_values,
+                                            parallel_iterations=1, swap_memory=True)
+                return loop_values[4:]
+
+
+def online_log_sum_exp(max_logit, sum_exp, logit):
+    """
+    one step of a running log-sum-exp, log_sum_exp = max_logit + log(sum_exp)
+    :return: max_logit, sum_exp including logit
+    """
+    new_max_logit = tf.maximum(max_logit, logit)
+    sum_exp = sum_exp * tf.exp(max_logit - new_max_logit) + tf.exp(logit - new_max_logit)
+    return new_max_logit, sum_exp
+
+
+def gru_regularization(cost_volume, training, trainable):
+    """
+    ConvGRU regularization, see gru_depth_loop. The logits of all planes are kept for the probability volume,
+    gru_winner_take_all is the inference without it, in O(h * w) memory
+    :param cost_volume: b, d, h, w, c, or CostPlanes
+    :return: prob_volume: b, d, h, w, 1
+    """
+    # logits of the planes, depth first
+    logits, = gru_depth_loop(cost_volume, lambda d, logit, logits: [logits.write(d, logit)],
+                             lambda shape, d: [tf.TensorArray(tf.float32, size=d,
+                                                              element_shape=tf.TensorShape([None, None, None, 1]))])
+    # prob_volume: b, d, h, w, 1
+    prob_volume = tf.transpose(logits.stack(), [1, 0, 2, 3, 4])
+    return tf.nn.softmax(prob_volume, axis=1, name='prob_volume')
+
+
+def gru_winner_take_all(cost_volume, depth_start, depth_interval, gt_index=None):
+    """
+    inference of the GRU regularization without the probability volume: per pixel, the running max logit, the
+    index of its plane and the running log-sum-exp are kept while stepping through the planes, in O(h * w) memory
+    :param cost_volume: b, d, h, w, c, or CostPlanes
+    :param depth_start: shape: b
+    :param depth_interval: shape: b
+    :param gt_index: optional index of the gt plane (get_gt_index_image), shape: b, h, w, 1, the logit of that
+    plane is then kept as well for the cross entropy (mvsnet_online_classification_loss)
+    :return: wta_depth_map: b, h, w, 1, depth of the most probable plane, the first one on ties like tf.argmax
+    prob_map: b, h, w, 1, its probability
+    with gt_index, gt_logit and log_sum_exp: b, h, w, 1
+    """
+    def _step(d, logit, max_logit, max_index, sum_exp, *gt_logit):
+        max_index = tf.where(logit > max_logit, tf.fill(tf.shape(max_index), d), max_index)
+        max_logit, sum_exp = online_log_sum_exp(max_logit, sum_exp, logit)
+        if gt_index is not None:
+            gt_logit = [tf.where(tf.equal(gt_index, d), logit, gt_logit[0])]
+        return [max_logit, max_index, sum_exp] + list(gt_logit)
+
+    def _init(shape, d):
+        values = [tf.fill(shape, -np.inf), tf.zeros(shape, tf.int32), tf.zeros(shape)]
+        return values if gt_index is None else values + [tf.zeros(shape)]
+
+    max_logit, max_index, sum_exp, *gt_logit = gru_depth_loop(cost_volume, _step, _init)
+    start_mat = tf.reshape(depth_start, [-1, 1, 1, 1])
+    interval_mat = tf.reshape(depth_interval, [-1, 1, 1, 1])
+    wta_depth_map = tf.cast(max_index, tf.float32) * interval_mat + start_mat
+    # exp(max_logit - log_sum_exp)
+    prob_map = tf.reciprocal(sum_exp)
+    if gt_index is None:
+        return wta_depth_map, prob_map
+    return wta_depth_map, prob_map, gt_logit[0], max_logit + tf.log(sum_exp)
 
 
 # @layer_register(use_scope=True)
@@ -309,33 +508,48 @@ def deconv3d_bn_relu(inputs, filters, kernel_size, strides, training, trainable,
 
 
 @layer_register(log_shape=True)
-def soft_argmin(regularized_cost_volume, depth_start, depth_end, depth_num, depth_interval, batch_size):
+def soft_argmin(regularized_cost_volume, depth_start, depth_interval, depth_num):
+    """
+    depth regression, the expected depth under the softmax of the negated cost over the depth planes.
+    The depth planes of the samples are broadcast from one depth index vector, so the batch size is dynamic
+    :param regularized_cost_volume: shape: b, d, h, w
+    :param depth_start: shape: b
+    :param depth_interval: shape: b
+    :return: estimated_depth_map: b, h, w, 1, prob_map: b, h, w, 1
+    """
     with tf.variable_scope('soft_argmin'):
-        # batch_size =
         # b, d, h, w
         probability_volume = tf.nn.softmax(
             tf.scalar_mul(-1, regularized_cost_volume), axis=1, name='prob_volume')
-        volume_shape = tf.shape(probability_volume)
-        # batch_size = volume_shape[0]
-        soft_2d = []
-        for i in range(batch_size):
-            # shape of 1d: (depth_num, )
-            soft_1d = tf.linspace(depth_start[i], depth_end[i], tf.cast(depth_num, tf.int32))
-            # shape of 2d: (batch_size, depth_num)
-            soft_2d.append(soft_1d)
-        # shape of 2d: (b, d, 1, 1)
-        soft_2d = tf.reshape(tf.stack(soft_2d, axis=0), [volume_shape[0], volume_shape[1], 1, 1])
-        soft_4d = tf.tile(soft_2d, [1, 1, volume_shape[2], volume_shape[3]])
-        # shape: (b, 1, h, w)
-        estimated_depth_map = tf.reduce_sum(soft_4d * probability_volume, axis=1, name='coarse_depth')
-        # # shape: (b, 1, h, w)
-        # estimated_depth_map = tf.expand_dims(estimated_depth_map, axis=1)
+        # shape: b, d, 1, 1
+        depth_values = get_depth_values(depth_start, depth_interval, depth_num)[:, :, tf.newaxis, tf.newaxis]
+        # shape: (b, h, w)
+        estimated_depth_map = tf.reduce_sum(depth_values * probability_volume, axis=1, name='coarse_depth')
         # shape of prob_map: b, h, w, 1
         estimated_depth_map = tf.expand_dims(estimated_depth_map, axis=3)
         prob_map = get_propability_map(probability_volume, estimated_depth_map, depth_start, depth_interval)
     return estimated_depth_map, prob_map
 
 
+@layer_register(log_shape=True)
+def soft_argmin_hypotheses(regularized_cost_volume, depth_hypotheses, hypotheses_start, depth_interval):
+    """
+    soft_argmin over per pixel depth hypotheses (see get_cascade_hypotheses)
+    :param regularized_cost_volume: shape: b, d, h, w
+    :param depth_hypotheses: shape: b, d, h, w
+    :param hypotheses_start: shape: b, h, w, 1
+    :param depth_interval: shape: b
+    :return: estimated_depth_map: b, h, w, 1, prob_map: b, h, w, 1
+    """
+    with tf.variable_scope('soft_argmin'):
+        probability_volume = tf.nn.softmax(
+            tf.scalar_mul(-1, regularized_cost_volume), axis=1, name='prob_volume')
+        estimated_depth_map = tf.reduce_sum(depth_hypotheses * probability_volume, axis=1, name='coarse_depth')
+        estimated_depth_map = tf.expand_dims(estimated_depth_map, axis=3)
+        prob_map = get_propability_map(probability_volume, estimated_depth_map, hypotheses_start, depth_interval)
+    return estimated_depth_map, prob_map
+
+
 def depth_refinement(coarse_depth, img, depth_start, depth_end):
     """
     get refine depth from coarse depth
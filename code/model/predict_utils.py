@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# File: predict_utils.py
+
+"""
+Test time predictors.
+
+In a test scene every image is the ref view of one sample and a src view of up to view_num - 1 others, so running
+the whole net per sample extracts the features of each image about view_num times. FeatureCachePredictor runs
+the net in two stages (see MVSNet's stage param): the features of an image are extracted once per scene, kept in
+an LRU cache under a memory budget, and the samples are assembled from the cached feature maps.
+
+With an adaptive num of depth planes (see adapt_depth_num) or images of several resolutions (see
+closest_bucket) the graph differs per sample, BucketPredictor keeps one predictor per (height, width, depth_num,
+view_num) bucket.
+
+FrozenPredictor runs a graph written by export_frozen_graph, its cold start is a single graph import.
+
+TiledPredictor runs the depth stage tile by tile over the ref view, so that its memory is bounded by the tile
+rather than the image. The tile shape is chosen from a memory budget (choose_tile_shape).
+"""
+
+import math
+import time
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+from tensorpack.utils import logger
+from DataManager import LRUCache
+from export_utils import load_frozen_graph
+
+__all__ = ['FeatureCachePredictor', 'BucketPredictor', 'FrozenPredictor', 'TiledPredictor', 'sample_bucket',
+           'choose_tile_shape']
+
+# float32 volumes of the feature channels alive per voxel at the peak of the tile stage: the 4 bilinear reads of a
+# src view, the sum, the sum of squares, the warped view and its square
+TILE_VOLUMES = 8
+# tiles are a multiple of it in feature pixels, the 3 stride 2 levels of the 3DCNN regularization halve them
+TILE_ALIGN = 8
+
+
+class FeatureCachePredictor(object):
+    """
+    predicts a test sample with a 'feature' stage predictor and a 'depth' stage predictor
+    the cache is emptied when the scene changes, as the image file names are only unique in a scene
+    """
+
+    def __init__(self, feature_func, depth_func, max_bytes):
+        """
+        :param feature_func: predictor of the 'feature' stage, imgs (b, h, w, 3) -> [image_features]
+        :param depth_func: predictor of the 'depth' stage, its inputs in the order of
+        MVSNet.get_predict_input_names
+        :param max_bytes: budget of the cached feature maps
+        """
+        self.feature_func = feature_func
+        self.depth_func = depth_func
+        self.cache = LRUCache(max_bytes)
+        self.scene = None
+        self.extracted_num = 0
+        self.view_num = 0
+
+    def __call__(self, meta, dp):
+        """
+        :param meta: meta of the sample, see DTU.make_test_dataset
+        :param dp: imgs, cams and optionally the homographies of one sample
+        :return: the outputs of depth_func, with a batch dim of 1
+        """
+        if meta['scene'] != self.scene:
+            self.finish_scene()
+            self.scene = meta['scene']
+        imgs = dp[0]
+        # an image is cropped to the resolution of the bucket of the sample
+        views = [(image_name, imgs.shape[1:3]) for image_name in meta['views']]
+        feature_maps = [None] * len(views)
+        missing = []
+        for view, image_key in enumerate(views):
+            if image_key in self.cache:
+                feature_maps[view] = self.cache.get(image_key, None)
+            else:
+                missing.append(view)
+        if missing:
+            # one batch for all the views that are not cached
+            features, = self.feature_func(imgs[missing])
+            for view, feature_map in zip(missing, features):
+                feature_maps[view] = feature_map
+                self.cache.put(views[view], feature_map)
+        self.extracted_num += len(missing)
+        self.view_num += len(views)
+        inputs = [imgs[None, :1], np.stack(feature_maps)[None]]
+        inputs.extend(np.expand_dims(component, 0) for component in dp[1:])
+        return self.depth_func(*inputs)
+
+    def finish_scene(self):
+        """ log the saving of the current scene and empty the cache """
+        if self.scene is not None and self.extracted_num > 0:
+            logger.info('scene {}: features of {} images extracted for {} views, {:.2f}x less'.format(
+                self.scene, self.extracted_num, self.view_num, self.view_num / self.extracted_num))
+        self.cache.clear()
+        self.extracted_num = 0
+        self.view_num = 0
+
+
+def sample_bucket(imgs, cams, depth_num=None):
+    """
+    bucket of the inputs of a sample, (height, width, depth_num, view_num)
+    :param imgs: shape: 1, view_num or 1, height, width, 3
+    :param cams: shape: 1, view_num, 2, 4, 4
+    :param depth_num: the depth num of the ref cam (see adapt_depth_num) if None
+    """
+    return imgs.shape[-3], imgs.shape[-2], depth_num or int(round(cams[0, 0, 1, 3, 2])), cams.shape[1]
+
+
+def close_predictor(predictor):
+    """ close the session of an OfflinePredictor or of a predictor of this module """
+    if hasattr(predictor, 'close'):
+        predictor.close()
+    elif getattr(predictor, 'sess', None) is not None:
+        predictor.sess.close()
+
+
+class BucketPredictor(object):
+    """
+    dispatches the inputs to the predictor of their bucket, e.g. the sample_bucket of the samples of a test set of
+    mixed resolutions and depth nums. The predictors are built on the first inputs that need them and the
+    max_predictors last used ones are kept
+    """
+
+    def __init__(self, build_func, key_func, max_predictors=4):
+        """
+        :param build_func: *bucket -> predictor
+        :param key_func: *inputs -> bucket, a tuple
+        """
+        self.build_func = build_func
+        self.key_func = key_func
+        self.max_predictors = max_predictors
+        self.predictors = OrderedDict()
+
+    def __call__(self, *inputs):
+        bucket = tuple(self.key_func(*inputs))
+        if bucket in self.predictors:
+            self.predictors.move_to_end(bucket)
+        else:
+            while self.predictors and len(self.predictors) >= self.max_predictors:
+                evicted_bucket, evicted = self.predictors.popitem(last=False)
+                logger.info('evicted the predictor of bucket {}'.format(evicted_bucket))
+                close_predictor(evicted)
+            logger.info('building the predictor of bucket {}'.format(bucket))
+            self.predictors[bucket] = self.build_func(*bucket)
+        return self.predictors[bucket](*inputs)
+
+    def close(self):
+        for predictor in self.predictors.values():
+            close_predictor(predictor)
+        self.predictors.clear()
+
+
+class FrozenPredictor(object):
+    """ predictor of a frozen graph of export_frozen_graph, called like an OfflinePredictor """
+
+    def __init__(self, graph_path, input_names, output_names, config=None):
+        """
+        :param input_names: names of the inputs, in the order of the call, e.g. MVSNet.get_predict_input_names
+        :param output_names: names of the outputs, e.g. FROZEN_OUTPUT_NAMES
+        """
+        start = time.perf_counter()
+        self.graph = load_frozen_graph(graph_path)
+        self.input_tensors = [self.graph.get_tensor_by_name(name + ':0') for name in input_names]
+        self.output_tensors = [self.graph.get_tensor_by_name(name + ':0') for name in output_names]
+        self.sess = tf.Session(graph=self.graph, config=config)
+        logger.info('frozen graph {} loaded in {:.2f}s'.format(graph_path, time.perf_counter() - start))
+
+    def __call__(self, *inputs):
+        return self.sess.run(self.output_tensors, dict(zip(self.input_tensors, inputs)))
+
+    def close(self):
+        self.sess.close()
+
+
+def choose_tile_shape(max_bytes, depth_num, height, width, view_num, channels):
+    """
+    the largest, as square as possible, tile of the ref feature map whose depth stage fits in max_bytes, estimated
+    as TILE_VOLUMES float32 volumes of channels per voxel of the tile plus the whole src feature maps
+    :param height: height of the feature maps
+    :param width: width of the feature maps
+    :return: tile height, tile width in feature pixels, a multiple of TILE_ALIGN or the whole side
+    """
+    voxel_bytes = TILE_VOLUMES * channels * 4 * depth_num
+    src_bytes = (view_num - 1) * height * width * channels * 4
+    pixel_num = max(max_bytes - src_bytes, 0) // voxel_bytes
+    side = max(int(math.sqrt(pixel_num)) // TILE_ALIGN * TILE_ALIGN, TILE_ALIGN)
+    tile_h = min(side, height)
+    tile_w = min(max(pixel_num // tile_h // TILE_ALIGN * TILE_ALIGN, TILE_ALIGN), width)
+    if tile_h * tile_w > pixel_num:
+        logger.warn('the smallest tile {}x{} exceeds the memory budget'.format(tile_h, tile_w))
+    return tile_h, tile_w
+
+
+def tile_starts(size, tile, overlap):
+    """ starts of the tiles that cover [0, size), at least overlap apart, the last one ends at size """
+    if tile >= size:
+        return [0]
+    step = max(tile - overlap, 1)
+    return list(range(0, size - tile, step)) + [size - tile]
+
+
+def feather_weights(start, tile, size, overlap):
+    """ blending weights of a tile along one axis, ramping up over overlap pixels at the sides inside the image """
+    weights = np.ones(tile, dtype=np.float32)
+    ramp = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+    ramp = ramp[:tile]
+    if start > 0:
+        weights[:len(ramp)] = np.minimum(weights[:len(ramp)], ramp)
+    if start + tile < size:
+        weights[tile - len(ramp):] = np.minimum(weights[tile - len(ramp):], ramp[::-1])
+    return weights
+
+
+class TiledPredictor(object):
+    """
+    a predictor of the 'depth' stage that runs a 'tile' stage predictor on overlapping tiles of the ref feature
+    map, each against the whole src feature maps, and blends the outputs of the tiles with feathered weights
+    """
+
+    def __init__(self, tile_func, tile_shape, overlap):
+        """
+        :param tile_func: predictor of the 'tile' stage, imgs, ref_features, src_features, cams ->
+        prob_map, coarse_depth, refine_depth
+        :param tile_shape: tile height, tile width in feature pixels, see choose_tile_shape
+        :param overlap: min overlap of the tiles in feature pixels
+        """
+        self.tile_func = tile_func
+        self.tile_shape = tile_shape
+        self.overlap = overlap
+
+    def __call__(self, imgs, feature_maps, cams):
+        """
+        inputs of the 'depth' stage, of a batch of 1, the cams at the resolution of the feature maps
+        :return: prob_map, coarse_depth, refine_depth, shape: 1, h, w, 1
+        """
+        _, _, height, width, _ = feature_maps.shape
+        tile_h, tile_w = min(self.tile_shape[0], height), min(self.tile_shape[1], width)
+        scale = imgs.shape[2] // height
+        outputs = None
+        weight_sum = np.zeros((height, width, 1), dtype=np.float32)
+        for y in tile_starts(height, tile_h, self.overlap):
+            for x in tile_starts(width, tile_w, self.overlap):
+                tile_cams = cams.copy()
+                # principal point of the tile
+                tile_cams[0, 0, 1, 0, 2] -= x
+                tile_cams[0, 0, 1, 1, 2] -= y
+                tile_outputs = self.tile_func(
+                    imgs[:, :, y * scale:(y + tile_h) * scale, x * scale:(x + tile_w) * scale],
+                    feature_maps[:, 0, y:y + tile_h, x:x + tile_w], feature_maps[:, 1:], tile_cams)
+                weights = np.outer(feather_weights(y, tile_h, height, self.overlap),
+                                   feather_weights(x, tile_w, width, self.overlap))[:, :, np.newaxis]
+                if outputs is None:
+                    outputs = [np.zeros((1, height, width, 1), dtype=np.float32) for _ in tile_outputs]
+                for output, tile_output in zip(outputs, tile_outputs):
+                    output[0, y:y + tile_h, x:x + tile_w] += weights * tile_output[0]
+                weight_sum[y:y + tile_h, x:x + tile_w] += weights
+        return [output / weight_sum for output in outputs]
+
+    def close(self):
+        close_predictor(self.tile_func)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# File: shard_utils.py
+
+"""
+Packed DTU training shards.
+
+Every scan is packed once into a single raw binary file ``scan%d.shard`` plus a small ``scan%d.json``
+header that records the offset, dtype and shape of each array in it:
+
+* images: uint8, (lighting_num, cam_num, h, w, 3), decoded BGR images, as cv2.imread returns them
+* depths: float32, (cam_num, h', w', 1), reference depth maps already masked to the sweep range
+* cams: float32, (cam_num, 2, 4, 4), cameras in matrix form with interval_scale applied
+
+Readers memory-map the arrays, so loading a sample is a page-in instead of a png decode.
+"""
+
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import cv2
+from tensorpack.utils import logger
+from DataManager import (Cam, CamTable, load_pfm, clip_mask_depth)
+
+__all__ = ['pack_dtu_scan', 'pack_dtu_dataset', 'DTUShardReader']
+
+SHARD_VERSION = 1
+# keep every array page aligned so that np.memmap views never straddle a page boundary
+SHARD_ALIGNMENT = 4096
+DTU_LIGHTING_NUM = 7
+
+
+def _align(offset, alignment=SHARD_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _shard_paths(shard_dir, scan):
+    return os.path.join(shard_dir, 'scan%d.shard' % scan), os.path.join(shard_dir, 'scan%d.json' % scan)
+
+
+def _read_cam_num(dtu_data_folder):
+    with open(os.path.join(dtu_data_folder, 'Cameras/pair.txt'), 'r') as cluster_file:
+        return int(cluster_file.read().split()[0])
+
+
+def pack_dtu_scan(dtu_data_folder, scan, shard_dir, max_d, interval_scale):
+    """
+    pack one scan of the dtu training set into a shard
+    :param dtu_data_folder: root of dtu_training, contains Rectified, Cameras and Depths
+    :param scan: scan index
+    :param shard_dir: output dir
+    :param max_d: depth num used to mask the depth maps, has to match the training run
+    :param interval_scale: interval scale used to mask the depth maps, has to match the training run
+    :return: path of the shard
+    """
+    image_folder = os.path.join(dtu_data_folder, ('Rectified/scan%d_train' % scan))
+    cam_folder = os.path.join(dtu_data_folder, 'Cameras/train')
+    depth_folder = os.path.join(dtu_data_folder, ('Depths/scan%d_train' % scan))
+    cam_num = _read_cam_num(dtu_data_folder)
+
+    # cams first, they are needed to mask the depth maps
+    cams = CamTable.get(cam_folder, max_d, interval_scale)[:cam_num]
+
+    # probe the first image and depth map for their shapes
+    image_shape = cv2.imread(os.path.join(image_folder, 'rect_001_0_r5000.png')).shape
+    depth_shape = load_pfm(os.path.join(depth_folder, 'depth_map_0000.pfm')).shape + (1,)
+
+    arrays = {}
+    offset = 0
+    for name, dtype, shape in [('images', np.uint8, (DTU_LIGHTING_NUM, cam_num) + tuple(image_shape)),
+                               ('depths', np.float32, (cam_num,) + tuple(depth_shape)),
+                               ('cams', np.float32, (cam_num, 2, 4, 4))]:
+        arrays[name] = {'offset': offset, 'dtype': np.dtype(dtype).str, 'shape': list(shape)}
+        offset = _align(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+
+    shard_path, meta_path = _shard_paths(shard_dir, scan)
+    with open(shard_path, 'wb') as shard_file:
+        shard_file.truncate(offset)
+
+    def _open(name):
+        spec = arrays[name]
+        return np.memmap(shard_path, dtype=spec['dtype'], mode='r+', offset=spec['offset'],
+                         shape=tuple(spec['shape']))
+
+    images = _open('images')
+    for light in range(DTU_LIGHTING_NUM):
+        for index in range(cam_num):
+            img = cv2.imread(os.path.join(image_folder, ('rect_%03d_%d_r5000.png' % ((index + 1), light))))
+            assert img is not None and img.shape == images.shape[2:], 'bad image: scan %d, light %d, view %d' \
+                                                                      % (scan, light, index)
+            images[light, index] = img
+    images.flush()
+    del images
+
+    depths = _open('depths')
+    for index in range(cam_num):
+        depth_min, depth_interval = Cam.get_depth_meta(cams[index], 'depth_min', 'depth_interval')
+        depth_start = depth_min + depth_interval
+        depth_end = depth_min + (max_d - 2) * depth_interval
+        depth_image = load_pfm(os.path.join(depth_folder, ('depth_map_%04d.pfm' % index)))
+        depths[index] = clip_mask_depth(depth_image, depth_start, depth_end)
+    depths.flush()
+    del depths
+
+    cam_table = _open('cams')
+    cam_table[:] = cams
+    cam_table.flush()
+    del cam_table
+
+    meta = {'version': SHARD_VERSION, 'scan': scan, 'max_d': max_d, 'interval_scale': interval_scale,
+            'arrays': arrays}
+    with open(meta_path, 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    return shard_path
+
+
+def pack_dtu_dataset(dtu_data_folder, shard_dir, max_d, interval_scale, scans):
+    """ pack the given scans, pair.txt is copied along so that the shard dir is self-contained """
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    shutil.copyfile(os.path.join(dtu_data_folder, 'Cameras/pair.txt'), os.path.join(shard_dir, 'pair.txt'))
+    for scan in scans:
+        logger.info('packing scan %d' % scan)
+        pack_dtu_scan(dtu_data_folder, scan, shard_dir, max_d, interval_scale)
+
+
+class DTUShardReader(object):
+    """
+    read-only, memory-mapped view of one packed scan
+    images, depths and cams are np.memmap, slicing them only touches the pages needed
+    """
+
+    def __init__(self, shard_dir, scan):
+        shard_path, meta_path = _shard_paths(shard_dir, scan)
+        with open(meta_path, 'r') as meta_file:
+            self.meta = json.load(meta_file)
+        assert self.meta['version'] == SHARD_VERSION, 'shard version {} is not supported'.format(self.meta['version'])
+        self.scan = scan
+        self.max_d = self.meta['max_d']
+        self.interval_scale = self.meta['interval_scale']
+        for name, spec in self.meta['arrays'].items():
+            setattr(self, name, np.memmap(shard_path, dtype=spec['dtype'], mode='r', offset=spec['offset'],
+                                          shape=tuple(spec['shape'])))
+
+
+if __name__ == "__main__":
+    from dataflow_utils import DTU_TRAINING_SET, DTU_VALIDATION_SET
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', help='path to dtu_training', required=True)
+    parser.add_argument('--out', help='output dir of the shards', required=True)
+    parser.add_argument('--max_d', required=True, type=int)
+    parser.add_argument('--interval_scale', required=True, type=float)
+    args = parser.parse_args()
+
+    pack_dtu_dataset(args.data, args.out, args.max_d, args.interval_scale, DTU_TRAINING_SET + DTU_VALIDATION_SET)
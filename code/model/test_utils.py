@@ -86,10 +86,11 @@ class LogManager(object):
                 'intrinsic': intrinsic, 'extrinsic': extrinsic}
 
     @staticmethod
-    def format_log(parsed_dict, depth_min, depth_interval):
+    def format_log(parsed_dict, depth_min, depth_interval, depth_max=None):
         """
 
         :param parsed_dict: output of the `parse` method
+        :param depth_max: optional, written with the depth num of the range at depth_interval
         :return: write_lines, directly write it line by line would yield the standard dataset
         """
         write_buffer = []
@@ -102,7 +103,11 @@ class LogManager(object):
         intrinsic = parsed_dict['intrinsic']
         for row in intrinsic:
             write_buffer.append(' '.join([str(item) for item in row]))
-        write_buffer.append('\n' + str(depth_min) + ' ' + str(depth_interval))
+        if depth_max is None:
+            write_buffer.append('\n' + str(depth_min) + ' ' + str(depth_interval))
+        else:
+            depth_num = int(round((depth_max - depth_min) / depth_interval))
+            write_buffer.append('\n{} {} {} {}'.format(depth_min, depth_interval, depth_num, depth_max))
         return write_buffer
 
     @staticmethod
@@ -287,13 +292,14 @@ def is_img_file(file):
     return ext.lower() == '.jpg' or ext.lower() == '.png'
 
 
-def gen_dataset(base_dir, out_dir, depth_min, depth_interval):
+def gen_dataset(base_dir, out_dir, depth_min, depth_interval, depth_max=None):
     """
     generate a well-formmated dataset directly
     :param base_dir: must contains color_depth_log
     :param out_dir:
     :param depth_min:
     :param depth_interval:
+    :param depth_max: optional, lets the test loader adapt the num of depth planes (see adapt_depth_num)
     :return:
     """
     assert isinstance(depth_min, (list, np.ndarray, tuple)), type(depth_min)
@@ -309,7 +315,8 @@ def gen_dataset(base_dir, out_dir, depth_min, depth_interval):
     make_standard_dataset_dir(out_dir)
 
     for idx, parsed_dict in enumerate(parsed_dict_list):
-        standard_log_lines = log_manager.format_log(parsed_dict, depth_min[idx], depth_interval[idx])
+        standard_log_lines = log_manager.format_log(parsed_dict, depth_min[idx], depth_interval[idx],
+                                                    None if depth_max is None else depth_max[idx])
         log_manager.write_log_lines(standard_log_lines, path.join(out_dir, 'cams', '%08d_cam.txt' % parsed_dict['id']))
 
     """ generate images """
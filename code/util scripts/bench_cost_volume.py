@@ -0,0 +1,104 @@
+"""
+File: bench_cost_volume.py
+Graph size, build time, run time and equality of the cost volume builders of homography_utils.py.
+Every builder gets its own graph, fed with the same random feature maps and DTU-like cams.
+rss_growth_mb is the growth of the peak resident memory of the process over the first run, it is only meaningful
+for the first builder of a process: compare the memory of the builders with one --builders per run.
+
+    PYTHONPATH=code/model python "code/util scripts/bench_cost_volume.py" --depth_num 256 --view_num 5
+"""
+import time
+import argparse
+import resource
+import numpy as np
+import tensorflow as tf
+from homography_utils import (get_homographies, build_cost_volume, build_cost_volume_batched,
+                              build_cost_volume_chunked)
+from bench_utils import (time_func, report)
+
+BUILDERS = {
+    'loop': lambda view_homographies, feature_maps, args: build_cost_volume(
+        view_homographies, feature_maps, args.depth_num, dtype=tf.as_dtype(args.dtype)),
+    'batched': lambda view_homographies, feature_maps, args: tf.cast(build_cost_volume_batched(
+        view_homographies, feature_maps, args.depth_num), args.dtype),
+    'chunked': lambda view_homographies, feature_maps, args: build_cost_volume_chunked(
+        view_homographies, feature_maps, args.depth_num, args.depth_chunk, dtype=tf.as_dtype(args.dtype)),
+    'preallocated': lambda view_homographies, feature_maps, args: build_cost_volume_chunked(
+        view_homographies, feature_maps, args.depth_num, args.depth_chunk, dtype=tf.as_dtype(args.dtype),
+        preallocate=True),
+}
+
+
+def make_cams(view_num, h, w, depth_start, depth_interval, seed=0):
+    """ cams at the resolution of the feature maps, looking at the same scene from slightly shifted positions """
+    rng = np.random.RandomState(seed)
+    cams = np.zeros((1, view_num, 2, 4, 4), dtype=np.float32)
+    for view in range(view_num):
+        angle = rng.uniform(-0.1, 0.1)
+        rotation = np.array([[np.cos(angle), 0, np.sin(angle)], [0, 1, 0], [-np.sin(angle), 0, np.cos(angle)]])
+        cams[0, view, 0, :3, :3] = rotation
+        cams[0, view, 0, :3, 3] = rng.uniform(-50., 50., size=3)
+        cams[0, view, 0, 3, 3] = 1.
+        cams[0, view, 1, :3, :3] = [[1.2 * w, 0, w / 2.], [0, 1.2 * w, h / 2.], [0, 0, 1]]
+        cams[0, view, 1, 3, :2] = [depth_start, depth_interval]
+    return cams
+
+
+def build(builder, args):
+    graph = tf.Graph()
+    with graph.as_default():
+        feature_maps = tf.placeholder(tf.float32, [1, args.view_num, args.h, args.w, args.c], 'feature_maps')
+        cams = tf.placeholder(tf.float32, [1, args.view_num, 2, 4, 4], 'cams')
+        depth_start = tf.reshape(cams[:, 0, 1, 3, 0], [1])
+        depth_interval = tf.reshape(cams[:, 0, 1, 3, 1], [1])
+        start = time.perf_counter()
+        view_homographies = [get_homographies(cams[:, 0], cams[:, view], args.depth_num, depth_start,
+                                              depth_interval) for view in range(1, args.view_num)]
+        cost_volume = BUILDERS[builder](view_homographies, feature_maps, args)
+        build_time = time.perf_counter() - start
+        node_num = len(graph.as_graph_def().node)
+    return graph, feature_maps, cams, cost_volume, build_time, node_num
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--builders', default='loop,batched,chunked,preallocated')
+    parser.add_argument('--depth_chunk', default=32, type=int, help='depth planes per iteration of chunked and preallocated')
+    parser.add_argument('--view_num', default=5, type=int)
+    parser.add_argument('--depth_num', default=256, type=int)
+    parser.add_argument('--h', default=128, type=int, help='height of the feature maps')
+    parser.add_argument('--w', default=160, type=int, help='width of the feature maps')
+    parser.add_argument('--c', default=32, type=int)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'bfloat16'],
+                        help='dtype the cost volume is stored in')
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    feed_features = rng.randn(1, args.view_num, args.h, args.w, args.c).astype(np.float32)
+    feed_cams = make_cams(args.view_num, args.h, args.w, 425., 2.5 * 192 / args.depth_num)
+
+    results = []
+    reference = None
+    for builder in args.builders.split(','):
+        graph, feature_maps, cams, cost_volume, build_time, node_num = build(builder, args)
+        feed = {feature_maps: feed_features, cams: feed_cams}
+        with graph.as_default(), tf.Session(graph=graph) as sess:
+            # the max of one channel reads every plane, without a volume sized output
+            probe = tf.reduce_max(cost_volume[..., 0])
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            sess.run(probe, feed)
+            first_run = time.perf_counter() - start
+            result = {'builder': builder, 'dtype': args.dtype, 'depth_num': args.depth_num,
+                      'view_num': args.view_num, 'graph_nodes': node_num, 'build_s': build_time,
+                      'first_run_s': first_run,
+                      'rss_growth_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024.}
+            result.update(time_func(lambda: sess.run(probe, feed), repeat=args.repeat, warmup=1))
+            value = sess.run(tf.cast(cost_volume, tf.float32), feed)
+        if reference is None:
+            reference = value
+        result['max_abs_diff'] = float(np.abs(value - reference).max())
+        results.append(result)
+    report(results, args.json, {'args': vars(args), 'tensorflow': tf.__version__})
@@ -0,0 +1,99 @@
+"""
+File: bench_cost_volume_dtype.py
+Accuracy and peak memory of MVSNet with the cost volume stored in float32, float16 and bfloat16
+(--cost_volume_dtype), on the first samples of the DTU validation set. Every dtype gets its own graph with the
+same weights: restored from --load, or without it the random weights of the first graph are copied into the
+others (then only the memory and the deviation from the first dtype are meaningful).
+
+    PYTHONPATH=code/model python "code/util scripts/bench_cost_volume_dtype.py" --data dtu_training --load model
+"""
+import os
+import argparse
+
+# cpu only, before tensorflow is imported
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+import numpy as np
+import tensorflow as tf
+from tensorpack import (TowerContext, get_model_loader, DictRestore)
+from mvsnet_model import MVSNet
+from nn_utils import (unet_feature_extraction_branch, uni_feature_extraction_branch, COST_VOLUME_MODES,
+                      COST_VOLUME_DTYPES)
+from dataflow_utils import DTU
+from bench_utils import (time_func, run_peak_bytes, report)
+
+OUTPUT_NAMES = ['loss', 'less_one_accuracy', 'less_three_accuracy', 'coarse_depth']
+
+
+def build(dtype, args, weights=None):
+    """
+    :param weights: dict of variable name to value to initialize the graph with, instead of --load
+    :return: the session, the inputs and the outputs of the graph, and its weights
+    """
+    branch_function = unet_feature_extraction_branch if args.feature == 'unet' else uni_feature_extraction_branch
+    model = MVSNet(depth_num=args.max_d, bn_training=None, bn_trainable=None, batch_size=1,
+                   branch_function=branch_function, is_refine=False, height=args.max_h, width=args.max_w,
+                   view_num=args.view_num, regularize_type=args.regularize, cost_volume_mode=args.cost_volume,
+                   cost_volume_dtype=dtype)
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs = model.inputs()
+        with TowerContext('', is_training=False):
+            model.build_graph(*inputs)
+        outputs = [graph.get_tensor_by_name(name + ':0') for name in OUTPUT_NAMES]
+        sess = tf.Session(graph=graph)
+        if args.load:
+            get_model_loader(args.load).init(sess)
+        elif weights is not None:
+            # the variables are named the same whatever the dtype of the cost volume
+            DictRestore(weights).init(sess)
+        else:
+            sess.run(tf.global_variables_initializer())
+        variables = tf.global_variables()
+        weights = dict(zip([variable.op.name for variable in variables], sess.run(variables)))
+    return sess, inputs, outputs, weights
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', help='dtu_training root', required=True)
+    parser.add_argument('--load', help='model to restore, the weights of the first graph are random otherwise')
+    parser.add_argument('--dtypes', default=','.join(COST_VOLUME_DTYPES))
+    parser.add_argument('--samples', default=8, type=int, help='num of validation samples')
+    parser.add_argument('--feature', choices=['uninet', 'unet'], default='unet')
+    parser.add_argument('--regularize', default='3DCNN', choices=['3DCNN', 'GRU'])
+    parser.add_argument('--cost_volume', default='batched', choices=COST_VOLUME_MODES)
+    parser.add_argument('--max_d', default=192, type=int)
+    parser.add_argument('--max_h', default=512, type=int)
+    parser.add_argument('--max_w', default=640, type=int)
+    parser.add_argument('--view_num', default=3, type=int)
+    parser.add_argument('--interval_scale', default=1.06, type=float)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    ds = DTU(args.data, args.view_num, 'val', args.interval_scale, args.max_d, shuffle=False)
+    ds.reset_state()
+    dps = [ds[i] for i in range(min(args.samples, len(ds)))]
+
+    results = []
+    reference_depths = None
+    weights = None
+    for dtype in args.dtypes.split(','):
+        sess, inputs, outputs, weights = build(dtype, args, weights)
+        feeds = [{placeholder: np.expand_dims(component, 0) for placeholder, component in zip(inputs, dp)}
+                 for dp in dps]
+        values = [sess.run(outputs, feed) for feed in feeds]
+        losses, less_ones, less_threes, depths = zip(*values)
+        result = {'dtype': dtype, 'regularize': args.regularize, 'samples': len(dps),
+                  'loss': float(np.mean(losses)), 'less_one_accuracy': float(np.mean(less_ones)),
+                  'less_three_accuracy': float(np.mean(less_threes)),
+                  'peak_mb': run_peak_bytes(sess, outputs, feeds[0]) / 1024. ** 2}
+        if reference_depths is None:
+            reference_depths = depths
+        result['depth_max_abs_diff'] = float(max(np.abs(depth - reference).max()
+                                                 for depth, reference in zip(depths, reference_depths)))
+        result.update(time_func(lambda: sess.run(outputs, feeds[0]), repeat=args.repeat, warmup=0))
+        sess.close()
+        results.append(result)
+    report(results, args.json, {'args': vars(args), 'tensorflow': tf.__version__})
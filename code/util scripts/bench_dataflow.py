@@ -0,0 +1,219 @@
+"""
+File: bench_dataflow.py
+Per-stage benchmark of the training (DTU) and test dataflows on a synthetic, DTU-shaped fixture written to disk:
+image decode, cam parse, pfm load, depth mask, whole sample, batch, and the queue between the loader workers and
+the trainer, swept over worker counts and batch sizes. Results go to a json file to compare between releases.
+
+    PYTHONPATH=code/model python "code/util scripts/bench_dataflow.py" --fixture /tmp/dtu_fixture --json out.json
+"""
+import os
+import time
+import argparse
+import platform
+import numpy as np
+import cv2
+from tensorpack import BatchData
+from tensorpack.utils import logger
+from DataManager import (Cam, CamTable, load_pfm, write_pfm, clip_mask_depth)
+from dataflow_utils import (DTU, DTU_TRAINING_SET, gen_test_input_sample_list, preprocess_mvs_input)
+from manifest_utils import (build_dtu_manifest, DTU_IMAGE_FILE, DTU_DEPTH_FILE, DTU_CAM_FILE, DTU_PAIR_FILE)
+from loader_utils import SharedMemoryLoader
+from bench_utils import (time_func, report)
+
+
+def _fake_cam(index, h, w):
+    cam = np.zeros((2, 4, 4), dtype=np.float32)
+    cam[0] = np.eye(4)
+    cam[0, 0, 3] = 0.1 * index
+    cam[1, :3, :3] = [[1.2 * w, 0, w / 2.], [0, 1.2 * w, h / 2.], [0, 0, 1]]
+    cam[1, 3] = [425., 2.5, 192., 905.]
+    return cam
+
+
+def _fake_image(rng, h, w):
+    # smooth content, so that the png and jpg sizes are closer to real photos than white noise
+    coarse = rng.randint(0, 256, size=(max(h // 16, 1), max(w // 16, 1), 3)).astype(np.uint8)
+    return cv2.resize(coarse, (w, h), interpolation=cv2.INTER_LINEAR)
+
+
+def _write_pair(pair_path, cam_num):
+    with open(pair_path, 'w') as pair_file:
+        pair_file.write('%d\n' % cam_num)
+        for index in range(cam_num):
+            src_num = min(10, cam_num - 1)
+            pairs = ' '.join('%d %f' % ((index + k) % cam_num, 1. / k) for k in range(1, src_num + 1))
+            pair_file.write('%d\n%d %s\n' % (index, src_num, pairs))
+
+
+def make_dtu_fixture(root, scans, cam_num, h, w, seed=0):
+    """ dtu_training-like root: Rectified pngs of 7 lightings, Depths pfms at 1/4 resolution, Cameras """
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root, 'Cameras/train'), exist_ok=True)
+    _write_pair(os.path.join(root, DTU_PAIR_FILE), cam_num)
+    for index in range(cam_num):
+        Cam.write_cam(_fake_cam(index, h, w), os.path.join(root, DTU_CAM_FILE % index))
+    for scan in scans:
+        os.makedirs(os.path.join(root, 'Rectified/scan%d_train' % scan), exist_ok=True)
+        os.makedirs(os.path.join(root, 'Depths/scan%d_train' % scan), exist_ok=True)
+        for index in range(cam_num):
+            for light in range(7):
+                cv2.imwrite(os.path.join(root, DTU_IMAGE_FILE % (scan, index + 1, light)), _fake_image(rng, h, w))
+            depth = rng.uniform(400., 950., size=(h // 4, w // 4)).astype(np.float32)
+            write_pfm(os.path.join(root, DTU_DEPTH_FILE % (scan, index)), depth)
+
+
+def make_test_fixture(root, scene_num, image_num, h, w, seed=0):
+    """ test root: numbered scenes of images/*.jpg, cams/*_cam.txt and pair.txt """
+    rng = np.random.RandomState(seed)
+    for scene in range(scene_num):
+        scene_dir = os.path.join(root, str(scene))
+        os.makedirs(os.path.join(scene_dir, 'images'), exist_ok=True)
+        os.makedirs(os.path.join(scene_dir, 'cams'), exist_ok=True)
+        _write_pair(os.path.join(scene_dir, 'pair.txt'), image_num)
+        for index in range(image_num):
+            cv2.imwrite(os.path.join(scene_dir, 'images/%08d.jpg' % index), _fake_image(rng, h, w))
+            Cam.write_cam(_fake_cam(index, h, w), os.path.join(scene_dir, 'cams/%08d_cam.txt' % index))
+
+
+def _per_item(result, num):
+    """ turn the timings of a batch of num items into timings per item """
+    for key in ['mean_ms', 'std_ms', 'min_ms', 'median_ms']:
+        result[key] /= num
+    result['items'] = num
+    return result
+
+
+def bench_dtu_stages(root, scans, args):
+    cam_num = args.cam_num
+    image_paths = [os.path.join(root, DTU_IMAGE_FILE % (scans[0], index + 1, 3)) for index in range(cam_num)]
+    cam_paths = [os.path.join(root, DTU_CAM_FILE % index) for index in range(cam_num)]
+    depth_paths = [os.path.join(root, DTU_DEPTH_FILE % (scans[0], index)) for index in range(cam_num)]
+    depths = [load_pfm(path) for path in depth_paths]
+    results = []
+
+    def _stage(name, func, num):
+        result = {'dataflow': 'dtu', 'stage': name}
+        result.update(_per_item(time_func(func, repeat=args.repeat), num))
+        results.append(result)
+
+    _stage('image_decode', lambda: [cv2.imread(path) for path in image_paths], cam_num)
+    _stage('cam_parse', lambda: [Cam(path, args.max_d, args.interval_scale).get_mat_form() for path in cam_paths],
+           cam_num)
+    _stage('cam_table_build', lambda: CamTable._build(os.path.join(root, 'Cameras/train'), args.max_d,
+                                                      args.interval_scale), 1)
+    _stage('pfm_load', lambda: [np.array(load_pfm(path)) for path in depth_paths], cam_num)
+    _stage('depth_mask', lambda: [clip_mask_depth(depth, 427.5, 900.) for depth in depths], cam_num)
+
+    ds = DTU(root, args.view_num, 'train', args.interval_scale, args.max_d, shuffle=False,
+             manifest=build_dtu_manifest(root, scans))
+    ds.reset_state()
+    sample_num = min(len(ds), 4 * cam_num)
+    _stage('sample', lambda: [ds[i] for i in range(sample_num)], sample_num)
+    for batch_size in args.batch_sizes:
+        dps = [ds[i] for i in range(batch_size)]
+        # what BatchData does for every batch
+        _stage('batch_%d' % batch_size, lambda: [np.stack(component) for component in zip(*dps)], 1)
+    return ds, results
+
+
+def bench_dtu_queue(ds, args):
+    """ consumer side throughput of the trainer queue, in process (BatchData) and through the worker loader """
+    results = []
+    for batch_size in args.batch_sizes:
+        for workers in args.workers:
+            if workers == 0:
+                loader = BatchData(ds, batch_size, remainder=False)
+            else:
+                loader = SharedMemoryLoader(ds, batch_size, workers)
+            loader.reset_state()
+            batch_num = min(len(loader), args.queue_batches)
+            it = iter(loader)
+            # the first batch includes the worker start up
+            next(it)
+            waits = []
+            start = time.perf_counter()
+            for _ in range(batch_num - 1):
+                wait_start = time.perf_counter()
+                next(it)
+                waits.append((time.perf_counter() - wait_start) * 1000.)
+            elapsed = time.perf_counter() - start
+            results.append({'dataflow': 'dtu', 'stage': 'queue', 'workers': workers, 'batch': batch_size,
+                            'samples_per_sec': (batch_num - 1) * batch_size / elapsed,
+                            'mean_ms': float(np.mean(waits)), 'median_ms': float(np.median(waits))})
+            # the loader workers are daemons, drop them before the next configuration
+            if workers > 0:
+                for proc in loader._procs:
+                    proc.terminate()
+    return results
+
+
+def bench_test_stages(root, args):
+    scene_dir = os.path.join(root, '0')
+    sample_list = gen_test_input_sample_list(scene_dir, args.view_num)
+    image_paths = [paths[0] for paths in sample_list]
+    cam_paths = [paths[1] for paths in sample_list]
+    images = [cv2.imread(path) for path in image_paths[:args.view_num]]
+    cams = np.array([Cam(path, args.max_d, args.interval_scale).get_mat_form() for path in cam_paths[:args.view_num]])
+    results = []
+
+    def _stage(name, func, num, **extra):
+        result = {'dataflow': 'test', 'stage': name}
+        result.update(extra)
+        result.update(_per_item(time_func(func, repeat=args.repeat), num))
+        results.append(result)
+
+    _stage('image_decode', lambda: [cv2.imread(path) for path in image_paths], len(image_paths))
+    _stage('cam_parse', lambda: [Cam(path, args.max_d, args.interval_scale).get_mat_form() for path in cam_paths],
+           len(cam_paths))
+    _stage('preprocess', lambda: preprocess_mvs_input(images, np.copy(cams), args.test_max_h, args.test_max_w), 1)
+    sample_num = len(sample_list) * args.test_scenes
+    for threads in sorted(set(max(workers, 1) for workers in args.workers)):
+        _stage('stream', lambda: list(DTU.make_test_dataset(root, args.view_num, args.test_max_h, args.test_max_w,
+                                                            args.max_d, args.interval_scale,
+                                                            nr_thread=threads, prefetch=2 * threads)),
+               sample_num, workers=threads)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixture', help='dir of the synthetic fixture, written if missing', required=True)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--scans', default=1, type=int, help='num of fixture scans')
+    parser.add_argument('--cam_num', default=49, type=int)
+    parser.add_argument('--h', default=512, type=int, help='height of the training images')
+    parser.add_argument('--w', default=640, type=int, help='width of the training images')
+    parser.add_argument('--test_scenes', default=1, type=int)
+    parser.add_argument('--test_images', default=10, type=int)
+    parser.add_argument('--test_h', default=1200, type=int)
+    parser.add_argument('--test_w', default=1600, type=int)
+    parser.add_argument('--test_max_h', default=1024, type=int)
+    parser.add_argument('--test_max_w', default=1280, type=int)
+    parser.add_argument('--view_num', default=3, type=int)
+    parser.add_argument('--max_d', default=192, type=int)
+    parser.add_argument('--interval_scale', default=1.06, type=float)
+    parser.add_argument('--workers', default='0,1,2,4', help='comma separated worker (thread) counts to sweep')
+    parser.add_argument('--batch_sizes', default='1,2,4', help='comma separated batch sizes to sweep')
+    parser.add_argument('--queue_batches', default=50, type=int, help='num of batches timed per queue setting')
+    parser.add_argument('--repeat', default=5, type=int)
+    args = parser.parse_args()
+    args.workers = [int(x) for x in args.workers.split(',')]
+    args.batch_sizes = [int(x) for x in args.batch_sizes.split(',')]
+
+    dtu_root = os.path.join(args.fixture, 'dtu')
+    test_root = os.path.join(args.fixture, 'test')
+    scans = DTU_TRAINING_SET[:args.scans]
+    if not os.path.exists(dtu_root):
+        logger.info('writing dtu fixture to {}'.format(dtu_root))
+        make_dtu_fixture(dtu_root, scans, args.cam_num, args.h, args.w)
+    if not os.path.exists(test_root):
+        logger.info('writing test fixture to {}'.format(test_root))
+        make_test_fixture(test_root, args.test_scenes, args.test_images, args.test_h, args.test_w)
+
+    ds, results = bench_dtu_stages(dtu_root, scans, args)
+    results.extend(bench_dtu_queue(ds, args))
+    results.extend(bench_test_stages(test_root, args))
+    meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'opencv': cv2.__version__, 'cpu_count': os.cpu_count(),
+            'args': vars(args)}
+    report(results, args.json, meta)
@@ -0,0 +1,66 @@
+"""
+File: bench_feature_extraction.py
+CPU benchmark of feature_extraction_net, one branch pass per view against one pass over all views.
+Both paths are built in the same graph and share their variables, so their outputs are compared directly.
+
+    PYTHONPATH=code/model python "code/util scripts/bench_feature_extraction.py" --batch 1 --view_num 5
+"""
+import os
+import time
+import argparse
+
+# cpu only, before tensorflow is imported
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+import numpy as np
+import tensorflow as tf
+from tensorpack import (argscope, Conv2D, Conv2DTranspose, BatchNorm, TowerContext)
+from nn_utils import (feature_extraction_net, unet_feature_extraction_branch, uni_feature_extraction_branch,
+                      mvsnet_gn, FEATURE_VIEW_MODES)
+from bench_utils import (time_func, report)
+
+BRANCHES = {
+    'unet': unet_feature_extraction_branch,
+    'uninet': uni_feature_extraction_branch,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feature', choices=list(BRANCHES), default='unet')
+    parser.add_argument('--batch', default=1, type=int)
+    parser.add_argument('--view_num', default=5, type=int)
+    parser.add_argument('--h', default=512, type=int)
+    parser.add_argument('--w', default=640, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='intra op threads, 0 lets tensorflow decide')
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    imgs = tf.placeholder(tf.float32, [None, args.view_num, args.h, args.w, 3], 'imgs')
+    outputs = {}
+    build_times = {}
+    node_nums = {}
+    with TowerContext('', is_training=False), \
+            argscope([Conv2D, Conv2DTranspose, BatchNorm, mvsnet_gn], data_format='channels_last'):
+        for mode in FEATURE_VIEW_MODES:
+            node_num = len(tf.get_default_graph().as_graph_def().node)
+            start = time.perf_counter()
+            with tf.name_scope(mode):
+                outputs[mode] = feature_extraction_net(imgs, BRANCHES[args.feature], feature_views=mode)
+            build_times[mode] = time.perf_counter() - start
+            node_nums[mode] = len(tf.get_default_graph().as_graph_def().node) - node_num
+
+    feed = {imgs: np.random.RandomState(0).rand(args.batch, args.view_num, args.h, args.w, 3).astype(np.float32)}
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.threads, inter_op_parallelism_threads=args.threads)
+    results = []
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        values = {mode: sess.run(outputs[mode], feed) for mode in FEATURE_VIEW_MODES}
+        for mode in FEATURE_VIEW_MODES:
+            result = {'feature_views': mode, 'batch': args.batch, 'view_num': args.view_num,
+                      'graph_nodes': node_nums[mode], 'build_s': build_times[mode],
+                      'max_abs_diff': float(np.abs(values[mode] - values['per_view']).max())}
+            result.update(time_func(lambda: sess.run(outputs[mode], feed), repeat=args.repeat, warmup=1))
+            results.append(result)
+    report(results, args.json, {'args': vars(args), 'tensorflow': tf.__version__})
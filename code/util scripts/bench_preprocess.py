@@ -0,0 +1,66 @@
+"""
+File: bench_preprocess.py
+Microbenchmark of the test-time preprocessing: the per-view scale_mvs_input + crop_mvs_input + scale_camera path
+against the vectorized preprocess_mvs_input, on random images of a given resolution.
+
+    PYTHONPATH=code/model python "code/util scripts/bench_preprocess.py" --h 1200 --w 1600 --max_h 1024 --max_w 1280
+"""
+import argparse
+import numpy as np
+from dataflow_utils import (scale_mvs_input, crop_mvs_input, scale_camera, preprocess_mvs_input)
+from bench_utils import (time_func, report)
+
+
+def make_inputs(view_num, h, w, seed=0):
+    rng = np.random.RandomState(seed)
+    images = [rng.randint(0, 256, size=(h, w, 3), dtype=np.uint8) for _ in range(view_num)]
+    cams = np.zeros((view_num, 2, 4, 4), dtype=np.float32)
+    cams[:, 0] = np.eye(4)
+    cams[:, 1, 0, 0] = cams[:, 1, 1, 1] = 1.2 * w
+    cams[:, 1, 0, 2] = w / 2.
+    cams[:, 1, 1, 2] = h / 2.
+    cams[:, 1, 2, 2] = 1.
+    cams[:, 1, 3] = [425., 2.5, 192., 905.]
+    return images, cams
+
+
+def per_view_path(images, cams, max_h, max_w):
+    """ the path make_test_data used to take """
+    h, w, _ = images[0].shape
+    resize_scale = max(float(max_h) / h, float(max_w) / w)
+    images, cams = scale_mvs_input(list(images), list(np.copy(cams)), scale=resize_scale)
+    images, cams = crop_mvs_input(images, cams, max_h, max_w, base_image_size=8)
+    cams = [scale_camera(cam, 0.25) for cam in cams]
+    return np.array(images), np.array(cams)
+
+
+def vectorized_path(images, cams, max_h, max_w, out=None):
+    return preprocess_mvs_input(images, np.copy(cams), max_h, max_w, base_image_size=8, cam_scale=0.25, out=out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--view_num', default=5, type=int)
+    parser.add_argument('--h', default=1200, type=int)
+    parser.add_argument('--w', default=1600, type=int)
+    parser.add_argument('--max_h', default=1024, type=int)
+    parser.add_argument('--max_w', default=1280, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    images, cams = make_inputs(args.view_num, args.h, args.w)
+    ref_images, ref_cams = per_view_path(images, cams, args.max_h, args.max_w)
+    new_images, new_cams = vectorized_path(images, cams, args.max_h, args.max_w)
+    assert np.array_equal(ref_images, new_images), 'images differ'
+    assert np.allclose(ref_cams, new_cams), 'cams differ: {}'.format(np.abs(ref_cams - new_cams).max())
+    out = np.empty_like(new_images)
+
+    results = []
+    for name, func in [('per_view', lambda: per_view_path(images, cams, args.max_h, args.max_w)),
+                       ('vectorized', lambda: vectorized_path(images, cams, args.max_h, args.max_w)),
+                       ('vectorized_out', lambda: vectorized_path(images, cams, args.max_h, args.max_w, out=out))]:
+        result = {'path': name, 'view_num': args.view_num, 'h': args.h, 'w': args.w}
+        result.update(time_func(func, repeat=args.repeat))
+        results.append(result)
+    report(results, args.json)
@@ -0,0 +1,83 @@
+"""
+File: bench_prob_map.py
+CPU time and peak memory of get_propability_map against the former gather_nd version
+(get_propability_map_gather_nd), on a random probability volume and depth maps that hit integer depths and the
+ends of the volume. Every version gets its own graph.
+
+    PYTHONPATH=code/model python "code/util scripts/bench_prob_map.py" --depth_nums 192,256
+"""
+import os
+import time
+import argparse
+
+# cpu only, before tensorflow is imported
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+import numpy as np
+import tensorflow as tf
+from homography_utils import (get_propability_map, get_propability_map_gather_nd)
+from bench_utils import (time_func, run_peak_bytes, report)
+
+VERSIONS = {
+    'gather': get_propability_map,
+    'gather_nd': get_propability_map_gather_nd,
+}
+
+
+def make_inputs(batch, depth_num, h, w, seed=0):
+    rng = np.random.RandomState(seed)
+    logits = rng.randn(batch, depth_num, h, w).astype(np.float32)
+    prob_volume = np.exp(logits - logits.max(axis=1, keepdims=True))
+    prob_volume /= prob_volume.sum(axis=1, keepdims=True)
+    depth_start = np.full([batch], 425., dtype=np.float32)
+    depth_interval = np.full([batch], 2.5 * 192 / depth_num, dtype=np.float32)
+    depth_index = rng.uniform(-2., depth_num + 2., size=(batch, h, w))
+    # integer depths, first and last planes
+    depth_index[:, 0, :4] = [0, depth_num - 1, 3, depth_num // 2]
+    depth_map = depth_start[:, None, None] + depth_interval[:, None, None] * depth_index
+    return prob_volume, depth_map[..., None].astype(np.float32), depth_start, depth_interval
+
+
+def build(version, batch, depth_num, h, w):
+    graph = tf.Graph()
+    with graph.as_default():
+        placeholders = [tf.placeholder(tf.float32, [batch, depth_num, h, w], 'prob_volume'),
+                        tf.placeholder(tf.float32, [batch, h, w, 1], 'depth_map'),
+                        tf.placeholder(tf.float32, [batch], 'depth_start'),
+                        tf.placeholder(tf.float32, [batch], 'depth_interval')]
+        start = time.perf_counter()
+        prob_map = VERSIONS[version](*placeholders)
+        build_time = time.perf_counter() - start
+        node_num = len(graph.as_graph_def().node)
+    return graph, placeholders, prob_map, build_time, node_num
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--versions', default='gather_nd,gather')
+    parser.add_argument('--depth_nums', default='192,256')
+    parser.add_argument('--batch', default=1, type=int)
+    parser.add_argument('--h', default=128, type=int, help='height of the probability volume')
+    parser.add_argument('--w', default=160, type=int, help='width of the probability volume')
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for depth_num in [int(x) for x in args.depth_nums.split(',')]:
+        values = make_inputs(args.batch, depth_num, args.h, args.w)
+        reference = None
+        for version in args.versions.split(','):
+            graph, placeholders, prob_map, build_time, node_num = build(version, args.batch, depth_num, args.h,
+                                                                        args.w)
+            feed = dict(zip(placeholders, values))
+            with tf.Session(graph=graph) as sess:
+                value = sess.run(prob_map, feed)
+                result = {'version': version, 'depth_num': depth_num, 'graph_nodes': node_num,
+                          'build_s': build_time, 'peak_mb': run_peak_bytes(sess, prob_map, feed) / 1024. ** 2}
+                result.update(time_func(lambda: sess.run(prob_map, feed), repeat=args.repeat, warmup=1))
+            if reference is None:
+                reference = value
+            result['max_abs_diff'] = float(np.abs(value - reference).max())
+            results.append(result)
+    report(results, args.json, {'args': vars(args), 'tensorflow': tf.__version__})
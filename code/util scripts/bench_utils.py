@@ -0,0 +1,66 @@
+"""
+File: bench_utils.py
+Timing and memory helpers shared by the bench_*.py scripts.
+The scripts import the model modules flat, run them with code/model on PYTHONPATH.
+"""
+import json
+import time
+import numpy as np
+from tensorpack.utils import logger
+
+
+def time_func(func, repeat=20, warmup=2):
+    """
+    run func warmup + repeat times
+    :return: dict of mean, std, min and median of the timed runs, in milliseconds
+    """
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000.)
+    times = np.array(times)
+    return {'mean_ms': float(times.mean()), 'std_ms': float(times.std()), 'min_ms': float(times.min()),
+            'median_ms': float(np.median(times)), 'repeat': repeat}
+
+
+def run_peak_bytes(sess, fetches, feed_dict=None):
+    """
+    run fetches once with a full trace
+    :return: the highest peak of the allocators in the step stats of the run, in bytes
+    """
+    import tensorflow as tf
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+             run_metadata=run_metadata)
+    peak_bytes = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak_bytes = max(peak_bytes, memory.peak_bytes)
+    return peak_bytes
+
+
+def report(results, json_path=None, meta=None):
+    """
+    log a list of result dicts as a table, and dump them as json if json_path is given
+    :param meta: dict describing the run (fixture, versions...), stored next to the results
+    """
+    keys = []
+    for result in results:
+        keys.extend(key for key in result if key not in keys)
+    logger.info(' | '.join(keys))
+    for result in results:
+        logger.info(' | '.join(_format(result.get(key, '')) for key in keys))
+    if json_path:
+        with open(json_path, 'w') as json_file:
+            json.dump({'meta': meta or {}, 'results': results}, json_file, indent=2)
+        logger.info('results written to {}'.format(json_path))
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '{:.3f}'.format(value)
+    return str(value)
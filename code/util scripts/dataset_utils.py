@@ -80,7 +80,9 @@ if __name__ == "__main__":
             depths_interval = [depth_interval for depth_interval in depths_interval]
             depths_interval = [interval / 184. for interval in depths_interval]
 
-            gen_dataset(base_dir, path.join(out_base, str(num)), depth_min=min_depths, depth_interval=depths_interval)
+            # depth_max lets the test loader sweep only the planes the range needs (--target_interval)
+            gen_dataset(base_dir, path.join(out_base, str(num)), depth_min=min_depths, depth_interval=depths_interval,
+                        depth_max=max_depths)
         except FileNotFoundError:
             invalid_dir.append(dir_)
         except IndexError: